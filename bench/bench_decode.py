@@ -0,0 +1,31 @@
+"""
+Compare the time it takes to turn a large feature's JSON body into a
+Feature with coordinates decoded as Decimal (the default) and as
+float (use_decimal=False).
+
+Run it from the top of the source tree with:
+
+  PYTHONPATH=. python bench/bench_decode.py
+"""
+
+import timeit
+
+from pyutil import jsonutil as json
+
+from txsimplegeo.shared import Feature
+
+def make_polygon_body(numvertices):
+    ring = [[-86.0 + (i % 1000) * 0.0001234567, 33.0 + (i // 1000) * 0.0007654321] for i in xrange(numvertices)]
+    ring.append(ring[0])
+    return json.dumps({ 'type': 'Feature', 'id': 'SG_4b10i9vCyPnKAYiYBLKZN7', 'geometry': { 'type': 'Polygon', 'coordinates': [ring] }, 'properties': { 'name': 'Elliott Island' } })
+
+def bench(numvertices, number):
+    body = make_polygon_body(numvertices)
+    print "%d vertices, %d bytes of JSON:" % (numvertices, len(body))
+    for use_decimal in (True, False):
+        t = min(timeit.repeat(lambda: Feature.from_json(body, use_decimal), repeat=3, number=number)) / number
+        print "  use_decimal=%-5s %8.2f ms per feature" % (use_decimal, t * 1000)
+
+if __name__ == '__main__':
+    bench(1000, 100)
+    bench(100000, 3)
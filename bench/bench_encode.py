@@ -0,0 +1,36 @@
+"""
+Compare the time it takes to turn a large Feature into JSON text by
+encoding the result of to_dict(), as to_json() used to, and by
+iter_json(), which encodes straight from the Feature, for both
+nested-list and compact coordinates.
+
+Run it from the top of the source tree with:
+
+  PYTHONPATH=. python bench/bench_encode.py
+"""
+
+import timeit
+
+from pyutil import jsonutil as json
+
+from txsimplegeo.shared import Feature
+
+def make_polygon_feature(numvertices, use_decimal, compact):
+    ring = [[-86.0 + (i % 1000) * 0.0001234567, 33.0 + (i // 1000) * 0.0007654321] for i in xrange(numvertices)]
+    ring.append(ring[0])
+    properties = dict([('key%d' % i, { 'name': 'Elliott Island', 'tags': ['island', 'park'] }) for i in range(20)])
+    body = json.dumps({ 'type': 'Feature', 'id': 'SG_4b10i9vCyPnKAYiYBLKZN7', 'geometry': { 'type': 'Polygon', 'coordinates': [ring] }, 'properties': properties })
+    return Feature.from_json(body, use_decimal=use_decimal, compact=compact)
+
+def bench(numvertices, number):
+    print "%d vertices:" % (numvertices,)
+    for (use_decimal, compact) in ((True, False), (False, False), (False, True)):
+        f = make_polygon_feature(numvertices, use_decimal, compact)
+        old = min(timeit.repeat(lambda: json.dumps(f.to_dict()), repeat=3, number=number)) / number
+        new = min(timeit.repeat(lambda: ''.join(f.iter_json()), repeat=3, number=number)) / number
+        print "  use_decimal=%-5s compact=%-5s to_dict+dumps %8.2f ms, iter_json %8.2f ms" % (use_decimal, compact, old * 1000, new * 1000)
+
+if __name__ == '__main__':
+    bench(10, 2000)
+    bench(1000, 100)
+    bench(100000, 3)
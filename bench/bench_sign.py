@@ -0,0 +1,66 @@
+"""
+Compare how many OAuth signatures per second are made by the original
+sign_request() (copied below), by calling oauth.sign_request() for
+each request, which sets up the HMAC key again every time, and by
+reusing one oauth.Signer. Every request has its own nonce, as real
+ones do.
+
+Run it from the top of the source tree with:
+
+  PYTHONPATH=. python bench/bench_sign.py
+"""
+
+import hashlib, hmac, itertools, timeit, urllib
+
+from txsimplegeo.shared import oauth
+
+KEY = 'MY_OAUTH_KEY'
+SECRET = 'MY_SECRET_KEY'
+REALM = 'http://api.simplegeo.com'
+URL = 'http://api.simplegeo.com:80/1.0/features/SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970.json'
+
+def make_params(i):
+    return { 'oauth_nonce': '%032x' % i, 'oauth_timestamp': str(1291669259 + i // 1000), 'oauth_version': '1.0' }
+
+# The original implementation, before Signer.
+
+def original_escape(s):
+    return urllib.quote(oauth.to_unicode(s).encode('utf-8'), safe='~')
+
+def original_sign_request(key, secret, method, url, params, realm):
+    params['oauth_consumer_key'] = key
+    params['oauth_signature_method'] = 'HMAC-SHA1'
+
+    sig = [
+        original_escape(method),
+        original_escape(url),
+        original_escape(oauth.normalize_parameters(params)),
+    ]
+    key = '%s&' % original_escape(secret)
+    raw = '&'.join(sig)
+
+    params['oauth_signature'] = hmac.new(key, raw, hashlib.sha1).hexdigest()
+
+    oauth_params = ((k, original_escape(oauth.to_unicode(v))) for k, v in params.iteritems() if k.startswith('oauth_'))
+    header_params = ('%s="%s"' % (k, v) for k, v in oauth_params)
+    params_header = ', '.join(header_params)
+
+    auth_header = 'OAuth realm="%s"' % realm
+    if params_header:
+        auth_header = "%s, %s" % (auth_header, params_header)
+
+    return auth_header
+
+def bench(number):
+    signer = oauth.Signer(KEY, SECRET, REALM)
+    counter = itertools.count()
+    for (name, sign) in (
+        ('original sign_request()', lambda: original_sign_request(KEY, SECRET, 'GET', URL, make_params(counter.next()), REALM)),
+        ('sign_request()', lambda: oauth.sign_request(KEY, SECRET, 'GET', URL, make_params(counter.next()), REALM)),
+        ('Signer.sign_request()', lambda: signer.sign_request('GET', URL, make_params(counter.next()))),
+        ):
+        t = min(timeit.repeat(sign, repeat=3, number=number)) / number
+        print "  %-24s %8.0f signatures per second" % (name, 1 / t)
+
+if __name__ == '__main__':
+    bench(20000)
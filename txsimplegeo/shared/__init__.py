@@ -8,13 +8,19 @@ __version__ # hush pyflakes
 from zope.interface import implements
 
 from twisted.web.client import Agent, ResponseDone
+from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
+from twisted.python import log
 from twisted.python.failure import Failure
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.internet.protocol import Protocol
-from twisted.internet.defer import Deferred, succeed
+from twisted.internet.defer import CancelledError, Deferred, fail, gatherResults, maybeDeferred, succeed
 
 import copy, re
+
+from array import array
+from itertools import islice, izip
+
 from decimal import Decimal as D
 
 from urlparse import urljoin
@@ -22,54 +28,77 @@ from urlparse import urljoin
 from pyutil import jsonutil as json
 from pyutil.assertutil import precondition
 
+import oauth
+from pool import CountingHTTPConnectionPool
+from scheduler import DEFAULT_PRIORITY, RequestScheduler
+from cache import FeatureCache
+FeatureCache # hush pyflakes
+from diskstore import DiskFeatureStore
+DiskFeatureStore # hush pyflakes
+from producer import ChunkedProducer
+ChunkedProducer # hush pyflakes
+from instrument import HistogramInstrumentation, IInstrumentation, NullInstrumentation, RequestTiming
+HistogramInstrumentation, IInstrumentation # hush pyflakes
+from retry import RetryPolicy
+RetryPolicy # hush pyflakes
+from ratelimit import TokenBucket, shared_limiter
+TokenBucket # hush pyflakes
+from circuit import CircuitBreaker, CircuitOpenError
+CircuitBreaker # hush pyflakes
+from spatial import GridIndex
+GridIndex # hush pyflakes
+from metadata import DEFAULT_METADATA_HEADERS, ResponseMetadata
+from offload import DEFAULT_OFFLOAD_THRESHOLD, ProcessOffloader, ThreadOffloader
+ProcessOffloader, ThreadOffloader # hush pyflakes
+from jsonstream import IncrementalJSONDecoder, decode_object_deferring, iter_array_member
+from geometry import CompactCoordinates, deep_swap, extent, iter_geojson_coordinates, validated_extent, vertex_centroid, deep_validate_lat_lon, is_numeric, is_valid_lat, is_valid_lon, swap
+deep_swap, deep_validate_lat_lon, is_numeric, is_valid_lat, is_valid_lon, swap # hush pyflakes
+
 # example: http://api.simplegeo.com/1.0/feature/abcdefghijklmnopqrstuvwyz.json
 
-def json_decode(jsonstr):
+# Decodes numbers with a fraction or exponent as native floats, using
+# simplejson's C speedups.
+_FLOAT_DECODER = json.JSONDecoder()
+
+def json_decode(jsonstr, use_decimal=True):
+    """
+    Decode the JSON text, raising DecodeError if it is malformed.
+
+    By default numbers with a fraction or exponent are decoded as
+    decimal.Decimal, so that coordinates come back exactly as the
+    server wrote them. Pass use_decimal=False to decode them as
+    floats instead, which is several times faster for large geometries
+    and makes the resulting objects much smaller.
+    """
     try:
-        return json.loads(jsonstr)
+        if use_decimal:
+            return json.loads(jsonstr)
+        return _FLOAT_DECODER.decode(jsonstr)
     except (ValueError, TypeError), le:
         raise DecodeError(jsonstr, le)
 
-def swap(tupleab):
-    return (tupleab[1], tupleab[0])
-
-def deep_swap(struc):
-    if is_numeric(struc[0]):
-        assert len(struc) == 2
-        assert is_numeric(struc[1])
-        return swap(struc)
-    return [deep_swap(sub) for sub in struc]
-
-def deep_validate_lat_lon(struc):
-    precondition(isinstance(struc, (list, tuple, set)), 'argument must be a sequence (of sequences of...) numbers')
-    if is_numeric(struc[0]):
-        assert len(struc) == 2
-        assert is_numeric(struc[1])
-        assert is_valid_lat(struc[0])
-        assert is_valid_lon(struc[1])
-    else:
-        for sub in struc:
-            deep_validate_lat_lon(sub)
-    return True
-
 SIMPLEGEOHANDLE_RSTR=r"""SG_[A-Za-z0-9]{22}(?:_-?[0-9]{1,3}(?:\.[0-9]+)?_-?[0-9]{1,3}(?:\.[0-9]+)?)?(?:@[0-9]+)?$"""
 SIMPLEGEOHANDLE_R= re.compile(SIMPLEGEOHANDLE_RSTR)
 def is_simplegeohandle(s):
     return isinstance(s, basestring) and SIMPLEGEOHANDLE_R.match(s)
 
-FEATURES_URL_R=re.compile("http://(.*)/features/([A-Za-z_,-]*).json$")
+FEATURES_URL_R=re.compile("http://(.*)/features/([A-Za-z0-9_,.@-]*)\\.json$")
 
-def is_numeric(x):
-    return isinstance(x, (int, long, float, D))
+def handle_base(simplegeohandle):
+    """ Return the "SG_" plus 22 character part of the simplegeohandle,
+    without the optional lat/lon and version suffixes. """
+    return simplegeohandle[:25]
 
-def is_valid_lat(x):
-    return is_numeric(x) and (x <= 90) and (x >= -90)
+class Feature(object):
+    # (bbox, num_vertices) and the centroid of the coordinates,
+    # computed when first needed and forgotten when they are replaced.
+    _extent = None
+    _centroid = None
+    # A ResponseMetadata, if the Client which fetched this Feature
+    # keeps them.
+    response_metadata = None
 
-def is_valid_lon(x):
-    return is_numeric(x) and (x <= 180) and (x >= -180.0)
-
-class Feature:
-    def __init__(self, coordinates, geomtype='Point', simplegeohandle=None, properties=None):
+    def __init__(self, coordinates, geomtype='Point', simplegeohandle=None, properties=None, validate=True):
         """
         The simplegeohandle and the record_id are both optional -- you
         can have one or the other or both or neither.
@@ -99,50 +128,129 @@ class Feature:
         "Polygon", or "Multipolygon". coordinates is a GeoJSON
         coordinates *except* that each lat/lon pair is written in
         order lat, lon instead of the GeoJSON order of lon, at.
+        coordinates can also be a CompactCoordinates, which stores
+        the same thing in much less memory.
 
         When txsimplegeo.shared is constructing a Feature object from
-        the result of an HTTP query to the SimpleGeo service, it will
-        stash a reference to the twisted.web.client.Response object in
-        the "._http_response" member variable of the Feature
-        object. This could be useful for debugging, investigating the
-        performance of the SimpleGeo service, etc.
+        the result of an HTTP query to the SimpleGeo service, it can
+        stash a ResponseMetadata (the status, a few headers and how
+        long the response took) in the ".response_metadata" member
+        variable of the Feature object, and, when debugging, a
+        reference to the whole twisted.web.client.Response object in
+        "._http_response". See the response_metadata and debug
+        arguments of Client.
+
+        If validate is False then the coordinates are not checked for
+        being valid lats and lons. That check visits every vertex, so
+        skip it only for coordinates that have already been checked,
+        such as those that came from the SimpleGeo service.
+
+        .bbox, .centroid and .num_vertices summarize the coordinates.
+        They are worked out the first time they are read and kept
+        until .coordinates is assigned, so don't change the
+        coordinates in place. The bbox and the number of vertices come
+        for free with validation, so they are kept from then on.
         """
         precondition(simplegeohandle is None or is_simplegeohandle(simplegeohandle), "simplegeohandle is required to be None or to match the regex %s" % SIMPLEGEOHANDLE_RSTR, simplegeohandle=simplegeohandle)
         record_id = properties and properties.get('record_id') or None
         precondition(record_id is None or isinstance(record_id, basestring), "record_id is required to be None or a string.", record_id=record_id, properties=properties)
-        precondition(deep_validate_lat_lon(coordinates), coordinates)
+        if validate:
+            coordinates_extent = validated_extent(coordinates)
 
         self.id = simplegeohandle
         self.coordinates = coordinates
+        if validate:
+            self._extent = coordinates_extent
         self.geomtype = geomtype
-        self.properties = {}
+        self.properties = self._adopt_properties(properties)
+
+    def _adopt_properties(self, properties):
+        """ Return the dict to use as .properties: a copy of the one
+        given, so the caller's can't change under us. """
+        copied = {}
         if properties:
-            self.properties.update(properties)
+            copied.update(properties)
+        return copied
 
     @classmethod
-    def from_dict(cls, data):
+    def from_dict(cls, data, compact=False, validate=True):
         """
         data is a GeoJSON standard data structure, including that the
         coordinates are in GeoJSON order (lon, lat) instead of
         SimpleGeo order (lat, lon)
+
+        If compact is True then the Feature's coordinates are stored
+        in a CompactCoordinates, built straight from the GeoJSON
+        coordinates.
+
+        validate is as for the constructor.
         """
         assert isinstance(data, dict), (type(data), repr(data))
+        if compact:
+            coordinates = CompactCoordinates.from_nested(data['geometry']['coordinates'], swap=True)
+        else:
+            coordinates = deep_swap(data['geometry']['coordinates'])
         feature = cls(
             simplegeohandle = data.get('id'),
-            coordinates = deep_swap(data['geometry']['coordinates']),
+            coordinates = coordinates,
             geomtype = data['geometry']['type'],
-            properties = data.get('properties')
+            properties = data.get('properties'),
+            validate = validate
             )
+        if compact and feature._extent is None:
+            # Cheap for CompactCoordinates, so do it now.
+            feature._extent = extent(coordinates)
 
         return feature
 
+    def _get_coordinates(self):
+        return self._coordinates
+
+    def _set_coordinates(self, coordinates):
+        self._coordinates = coordinates
+        self._extent = None
+        self._centroid = None
+
+    coordinates = property(_get_coordinates, _set_coordinates)
+
+    def _get_extent(self):
+        if self._extent is None:
+            self._extent = extent(self.coordinates)
+        return self._extent
+
+    @property
+    def bbox(self):
+        """ The (minlat, minlon, maxlat, maxlon) of the coordinates, or
+        None if there are none. """
+        return self._get_extent()[0]
+
+    @property
+    def num_vertices(self):
+        return self._get_extent()[1]
+
+    @property
+    def centroid(self):
+        """ The mean (lat, lon) of the vertices, as floats, or None if
+        there are none. """
+        if self._centroid is None:
+            self._centroid = vertex_centroid(self.coordinates)
+        return self._centroid
+
+    def _geojson_bbox(self):
+        bbox = self.bbox
+        if bbox is None:
+            return None
+        (minlat, minlon, maxlat, maxlon) = bbox
+        return [minlon, minlat, maxlon, maxlat]
+
     def to_dict(self):
         """
         Returns a GeoJSON object, including having its coordinates in
         GeoJSON standad order (lon, lat) instead of SimpleGeo standard
-        order (lat, lon).
+        order (lat, lon). Its "bbox" member is [minlon, minlat, maxlon,
+        maxlat], also in GeoJSON order.
         """
-        return {
+        d = {
             'type': 'Feature',
             'id': self.id,
             'geometry': {
@@ -151,13 +259,397 @@ class Feature:
             },
             'properties': copy.deepcopy(self.properties),
         }
+        bbox = self._geojson_bbox()
+        if bbox is not None:
+            d['bbox'] = bbox
+        return d
 
     @classmethod
-    def from_json(cls, jsonstr):
-        return cls.from_dict(json_decode(jsonstr))
+    def from_json(cls, jsonstr, use_decimal=True, compact=False, validate=True):
+        return cls.from_dict(json_decode(jsonstr, use_decimal), compact, validate)
+
+    def iter_json(self):
+        """
+        Yield the GeoJSON text of this feature in pieces. Unlike
+        to_dict() this doesn't copy the properties or build a swapped
+        copy of the coordinates; everything is encoded straight from
+        this Feature, so don't change the Feature while iterating.
+        """
+        bbox = self._geojson_bbox()
+        if bbox is None:
+            yield '{"type":"Feature","id":%s,' % (json.dumps(self.id),)
+        else:
+            yield '{"type":"Feature","id":%s,"bbox":%s,' % (json.dumps(self.id), json.dumps(bbox, separators=(',', ':')))
+        yield '"geometry":{"type":%s,"coordinates":' % (json.dumps(self.geomtype),)
+        for chunk in iter_geojson_coordinates(self.coordinates):
+            yield chunk
+        yield '},"properties":%s}' % (json.dumps(self.properties, separators=(',', ':')),)
+
+    def write_json(self, fileobj):
+        """ Write the GeoJSON text of this feature to fileobj, which
+        need only have a write() method. """
+        for chunk in self.iter_json():
+            fileobj.write(chunk)
 
     def to_json(self):
-        return json.dumps(self.to_dict())
+        return ''.join(self.iter_json())
+
+class LazyFeature(Feature):
+    """
+    A Feature whose geometry is decoded only when it is first needed.
+
+    LazyFeature.from_json() decodes the id and properties of the
+    feature straight away but keeps the text of the geometry, and the
+    geometry is decoded, swapped into SimpleGeo order and validated
+    the first time .coordinates or .geomtype is read. Callers which
+    only look at the id or the properties never pay for decoding the
+    coordinates, which is most of the work for a large feature.
+
+    Since the geometry is decoded late, a malformed or invalid
+    geometry is reported late: reading .coordinates raises DecodeError
+    if the geometry isn't valid JSON, or AssertionError if it fails
+    validation, instead of from_json() raising it.
+    """
+    _raw_geometry = None
+
+    def __init__(self, coordinates=None, geomtype='Point', simplegeohandle=None, properties=None, validate=True, raw_geometry=None, use_decimal=True, compact=False):
+        """
+        If raw_geometry is None then this is the same as Feature.
+        Otherwise it is the JSON text of a GeoJSON geometry object,
+        coordinates and geomtype are ignored, and use_decimal, compact
+        and validate say how the geometry will be decoded, as for
+        Feature.from_json().
+        """
+        if raw_geometry is None:
+            Feature.__init__(self, coordinates, geomtype, simplegeohandle, properties, validate)
+            return
+        Feature.__init__(self, None, None, simplegeohandle, properties, validate=False)
+        self._raw_geometry = raw_geometry
+        self._use_decimal = use_decimal
+        self._compact = compact
+        self._validate = validate
+
+    def is_materialized(self):
+        """ Whether the geometry has been decoded yet. """
+        return self._raw_geometry is None
+
+    def _materialize(self):
+        geometry = json_decode(self._raw_geometry, self._use_decimal)
+        try:
+            (rawcoords, geomtype) = (geometry['coordinates'], geometry['type'])
+        except (KeyError, TypeError), le:
+            raise DecodeError(self._raw_geometry, le)
+        if self._compact:
+            coordinates = CompactCoordinates.from_nested(rawcoords, swap=True)
+        else:
+            coordinates = deep_swap(rawcoords)
+        if self._validate:
+            self._extent = validated_extent(coordinates)
+        self._coordinates = coordinates
+        self._geomtype = geomtype
+        self._raw_geometry = None
+
+    def _get_coordinates(self):
+        if self._raw_geometry is not None:
+            self._materialize()
+        return self._coordinates
+
+    def _set_coordinates(self, coordinates):
+        if self._raw_geometry is not None:
+            self._materialize()
+        self._coordinates = coordinates
+        self._extent = None
+        self._centroid = None
+
+    coordinates = property(_get_coordinates, _set_coordinates)
+
+    def _get_geomtype(self):
+        if self._raw_geometry is not None:
+            self._materialize()
+        return self._geomtype
+
+    def _set_geomtype(self, geomtype):
+        if self._raw_geometry is not None:
+            self._materialize()
+        self._geomtype = geomtype
+
+    geomtype = property(_get_geomtype, _set_geomtype)
+
+    def _get_extent(self):
+        # Materializing first lets a validated geometry keep the
+        # extent which validation found, instead of Feature reading
+        # .coordinates and computing it again.
+        if self._raw_geometry is not None:
+            self._materialize()
+        return Feature._get_extent(self)
+
+    def iter_json(self):
+        """ As for Feature, except that while the geometry hasn't been
+        decoded, its text is written out as it came instead, without
+        decoding it (and without a "bbox" member, which would need
+        it). """
+        if self._raw_geometry is None:
+            return Feature.iter_json(self)
+        return iter([
+            '{"type":"Feature","id":%s,"geometry":' % (json.dumps(self.id),),
+            self._raw_geometry,
+            ',"properties":%s}' % (json.dumps(self.properties, separators=(',', ':')),),
+            ])
+
+    @classmethod
+    def from_json(cls, jsonstr, use_decimal=True, compact=False, validate=True):
+        if use_decimal:
+            parse_float = D
+        else:
+            parse_float = float
+        try:
+            (data, raw_geometry) = decode_object_deferring(jsonstr, 'geometry', parse_float)
+        except (ValueError, TypeError), le:
+            raise DecodeError(jsonstr, le)
+        if raw_geometry is None:
+            # No geometry object to defer; this raises the same errors
+            # as Feature.from_dict() does.
+            return cls.from_dict(data, compact, validate)
+        assert isinstance(data, dict), (type(data), repr(data))
+        return cls(
+            simplegeohandle = data.get('id'),
+            properties = data.get('properties'),
+            validate = validate,
+            raw_geometry = raw_geometry,
+            use_decimal = use_decimal,
+            compact = compact
+            )
+
+class SlimFeature(Feature):
+    """
+    A Feature which takes much less memory, for holding very many of
+    them.
+
+    Its attributes live in __slots__ rather than in a per-instance
+    __dict__, and the properties dict passed to the constructor is
+    used as it is instead of being copied, so don't change it
+    afterwards. Otherwise it behaves just like a Feature (and is
+    one). Setting any other attribute on it, such as
+    .response_metadata, gives it a __dict__ after all.
+    """
+    __slots__ = ('id', '_coordinates', 'geomtype', 'properties', '_extent', '_centroid')
+
+    def _adopt_properties(self, properties):
+        if properties is None:
+            return {}
+        return properties
+
+class FeatureCollection(object):
+    """
+    Many features, stored column by column instead of as one object
+    per feature.
+
+    The simplegeohandles are kept in one character array, the
+    coordinates of every feature in one shared array('d') of lat/lon
+    pairs (as in CompactCoordinates) with their nesting and bounding
+    boxes in more arrays, and each feature's properties as a tuple of
+    values plus the index of its sorted tuple of keys, which all
+    features with the same keys share. Equal strings among the
+    property values, and equal tuples of values, are stored once.
+    A feature costs little more than its coordinates take as floats,
+    where a Feature with nested coordinate lists takes many times
+    that.
+
+    Features are taken in with append() or from_json(), and come back
+    out with collection[i] or by iterating, which builds a SlimFeature
+    with CompactCoordinates for each as it is reached. Those are new
+    objects every time, down to any lists and dicts among the property
+    values: changing one doesn't change the collection.
+    Coordinates are stored as floats, so Decimal coordinates lose any
+    precision beyond that of a float.
+    """
+    def __init__(self, features=()):
+        self._ids = array('c')
+        self._id_ends = array('l')
+        self._flat = array('d')
+        self._flat_ends = array('l')
+        self._nesting = array('l')
+        self._nesting_ends = array('l')
+        self._depths = array('b')
+        self._bboxes = array('d')
+        self._types = array('h')
+        self._type_names = []
+        self._type_index = {}
+        self._key_ids = array('l')
+        self._key_tuples = []
+        self._key_index = {}
+        self._values = []
+        self._nested = array('b')
+        self._shared = {}
+        for feature in features:
+            self.append(feature)
+
+    @classmethod
+    def from_json(cls, jsonstr, validate=True):
+        """
+        Build a collection from the text of a GeoJSON
+        FeatureCollection. Each feature is decoded and stored before
+        the next is looked at, so the decoded form of the whole
+        collection is never in memory at once. Raises DecodeError if
+        the text is malformed, and AssertionError if validate is True
+        and a feature's coordinates aren't valid lats and lons.
+        """
+        collection = cls()
+        features = iter_array_member(jsonstr, 'features', float)
+        while True:
+            try:
+                data = features.next()
+            except StopIteration:
+                break
+            except (ValueError, TypeError), le:
+                raise DecodeError(jsonstr, le)
+            collection.append(SlimFeature.from_dict(data, compact=True, validate=validate))
+        return collection
+
+    def __len__(self):
+        return len(self._id_ends)
+
+    def _span(self, ends, i):
+        if i:
+            return (ends[i-1], ends[i])
+        return (0, ends[0])
+
+    def append(self, feature):
+        """ Add a copy of the Feature (or SlimFeature, or any of
+        their subclasses) to the end of the collection. """
+        coordinates = feature.coordinates
+        precondition(coordinates is not None, "feature is required to have coordinates.", feature=feature)
+        if not isinstance(coordinates, CompactCoordinates):
+            coordinates = CompactCoordinates.from_nested(coordinates)
+
+        if feature.id is not None:
+            self._ids.fromstring(str(feature.id))
+        self._id_ends.append(len(self._ids))
+
+        self._flat.extend(coordinates.flat)
+        self._flat_ends.append(len(self._flat))
+        for level in range(1, coordinates.depth):
+            offs = coordinates.offsets[level]
+            self._nesting.append(len(offs))
+            self._nesting.extend(offs)
+        self._nesting_ends.append(len(self._nesting))
+        self._depths.append(coordinates.depth)
+        bbox = coordinates.bounding_box()
+        if bbox is None:
+            bbox = (float('nan'),) * 4
+        self._bboxes.extend(bbox)
+
+        typei = self._type_index.get(feature.geomtype)
+        if typei is None:
+            typei = self._type_index[feature.geomtype] = len(self._type_names)
+            self._type_names.append(feature.geomtype)
+        self._types.append(typei)
+
+        properties = feature.properties or {}
+        keys = tuple(sorted(properties))
+        keyi = self._key_index.get(keys)
+        if keyi is None:
+            keyi = self._key_index[keys] = len(self._key_tuples)
+            self._key_tuples.append(keys)
+        self._key_ids.append(keyi)
+        values = []
+        for k in keys:
+            v = properties[k]
+            if isinstance(v, basestring):
+                v = self._shared.setdefault((type(v), v), v)
+            values.append(v)
+        values = tuple(values)
+        try:
+            # Keyed by the types too, since 1 == True and 'a' == u'a'.
+            values = self._shared.setdefault((tuple(map(type, values)), values), values)
+            nested = False
+        except TypeError:
+            # It holds lists or dicts. They are copied in, and out again
+            # by __getitem__, so that changing them outside doesn't
+            # change the collection.
+            values = copy.deepcopy(values)
+            nested = True
+        self._values.append(values)
+        self._nested.append(nested)
+
+    def id(self, i):
+        """ The simplegeohandle of the i'th feature, or None. """
+        (start, end) = self._span(self._id_ends, i)
+        return self._ids[start:end].tostring() or None
+
+    def bbox(self, i):
+        """ The (minlat, minlon, maxlat, maxlon) of the i'th
+        feature, or None if it has no pairs. Doesn't build the
+        feature. """
+        bbox = tuple(self._bboxes[4*i:4*i+4])
+        if bbox[0] != bbox[0]:
+            # NaN: no pairs.
+            return None
+        return bbox
+
+    def ids(self):
+        """ Yield the simplegeohandle (or None) of each feature. """
+        for i in xrange(len(self)):
+            yield self.id(i)
+
+    def _coordinates(self, i):
+        depth = self._depths[i]
+        (start, end) = self._span(self._flat_ends, i)
+        pos = self._span(self._nesting_ends, i)[0]
+        offsets = [None]
+        for level in range(1, depth):
+            n = self._nesting[pos]
+            offsets.append(self._nesting[pos+1:pos+1+n])
+            pos += 1 + n
+        return CompactCoordinates(depth, self._flat[start:end], offsets)
+
+    def __getitem__(self, i):
+        """ Build and return a SlimFeature for the i'th feature. """
+        precondition(isinstance(i, (int, long)), "i is required to be an integer.", i=i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        values = self._values[i]
+        if self._nested[i]:
+            values = copy.deepcopy(values)
+        feature = SlimFeature(
+            simplegeohandle = self.id(i),
+            coordinates = self._coordinates(i),
+            geomtype = self._type_names[self._types[i]],
+            properties = dict(izip(self._key_tuples[self._key_ids[i]], values)),
+            validate = False
+            )
+        feature._extent = (self.bbox(i), feature.coordinates.num_vertices())
+        return feature
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def iter_json(self):
+        """ Yield the text of a GeoJSON FeatureCollection of these
+        features, in pieces, as iter_feature_collection_json() does. """
+        return iter_feature_collection_json(self)
+
+    def to_json(self):
+        return ''.join(self.iter_json())
+
+def iter_feature_collection_json(features):
+    """
+    Yield the text of a GeoJSON FeatureCollection of the Features
+    from the iterable features, in pieces. Features are taken from the
+    iterable one at a time as the text is consumed, so wrapping this
+    in a ChunkedProducer uploads any number of features in constant
+    memory.
+    """
+    yield '{"type":"FeatureCollection","features":['
+    for i, feature in enumerate(features):
+        if i:
+            yield ','
+        for chunk in feature.iter_json():
+            yield chunk
+    yield ']}'
 
 class StringProducer(object):
     implements(IBodyProducer)
@@ -180,6 +672,13 @@ class StringProducer(object):
     def stopProducing(self):
         pass
 
+def _is_response_done(reason):
+    """ Twisted calls connectionLost() with a Failure wrapping the
+    reason, but accept the bare exception too. """
+    if isinstance(reason, Failure):
+        return reason.check(ResponseDone) is not None
+    return isinstance(reason, ResponseDone)
+
 class BodyCollector(Protocol):
     """
     If you want to accumulate the body of an HTTP response until it is
@@ -203,7 +702,7 @@ class BodyCollector(Protocol):
     def connectionLost(self, reason):
         self.reason = reason
         self.bytes = ''.join(self.bytesl)
-        if isinstance(reason, ResponseDone):
+        if _is_response_done(reason):
             self.finished.callback(self)
         else:
             self.finished.errback(reason)
@@ -226,27 +725,314 @@ def get_body(resp):
     return d
 
 
+class FeatureCollector(Protocol):
+    """
+    Like BodyCollector, except that instead of accumulating the body
+    in memory it feeds each piece of the body to an incremental JSON
+    decoder as it arrives, and when the body is finished the deferred
+    returned from .start() fires with the Feature. This keeps the peak
+    memory used for a large feature close to the size of the decoded
+    feature instead of two or three times that.
+
+    use_decimal has the same meaning as for json_decode(), and compact
+    and validate as for Feature.from_dict().
+
+    If the body isn't valid JSON, the deferred errbacks with a
+    DecodeError.
+    """
+    def __init__(self, feature_class=None, use_decimal=True, compact=False, validate=True):
+        if feature_class is None:
+            feature_class = Feature
+        self.feature_class = feature_class
+        self.compact = compact
+        self.validate = validate
+        self.finished = Deferred()
+        if use_decimal:
+            self.decoder = IncrementalJSONDecoder()
+        else:
+            self.decoder = IncrementalJSONDecoder(parse_float=float)
+        self.decodeerror = None
+        self.bytes_received = 0
+
+    def start(self):
+        return self.finished
+
+    def dataReceived(self, bytes):
+        self.bytes_received += len(bytes)
+        if self.decodeerror is not None:
+            return
+        try:
+            self.decoder.feed(bytes)
+        except ValueError, le:
+            self.decodeerror = DecodeError(bytes, le)
+
+    def connectionLost(self, reason):
+        self.reason = reason
+        if not _is_response_done(reason):
+            self.finished.errback(reason)
+            return
+        if self.decodeerror is None:
+            try:
+                data = self.decoder.close()
+            except ValueError, le:
+                self.decodeerror = DecodeError(self.decoder.unparsed(), le)
+        self.decoder = None
+        if self.decodeerror is not None:
+            self.finished.errback(self.decodeerror)
+            return
+        d = maybeDeferred(self.feature_class.from_dict, data, self.compact, self.validate)
+        d.chainDeferred(self.finished)
+
+def get_feature_from_body(resp, feature_class=None, use_decimal=True, compact=False, validate=True):
+    """
+    Takes a Response object, returns a deferred that will eventually
+    fire with the Feature decoded from its body, decoding the body
+    incrementally as it arrives.
+    """
+    fc = FeatureCollector(feature_class, use_decimal, compact, validate)
+    resp.deliverBody(fc)
+    return fc.start()
+
+# The most idle keep-alive connections to api.simplegeo.com that a
+# Client will hold open, and how many seconds an idle connection is
+# kept before it is closed.
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 10
+DEFAULT_IDLE_TIMEOUT = 60
+
+# The most requests a Client will have outstanding at once. Further
+# requests wait in the Client's scheduler until a slot frees up.
+# Keeping this equal to the number of pooled connections lets a busy
+# Client reuse its persistent connections instead of opening more.
+DEFAULT_MAX_IN_FLIGHT = DEFAULT_MAX_CONNECTIONS_PER_HOST
+
+# How many simplegeohandles get_features() puts into one request.
+DEFAULT_FEATURES_CHUNK_SIZE = 100
+
+# How many features add_features() uploads in one request, and how
+# many of those requests it keeps outstanding at once.
+DEFAULT_ADD_FEATURES_BATCH_SIZE = 100
+DEFAULT_ADD_FEATURES_IN_FLIGHT = 4
 
 class Client(object):
     realm = "http://api.simplegeo.com"
     endpoints = {
         'feature': 'features/%(simplegeohandle)s.json',
+        'features': 'features/%(simplegeohandles)s.json',
+        'add_features': 'places.json',
     }
 
-    def __init__(self, key, secret, api_version=API_VERSION, host="api.simplegeo.com", port=80):
+    def __init__(self, key, secret, api_version=API_VERSION, host="api.simplegeo.com", port=80, pool=None, max_connections_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST, idle_timeout=DEFAULT_IDLE_TIMEOUT, features_chunk_size=DEFAULT_FEATURES_CHUNK_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, cache=None, streaming_decode=False, use_decimal=True, compact_coordinates=False, validate_features=True, lazy_geometry=False, sign_in_thread=False, offloader=None, offload_threshold=DEFAULT_OFFLOAD_THRESHOLD, instrumentation=None, retry_policy=None, rate_limit=None, rate_burst=None, circuit_breaker=None, serve_stale=False, response_metadata=False, debug=False):
+        """
+        Requests are sent over persistent (keep-alive) HTTP
+        connections. If you pass a CountingHTTPConnectionPool as
+        "pool" then it will be used (and it can be shared between
+        several Clients), otherwise the Client makes its own pool
+        which keeps at most max_connections_per_host idle connections
+        open per host and closes each one after it has been idle for
+        idle_timeout seconds. Call close() on shutdown to drain the
+        pool.
+
+        At most max_in_flight requests are outstanding at once (None
+        means no limit); the rest wait their turn in self.scheduler,
+        a RequestScheduler, whose queue_depth and wait times can be
+        read for monitoring.
+
+        If cache is a FeatureCache then get_feature() looks there
+        first. It is None (no caching) by default.
+
+        If streaming_decode is True then get_feature() decodes each
+        response body incrementally as it arrives (see
+        FeatureCollector) rather than collecting the whole body first.
+
+        use_decimal is the default for the use_decimal argument of
+        get_feature() and get_features(), which is passed on to
+        json_decode(). Set it to False to decode coordinates as floats,
+        which is much faster for large features.
+
+        If compact_coordinates is True then the Features returned
+        from get_feature() and get_features() store their coordinates
+        in CompactCoordinates, which take a small fraction of the
+        memory of nested lists. Use this when keeping many large
+        features resident, e.g. in a cache.
+
+        If validate_features is False then the coordinates of features
+        received from the server are trusted and not re-validated.
+
+        If lazy_geometry is True then get_feature() returns
+        LazyFeatures, whose geometry isn't decoded until it is first
+        read. This is much cheaper for callers which only use the
+        properties. It takes precedence over streaming_decode.
+
+        Every request is signed with OAuth using key and secret. If
+        sign_in_thread is True then the signature is computed in the
+        reactor's thread pool rather than in the reactor thread, which
+        helps at very high request rates.
+
+        If offloader is a ThreadOffloader or a ProcessOffloader then
+        response bodies of at least offload_threshold bytes are decoded
+        (and, for get_feature(), turned into Features) by it instead of
+        in the reactor thread, so that decoding a large geometry
+        doesn't stall every other connection. Smaller bodies, and
+        bodies read with streaming_decode or lazy_geometry, are still
+        decoded inline. The offloader's pending count and wait times
+        show how far behind its workers are.
+
+        instrumentation is told how long each stage of each request
+        took (see RequestTiming); pass a HistogramInstrumentation to
+        aggregate those timings, or anything else which provides
+        IInstrumentation. By default nothing is recorded.
+
+        If retry_policy is a RetryPolicy then requests which fail with
+        a connection error or a status such as 503 or 429 are sent
+        again after a backoff, and slow GETs can be hedged with a
+        duplicate request; see RetryPolicy. Requests whose bodies are
+        streamed from an IBodyProducer (such as those of
+        add_features()) are never sent twice. By default nothing is
+        retried.
+
+        If rate_limit is given then requests are sent at most
+        rate_limit per second on average, in bursts of at most
+        rate_burst, by a TokenBucket which is shared with every other
+        Client in this process that has the same key (the first such
+        Client's settings are used). The rate is lowered when the
+        server's X-RateLimit-Remaining and X-RateLimit-Reset headers
+        say the quota is running out, and a 429 response's Retry-After
+        holds back every Client with the key. The limiter is
+        self.rate_limiter. Requests waiting for it keep their slot in
+        the scheduler.
+
+        If circuit_breaker is given then each endpoint in
+        self.endpoints gets its own CircuitBreaker, made by calling
+        circuit_breaker() (so pass CircuitBreaker itself, or a function
+        which makes one with other settings). While an endpoint's
+        breaker is open, requests to it fail at once with
+        CircuitOpenError; connection errors and 5xx statuses count as
+        failures. If serve_stale is True and this Client has a cache,
+        then get_feature() returns a stale cached Feature, if there is
+        one, instead of failing. circuit_states() tells how each
+        endpoint's breaker stands.
+
+        If response_metadata is True then each Feature fetched from
+        the server gets a .response_metadata: a ResponseMetadata with
+        the response's status, the headers named in
+        self.metadata_headers and its timings, small enough to keep on
+        every cached Feature. If debug is True then each Feature also
+        gets the whole twisted.web.client.Response as
+        ._http_response, which keeps the response and its connection
+        objects alive for as long as the Feature; don't use it with a
+        large cache. By default neither is kept.
+        """
         self.host = host
         self.port = port
         self.key = key
         self.secret = secret
         self.api_version = api_version
         self.uri = "http://%s:%s" % (host, port)
-        self.agent = Agent(reactor)
+        if pool is None:
+            pool = CountingHTTPConnectionPool(reactor)
+            pool.maxPersistentPerHost = max_connections_per_host
+            pool.cachedConnectionTimeout = idle_timeout
+        self.pool = pool
+        self.agent = Agent(reactor, pool=pool)
+        self.clock = reactor
+        self.signer = oauth.Signer(key, secret, self.realm)
+        self.nonces = oauth.NoncePool()
+        self.sign_in_thread = sign_in_thread
+        self.features_chunk_size = features_chunk_size
+        self.scheduler = RequestScheduler(max_in_flight, clock=reactor)
+        self.cache = cache
+        self.streaming_decode = streaming_decode
+        self.use_decimal = use_decimal
+        self.compact_coordinates = compact_coordinates
+        self.validate_features = validate_features
+        self.lazy_geometry = lazy_geometry
+        self.user_agent = 'SimpleGeo Places Client v%s' % (__version__,)
+        self.offloader = offloader
+        self.offload_threshold = offload_threshold
+        if instrumentation is None:
+            instrumentation = NullInstrumentation()
+        self.instrumentation = instrumentation
+        self.retry_policy = retry_policy
+        if rate_limit is None:
+            self.rate_limiter = None
+        else:
+            self.rate_limiter = shared_limiter(key, rate_limit, rate_burst)
+        if circuit_breaker is None:
+            self.circuits = {}
+        else:
+            self.circuits = dict([(name, circuit_breaker()) for name in self.endpoints])
+        self.serve_stale = serve_stale
+        self.response_metadata = response_metadata
+        self.metadata_headers = DEFAULT_METADATA_HEADERS
+        self.debug = debug
+        self.headers = None
+        self._inflight = {} # simplegeohandle -> list of waiting deferreds
+
+    @property
+    def pool_hits(self):
+        """ The number of requests which were sent over an
+        already-open connection from the pool. """
+        return self.pool.hits
+
+    @property
+    def pool_misses(self):
+        """ The number of requests which had to open a new
+        connection. """
+        return self.pool.misses
+
+    def close(self):
+        """
+        Close all idle persistent connections held by this Client's
+        pool. Returns a deferred which fires when they are all closed.
+        """
+        return self.pool.closeCachedConnections()
+
+    def circuit_states(self):
+        """ Return a dict mapping each endpoint name which has a
+        circuit breaker to its state: 'closed', 'open' or
+        'half-open'. """
+        return dict([(name, breaker.state) for (name, breaker) in self.circuits.iteritems()])
 
     def get_most_recent_http_headers(self):
         """ Intended for debugging -- return the most recent HTTP
         headers which were received from the server. """
         return self.headers
 
+    def _new_timing(self, name, method, url):
+        return RequestTiming(name, method, url, self.clock.seconds())
+
+    def _timed(self, timing, phase, f, *args, **kwargs):
+        """ Call f, adding the seconds it took to the given phase of
+        timing. """
+        start = self.clock.seconds()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            setattr(timing, phase, (getattr(timing, phase) or 0) + self.clock.seconds() - start)
+
+    def _body_received(self, body, timing):
+        timing.body_done_at = self.clock.seconds()
+        timing.bytes_received = len(body)
+        return body
+
+    def _finish_timing(self, res, timing):
+        try:
+            self.instrumentation.request_finished(timing)
+        except Exception:
+            log.err(None, "instrumentation failed")
+        return res
+
+    def _annotate(self, features, resp, timing):
+        """ Attach to each of the features what this Client keeps of
+        the response they came from. """
+        if self.response_metadata:
+            metadata = ResponseMetadata.from_response(resp, timing, self.metadata_headers)
+            for f in features:
+                f.response_metadata = metadata
+        if self.debug:
+            for f in features:
+                f._http_response = resp
+
     def _endpoint(self, name, **kwargs):
         """Not used directly. Finds and formats the endpoints as needed for any type of request."""
         try:
@@ -259,7 +1045,7 @@ class Client(object):
             raise TypeError('Missing required argument "%s"' % (e.args[0],))
         return urljoin(urljoin(self.uri, self.api_version + '/'), endpoint)
 
-    def get_feature(self, simplegeohandle):
+    def get_feature(self, simplegeohandle, priority=DEFAULT_PRIORITY, use_decimal=None):
         """
         Return the GeoJSON representation of a feature.
 
@@ -267,61 +1053,670 @@ class Client(object):
         fires with the Feature object. If the request fails, the
         deferred instead errbacks with the twisted.web.client.Response
         object.
+
+        If this Client has a cache then a fresh cached Feature is
+        returned without any request, and concurrent calls for the
+        same handle share a single request. (A cached Feature is
+        returned whichever use_decimal it was decoded with.)
+
+        use_decimal has the same meaning as for json_decode(); if it is
+        None then self.use_decimal is used.
+
+        If the endpoint's circuit breaker is open, the deferred
+        errbacks with CircuitOpenError, or fires with a stale cached
+        Feature if self.serve_stale is True and there is one.
         """
         precondition(is_simplegeohandle(simplegeohandle), "simplegeohandle is required to match the regex %s" % SIMPLEGEOHANDLE_RSTR, simplegeohandle=simplegeohandle)
+        if self.cache is None:
+            d = self._fetch_feature(simplegeohandle, priority, use_decimal)
+            d.addCallback(lambda res: res[0])
+            return d
+
+        f = self.cache.get(simplegeohandle)
+        if f is not None:
+            return succeed(f)
+
+        waiters = self._inflight.get(simplegeohandle)
+        if waiters is not None:
+            d = Deferred()
+            waiters.append(d)
+            return d
+
+        # If there is a stale entry then revalidate it with a
+        # conditional request instead of downloading it again.
+        stale = self.cache.get_entry(simplegeohandle)
+        waiters = self._inflight[simplegeohandle] = []
+        d = self._fetch_feature(simplegeohandle, priority, use_decimal, stale)
+        def _fetched(res):
+            if isinstance(res, Failure) and res.check(CircuitOpenError) and stale is not None and self.serve_stale:
+                # Serve it as it is, without caching it afresh.
+                res = stale.feature
+            elif not isinstance(res, Failure):
+                (f, resp) = res
+                # If the handle was invalidated while we were fetching
+                # it then don't cache the result.
+                if self._inflight.get(simplegeohandle) is waiters:
+                    etag = _last_header(resp.headers, 'etag')
+                    last_modified = _last_header(resp.headers, 'last-modified')
+                    if resp.code == 304:
+                        etag = etag or stale.etag
+                        last_modified = last_modified or stale.last_modified
+                    self.cache.put(simplegeohandle, f, etag, last_modified)
+                res = f
+            if self._inflight.get(simplegeohandle) is waiters:
+                del self._inflight[simplegeohandle]
+            for waiter in waiters:
+                if isinstance(res, Failure):
+                    waiter.errback(res)
+                else:
+                    waiter.callback(res)
+            return res
+        d.addBoth(_fetched)
+        return d
+
+    def invalidate(self, simplegeohandle):
+        """ Drop the cached Feature for this handle, if any, so that
+        the next get_feature() for it goes to the server. """
+        self._inflight.pop(simplegeohandle, None)
+        if self.cache is not None:
+            self.cache.invalidate(simplegeohandle)
+
+    def _fetch_feature(self, simplegeohandle, priority, use_decimal, stale=None):
+        """
+        Returns a deferred which fires with a tuple of (Feature,
+        twisted.web.client.Response).
+
+        If stale is a CacheEntry then the request is made conditional
+        on its validators, and if the server answers 304 Not Modified
+        the Feature from stale is reused without reading or parsing
+        any body.
+        """
+        if use_decimal is None:
+            use_decimal = self.use_decimal
         endpoint = self._endpoint('feature', simplegeohandle=simplegeohandle)
-        d = self._request(endpoint, 'GET')
+        headers = Headers()
+        if stale is not None:
+            if stale.etag is not None:
+                headers.setRawHeaders('If-None-Match', [stale.etag])
+            if stale.last_modified is not None:
+                headers.setRawHeaders('If-Modified-Since', [stale.last_modified])
+        timing = self._new_timing('feature', 'GET', endpoint)
+        d = self._request(endpoint, 'GET', headers=headers, priority=priority, timing=timing)
         def _handle_resp(resp):
+            if resp.code == 304 and stale is not None:
+                return (stale.feature, resp)
+
             if (resp.code / 100) not in (2, 3):
-                return Failure(resp)
+                return _fail_with(resp)
+
+            if self.lazy_geometry:
+                d2 = get_body(resp)
+                d2.addCallback(self._body_received, timing)
+                d2.addCallback(lambda body: self._timed(timing, 'decode', LazyFeature.from_json, body, use_decimal, **self._feature_options()))
+            elif self.streaming_decode:
+                # The body is decoded as it arrives, so its download
+                # and decoding times can't be told apart.
+                fc = FeatureCollector(None, use_decimal, **self._feature_options())
+                resp.deliverBody(fc)
+                d2 = fc.start()
+                def _streamed(f):
+                    timing.body_done_at = self.clock.seconds()
+                    timing.bytes_received = fc.bytes_received
+                    return f
+                d2.addCallback(_streamed)
+            else:
+                d2 = get_body(resp)
+                d2.addCallback(self._body_received, timing)
+                d2.addCallback(self._decode_feature, use_decimal, timing)
+            def _handle_feature(f):
+                self._annotate([f], resp, timing)
+                return (f, resp)
+
+            d2.addCallback(_handle_feature)
+            return d2
+        d.addCallback(_handle_resp)
+        d.addBoth(self._finish_timing, timing)
+        return d
+
+    def _should_offload(self, body):
+        return self.offloader is not None and len(body) >= self.offload_threshold
+
+    def _decode_feature(self, body, use_decimal, timing):
+        opts = self._feature_options()
+        if self._should_offload(body):
+            # Decoding and construction both happen in the worker, so
+            # they are counted together as decoding.
+            start = self.clock.seconds()
+            d = self.offloader.run(_decode_feature, body, use_decimal, opts['compact'], opts['validate'])
+            def _done(res):
+                timing.decode = self.clock.seconds() - start
+                return res
+            d.addBoth(_done)
+            return d
+        data = self._timed(timing, 'decode', json_decode, body, use_decimal)
+        return self._timed(timing, 'construct', Feature.from_dict, data, **opts)
+
+    def _feature_options(self):
+        """ The keyword arguments for Feature.from_dict() with which
+        features received from the server are built. """
+        return { 'compact': self.compact_coordinates, 'validate': self.validate_features }
+
+    def get_features(self, simplegeohandles, chunk_size=None, priority=DEFAULT_PRIORITY, use_decimal=None):
+        """
+        Return the GeoJSON representations of many features, using as
+        few round trips as possible.
+
+        The handles are split into chunks of at most chunk_size
+        (default: self.features_chunk_size) handles and each chunk is
+        fetched with one request to the comma-separated form of the
+        features endpoint.
+
+        Return a deferred which fires with a dict mapping each
+        simplegeohandle to either its Feature object or a Failure. If
+        the request for a handle's chunk failed, its Failure wraps the
+        twisted.web.client.Response object (or the connection error),
+        just as for get_feature(). If the response didn't include the
+        handle, its Failure wraps an APIError with code 404.
+
+        use_decimal is as for get_feature().
+        """
+        if chunk_size is None:
+            chunk_size = self.features_chunk_size
+        if use_decimal is None:
+            use_decimal = self.use_decimal
+        precondition(isinstance(chunk_size, (int, long)) and chunk_size > 0, "chunk_size is required to be a positive integer.", chunk_size=chunk_size)
+
+        handles = []
+        seen = set()
+        for simplegeohandle in simplegeohandles:
+            precondition(is_simplegeohandle(simplegeohandle), "simplegeohandle is required to match the regex %s" % SIMPLEGEOHANDLE_RSTR, simplegeohandle=simplegeohandle)
+            if simplegeohandle not in seen:
+                seen.add(simplegeohandle)
+                handles.append(simplegeohandle)
+
+        results = {}
+        ds = []
+        for i in range(0, len(handles), chunk_size):
+            d = self._get_features_chunk(handles[i:i+chunk_size], priority, use_decimal)
+            d.addCallback(results.update)
+            ds.append(d)
+
+        d = gatherResults(ds)
+        d.addCallback(lambda ign: results)
+        return d
+
+    def _get_features_chunk(self, simplegeohandles, priority, use_decimal):
+        """ Returns a deferred which never errbacks, instead firing
+        with a dict of handle -> Feature-or-Failure for each of the
+        handles. """
+        endpoint = self._endpoint('features', simplegeohandles=','.join(simplegeohandles))
+        timing = self._new_timing('features', 'GET', endpoint)
+        d = self._request(endpoint, 'GET', priority=priority, timing=timing)
+        def _handle_resp(resp):
+            if (resp.code / 100) not in (2, 3):
+                return _fail_with(resp)
 
             d2 = get_body(resp)
+            d2.addCallback(self._body_received, timing)
             def _handle_body(body):
-                f = Feature.from_json(body)
-                f._http_response = resp
-                return f
-
+                if self._should_offload(body):
+                    start = self.clock.seconds()
+                    d3 = self.offloader.run(json_decode, body, use_decimal)
+                    def _done(res):
+                        timing.decode = self.clock.seconds() - start
+                        return res
+                    d3.addBoth(_done)
+                    return d3
+                return self._timed(timing, 'decode', json_decode, body, use_decimal)
             d2.addCallback(_handle_body)
+            def _handle_data(data):
+                results = self._timed(timing, 'construct', _match_features, simplegeohandles, data, resp, **self._feature_options())
+                self._annotate([f for f in results.itervalues() if not isinstance(f, Failure)], resp, timing)
+                return results
+            d2.addCallback(_handle_data)
+            return d2
+        d.addCallback(_handle_resp)
+        d.addBoth(self._finish_timing, timing)
+        def _handle_failure(f):
+            return dict([(simplegeohandle, f) for simplegeohandle in simplegeohandles])
+        d.addErrback(_handle_failure)
+        return d
+
+    def add_features(self, features, on_result=None, batch_size=DEFAULT_ADD_FEATURES_BATCH_SIZE, max_batches_in_flight=DEFAULT_ADD_FEATURES_IN_FLIGHT, priority=DEFAULT_PRIORITY):
+        """
+        Add many features to the Places database.
+
+        features is any iterable of Features, such as a generator
+        reading them from a file. Features are pulled from it only as
+        fast as they are uploaded: at most max_batches_in_flight
+        requests, each of at most batch_size features, are outstanding
+        at once, and each request body is serialized as it is sent.
+
+        If on_result is given, then it is called once for each feature
+        as on_result(feature, result). If the feature was added, or a
+        feature with the same record_id already existed, then result
+        is its simplegeohandle. Otherwise it is a Failure, which wraps
+        an APIError or the twisted.web.client.Response of the failed
+        request.
+
+        Return a deferred which fires, once every feature has been
+        dealt with, with a dict { 'added': number of features added,
+        'failed': number of features which weren't }. If iterating
+        features or calling on_result raises an exception, no more
+        batches are started and the deferred errbacks with it once the
+        outstanding batches have finished.
+        """
+        precondition(isinstance(batch_size, (int, long)) and batch_size > 0, "batch_size is required to be a positive integer.", batch_size=batch_size)
+        precondition(isinstance(max_batches_in_flight, (int, long)) and max_batches_in_flight > 0, "max_batches_in_flight is required to be a positive integer.", max_batches_in_flight=max_batches_in_flight)
+        return _FeatureAdder(self, features, on_result, batch_size, max_batches_in_flight, priority).start()
+
+    def _add_features_batch(self, features, priority):
+        """ Returns a deferred which never errbacks, instead firing
+        with a list of the simplegeohandle or a Failure for each of
+        the features. """
+        endpoint = self._endpoint('add_features')
+        body = ChunkedProducer(iter_feature_collection_json(features))
+        headers = Headers({'Content-Type': ['application/json']})
+        timing = self._new_timing('add_features', 'POST', endpoint)
+        d = self._request(endpoint, 'POST', body, headers=headers, priority=priority, timing=timing)
+        def _handle_resp(resp):
+            if (resp.code / 100) not in (2, 3):
+                return _fail_with(resp)
+
+            d2 = get_body(resp)
+            d2.addCallback(self._body_received, timing)
+            d2.addCallback(lambda body: self._timed(timing, 'decode', json_decode, body))
+            d2.addCallback(lambda data: _match_added(features, data, resp))
             return d2
         d.addCallback(_handle_resp)
+        d.addBoth(self._finish_timing, timing)
+        d.addErrback(lambda f: [f] * len(features))
         return d
 
-    def _request(self, endpoint, method, data=None):
+    def _request(self, endpoint, method, data=None, headers=None, priority=DEFAULT_PRIORITY, timing=None):
         """
         Not used directly by code external to this lib. Performs the
         actual request against the API, including passing the
         credentials with oauth.  Returns deferred that eventually
         fires with a twisted.web.client.Response instance.
+
+        data is the request body: None, a string, or an IBodyProducer
+        such as a ChunkedProducer for a body too big to hold in memory.
+
+        The request is not sent until self.scheduler has a free slot
+        (requests with a lower priority number go first), and it
+        holds that slot until the response headers have arrived. It is
+        signed just before it is sent, so that its timestamp is
+        current.
+
+        If timing is a RequestTiming then its stages up to the arrival
+        of the response headers are filled in, and the caller is
+        responsible for passing it to self.instrumentation. Otherwise
+        a RequestTiming is made here and reported when the response
+        headers arrive.
+
+        If self.retry_policy says so then the request is retried, and
+        the deferred fires with the response to the last attempt.
         """
-        if data is None:
-            data = ''
-        elif not isinstance(data, basestring):
-            raise TypeError("data is required to be None or a string or unicode, not %s" % (type(data),))
+        replayable = not IBodyProducer.providedBy(data)
+        if not replayable:
+            body = data
+        else:
+            if data is None:
+                data = ''
+            elif not isinstance(data, basestring):
+                raise TypeError("data is required to be None or a string or unicode or an IBodyProducer, not %s" % (type(data),))
+            body = StringProducer(data)
+
+        if headers is None:
+            headers = Headers()
+        report = timing is None
+        if report:
+            timing = self._new_timing(None, method, endpoint)
+        breaker = self.circuits.get(timing.name)
+        token = breaker is not None and breaker.allow()
+        if breaker is not None and not token:
+            d = fail(CircuitOpenError(timing.name))
+        else:
+            policy = self.retry_policy
+            if policy is not None and replayable and method in policy.methods:
+                d = _RetryingRequest(self, policy, endpoint, method, headers, body, priority, timing).start()
+            else:
+                d = self._attempt(endpoint, method, headers, body, priority, timing)
+            if breaker is not None:
+                d.addBoth(_record_outcome, breaker, token)
+        if report:
+            d.addBoth(self._finish_timing, timing)
+        return d
+
+    def _attempt(self, endpoint, method, headers, body, priority, timing):
+        """ Send the request once, through the scheduler. """
+        d = self.scheduler.schedule(priority, self._send, endpoint, method, headers, body, timing)
+        def _got_response(resp):
+            timing.response_at = self.clock.seconds()
+            timing.code = resp.code
+            self.headers = resp.headers
+            if self.rate_limiter is not None:
+                self.rate_limiter.update_from_response(resp)
+            return resp
+        d.addCallback(_got_response)
+        return d
+
+    def _send(self, endpoint, method, headers, body, timing):
+        if self.rate_limiter is None:
+            return self._sign_and_send(endpoint, method, headers, body, timing)
+        d = self.rate_limiter.acquire()
+        d.addCallback(lambda ign: self._sign_and_send(endpoint, method, headers, body, timing))
+        return d
+
+    def _sign_and_send(self, endpoint, method, headers, body, timing):
+        # The nonce and timestamp are taken here, in the reactor
+        # thread, so that only the HMAC might be computed elsewhere.
+        (url, params) = oauth.normalize_url(endpoint)
+        params['oauth_nonce'] = self.nonces.next()
+        params['oauth_timestamp'] = str(int(self.clock.seconds()))
+        params['oauth_version'] = '1.0'
+
+        if self.sign_in_thread:
+            d = threads.deferToThread(self.signer.sign_request, method, url, params)
+        else:
+            d = succeed(self.signer.sign_request(method, url, params))
+        def _signed(auth_header):
+            headers.setRawHeaders('Authorization', [auth_header])
+            headers.setRawHeaders('User-Agent', [self.user_agent])
+            timing.sent_at = self.clock.seconds()
+            if isinstance(self.pool, CountingHTTPConnectionPool):
+                self.pool.connection_observer = timing._connected(self.clock)
+            try:
+                return self.agent.request(method, endpoint, headers=headers, bodyProducer=body)
+            finally:
+                if isinstance(self.pool, CountingHTTPConnectionPool):
+                    self.pool.connection_observer = None
+        d.addCallback(_signed)
+        return d
+
+
+def _decode_feature(body, use_decimal, compact, validate):
+    """ The work that Client hands to its offloader for a large
+    feature; defined at module level so that it can be pickled. """
+    return Feature.from_json(body, use_decimal, compact, validate)
+
+def _last_header(headers, name):
+    """ Return the last value of the named header in the
+    twisted.web.http_headers.Headers, or None if it is absent. """
+    values = headers.getRawHeaders(name)
+    if not values:
+        return None
+    return values[-1]
+
+def _match_features(simplegeohandles, data, resp, compact=False, validate=True):
+    """
+    data is a decoded GeoJSON FeatureCollection (or a lone Feature)
+    returned for a request for the given simplegeohandles. Returns a
+    dict mapping each of the simplegeohandles to its Feature, or to a
+    Failure if the Feature was missing or malformed. The server might
+    return the short form of a handle that was requested in its long
+    form, or vice versa, so handles are also matched by handle_base().
+    """
+    if data.get('type') == 'FeatureCollection':
+        featuredicts = data.get('features') or []
+    else:
+        featuredicts = [data]
 
-        body = StringProducer(data)
+    byid = {}
+    for featuredict in featuredicts:
+        try:
+            f = Feature.from_dict(featuredict, compact, validate)
+        except Exception:
+            f = Failure()
+        fid = isinstance(featuredict, dict) and featuredict.get('id')
+        if is_simplegeohandle(fid):
+            byid[fid] = f
+            byid.setdefault(handle_base(fid), f)
+
+    results = {}
+    for simplegeohandle in simplegeohandles:
+        f = byid.get(simplegeohandle) or byid.get(handle_base(simplegeohandle))
+        if f is None:
+            f = Failure(APIError(404, "The server did not return this feature.", resp.headers, simplegeohandle))
+        results[simplegeohandle] = f
+    return results
+
+def _match_added(features, data, resp):
+    """
+    data is the decoded response to a request to add the given
+    features. Returns a list of the simplegeohandle, or a Failure, for
+    each of the features.
+
+    The format of this response is an assumption: data is expected to
+    be an object whose "features" member (or else data itself) is a
+    list with one result per submitted feature, in the order they were
+    submitted. The result for a feature which was added, or which
+    already existed with the same record_id, is an object whose "id"
+    is the feature's simplegeohandle. Any other result is an error,
+    whose "code" and "message" members, if any, are passed on in an
+    APIError.
+    """
+    if isinstance(data, dict):
+        data = data.get('features')
+    if not isinstance(data, list) or len(data) != len(features):
+        f = Failure(APIError(resp.code, "The server did not return one result per feature.", resp.headers))
+        return [f] * len(features)
+
+    results = []
+    for result in data:
+        fid = isinstance(result, dict) and result.get('id')
+        if is_simplegeohandle(fid):
+            results.append(fid)
+        else:
+            if isinstance(result, dict):
+                (code, msg) = (result.get('code'), result.get('message', "The feature was not added."))
+            else:
+                (code, msg) = (None, "The feature was not added.")
+            results.append(Failure(APIError(code, msg, resp.headers, repr(result))))
+    return results
+
+class _FeatureAdder(object):
+    """
+    The state of one Client.add_features() call: pulls batches of
+    features from the iterator, keeping up to max_batches_in_flight
+    batches uploading at once, and tallies the results.
+    """
+    def __init__(self, client, features, on_result, batch_size, max_batches_in_flight, priority):
+        self.client = client
+        self.features = iter(features)
+        self.on_result = on_result
+        self.batch_size = batch_size
+        self.max_batches_in_flight = max_batches_in_flight
+        self.priority = priority
+        self.in_flight = 0
+        self.exhausted = False
+        self.failure = None
+        self.counts = { 'added': 0, 'failed': 0 }
+        self.finished = Deferred()
+        self._starting = False
 
-# xyZ
-#         # headers = request.to_header(self.realm)
-#         headers = {}
-#XXX         headers['User-Agent'] = 'SimpleGeo Places Client v%s' % __version__
+    def start(self):
+        self._start_batches()
+        return self.finished
 
-        d = self.agent.request(method, endpoint, bodyProducer=body)
+    def _start_batches(self):
+        # A batch which completes synchronously calls back in here;
+        # the loop that is already running will pick up the free slot.
+        if self._starting:
+            return
+        self._starting = True
+        try:
+            while not self.exhausted and self.in_flight < self.max_batches_in_flight:
+                try:
+                    batch = list(islice(self.features, self.batch_size))
+                except Exception:
+                    self._stop(Failure())
+                    break
+                if not batch:
+                    self.exhausted = True
+                    break
+                self.in_flight += 1
+                d = self.client._add_features_batch(batch, self.priority)
+                d.addCallback(self._batch_done, batch)
+        finally:
+            self._starting = False
+        if self.exhausted and self.in_flight == 0 and not self.finished.called:
+            if self.failure is not None:
+                self.finished.errback(self.failure)
+            else:
+                self.finished.callback(self.counts)
+
+    def _stop(self, failure):
+        self.exhausted = True
+        if self.failure is None:
+            self.failure = failure
+
+    def _batch_done(self, results, batch):
+        self.in_flight -= 1
+        for (feature, result) in zip(batch, results):
+            if isinstance(result, Failure):
+                self.counts['failed'] += 1
+            else:
+                self.counts['added'] += 1
+            if self.on_result is not None and self.failure is None:
+                try:
+                    self.on_result(feature, result)
+                except Exception:
+                    self._stop(Failure())
+        self._start_batches()
+
+def _record_outcome(result, breaker, token):
+    """ Tell the CircuitBreaker how the request which allow() gave
+    token to went. """
+    if isinstance(result, Failure):
+        if result.check(CancelledError):
+            breaker.record_ignored(token)
+        else:
+            breaker.record_failure(token)
+    elif result.code >= 500:
+        breaker.record_failure(token)
+    else:
+        breaker.record_success(token)
+    return result
+
+def _discard(result):
+    """ Read and throw away the body of a response which won't be
+    used, so that its connection can go back to the pool. """
+    if not isinstance(result, Failure):
+        get_body(result).addErrback(lambda f: None)
+
+def _fail_with(resp):
+    """ Return a deferred which fails with the error response once
+    its body has been read and thrown away, so that its connection
+    can go back to the pool. """
+    d = get_body(resp)
+    d.addBoth(lambda ign: Failure(resp))
+    return d
 
-        # def _callb(resp):
-        #     self.headers = resp.header
-        #     if (resp.code / 100) not in ('2', '3'):
-        #         raise APIError(int(self.headers['status']), content, self.headers)
-# 
-#             self.k
-#             self.headers, content = self.http.request(endpoint, method, body=body, headers=headers)
+class _RetryingRequest(object):
+    """
+    Sends a request for Client._request, again and again as
+    policy.retry_delay() says, and once more at the same time if
+    policy.hedge_delay() says that the first attempt is too slow.
+    start() returns a deferred which fires with the response that was
+    used (or the Failure of the last attempt). Every attempt is signed
+    afresh and goes through the Client's scheduler.
+    """
+    def __init__(self, client, policy, endpoint, method, headers, body, priority, timing):
+        self.client = client
+        self.clock = client.clock
+        self.policy = policy
+        self.endpoint = endpoint
+        self.method = method
+        self.headers = headers
+        self.body = body
+        self.priority = priority
+        self.timing = timing
+        self.retries = 0
+        self.hedged = False
+        self.finished = False
+        self.attempts = [] # (deferred, RequestTiming) for each outstanding attempt
+        self.delayed = None # the pending retry or hedge
+        self.done = Deferred(self._cancel)
 
-        return d # XXX self.headers, content
+    def start(self):
+        self._send_attempt()
+        hedge_after = self.policy.hedge_delay(self.method, self.timing.name)
+        if hedge_after is not None:
+            self.delayed = self.clock.callLater(hedge_after, self._hedge)
+        return self.done
+
+    def _send_attempt(self):
+        self.delayed = None
+        timing = RequestTiming(self.timing.name, self.method, self.endpoint, self.clock.seconds())
+        # Each attempt is signed with its own nonce, so each needs its
+        # own headers.
+        headers = Headers(dict(self.headers.getAllRawHeaders()))
+        d = self.client._attempt(self.endpoint, self.method, headers, self.body, self.priority, timing)
+        attempt = (d, timing)
+        self.attempts.append(attempt)
+        d.addBoth(self._attempt_done, attempt)
+
+    def _hedge(self):
+        self.delayed = None
+        # A duplicate only helps if the first attempt is waiting on the
+        # server; if it is still waiting for the scheduler then so
+        # would the duplicate.
+        if len(self.attempts) == 1 and self.attempts[0][1].sent_at is not None:
+            self.hedged = True
+            self._send_attempt()
+
+    def _attempt_done(self, result, attempt):
+        if self.finished:
+            _discard(result)
+            return
+        self.attempts.remove(attempt)
+        delay = self.policy.retry_delay(self.retries, result, self.clock.seconds())
+        if delay is None:
+            self._finish(result, attempt[1])
+        elif self.attempts:
+            # A hedged duplicate is still outstanding; wait for it.
+            _discard(result)
+        else:
+            _discard(result)
+            self.retries += 1
+            if self.delayed is not None:
+                self.delayed.cancel()
+            self.delayed = self.clock.callLater(delay, self._send_attempt)
+
+    def _finish(self, result, timing):
+        self.finished = True
+        if self.delayed is not None:
+            self.delayed.cancel()
+            self.delayed = None
+        for slot in RequestTiming.__slots__:
+            if slot != 'name':
+                setattr(self.timing, slot, getattr(timing, slot))
+        self.timing.retries = self.retries
+        self.timing.hedged = self.hedged
+        for (d, ign) in self.attempts:
+            d.cancel()
+        if isinstance(result, Failure):
+            self.done.errback(result)
+        else:
+            self.done.callback(result)
 
+    def _cancel(self, d):
+        self.finished = True
+        if self.delayed is not None:
+            self.delayed.cancel()
+            self.delayed = None
+        for (d2, ign) in self.attempts:
+            d2.cancel()
 
 class APIError(Exception):
     """Base exception for all API errors."""
 
     def __init__(self, code, msg, headers, description=''):
+        # Set args so that the exception can be pickled, e.g. to send
+        # it back from a ProcessOffloader's worker.
+        self.args = (code, msg, headers, description)
         self.code = code
         self.msg = msg
         self.headers = headers
@@ -339,6 +1734,7 @@ class DecodeError(APIError):
 
     def __init__(self, body, le):
         super(DecodeError, self).__init__(None, "Could not decode JSON from server.", None, repr(le))
+        self.args = (body, le)
         self.body = body
 
     def __repr__(self):
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+from pyutil.assertutil import precondition
+
+DEFAULT_MAXSIZE = 10000
+DEFAULT_TTL = 3600
+
+class CacheEntry(object):
+    """
+    A cached Feature, the time at which it goes stale, and the HTTP
+    validators (the ETag and Last-Modified response headers, or None)
+    with which a stale entry can be revalidated by a conditional
+    request.
+    """
+    __slots__ = ('feature', 'expires', 'etag', 'last_modified')
+
+    def __init__(self, feature, expires, etag=None, last_modified=None):
+        self.feature = feature
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+class FeatureCache(object):
+    """
+    An in-memory cache of Feature objects keyed by simplegeohandle.
+
+    It holds at most maxsize features, evicting the least recently
+    used one when it is full. A feature which was put into the cache
+    more than ttl seconds ago is stale and is no longer returned from
+    get(). If ttl is None features never go stale.
+
+    .hits, .misses and .evictions count what happened to lookups and
+    insertions, for monitoring.
+
+    If index is given (a GridIndex) then every Feature in the cache,
+    stale or not, is also kept in the index, so that
+    cache.index.nearest() and cache.index.intersecting() answer
+    proximity queries over the cached features without any requests.
+
+    If store is given (a DiskFeatureStore) then it is a second, larger
+    and persistent tier below the in-memory one: every put() is
+    written through to it (unless it is read-only; re-putting the
+    Feature already cached only renews it there) and invalidate()
+    deletes from it, and when get() doesn't find a handle in memory
+    it loads it from the store, counting .disk_hits. A loaded feature
+    goes stale ttl seconds after it was stored, and keeps its
+    validators, so a stale one is revalidated like any other. Features
+    evicted from memory stay in the store, and clear() leaves the
+    store alone.
+    """
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL, clock=None, index=None, store=None):
+        precondition(isinstance(maxsize, (int, long)) and maxsize > 0, "maxsize is required to be a positive integer.", maxsize=maxsize)
+        precondition(ttl is None or ttl >= 0, "ttl is required to be None or a non-negative number of seconds.", ttl=ttl)
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.index = index
+        self.store = store
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_hits = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, simplegeohandle):
+        return self.get_entry(simplegeohandle) is not None
+
+    def _is_fresh(self, entry):
+        return entry.expires is None or self.clock.seconds() < entry.expires
+
+    def get_entry(self, simplegeohandle):
+        """ Return the CacheEntry for this handle, whether or not it is
+        stale, or None. Doesn't count as a use of the entry. """
+        return self._entries.get(simplegeohandle)
+
+    def get(self, simplegeohandle):
+        """ Return the cached Feature, or None if there isn't a fresh
+        one. """
+        entry = self._entries.pop(simplegeohandle, None)
+        if entry is None and self.store is not None:
+            entry = self._load(simplegeohandle)
+        if entry is None:
+            self.misses += 1
+            return None
+        # Re-insert to mark it as the most recently used.
+        self._entries[simplegeohandle] = entry
+        if not self._is_fresh(entry):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.feature
+
+    def _expires(self, stored_at):
+        if self.ttl is None:
+            return None
+        return stored_at + self.ttl
+
+    def _load(self, simplegeohandle):
+        """ Copy the handle's feature from the store into memory and
+        return its CacheEntry, or return None if it isn't stored. """
+        stored = self.store.lookup(simplegeohandle)
+        if stored is None:
+            return None
+        feature = self.store.get(simplegeohandle)
+        self.disk_hits += 1
+        return self._insert(simplegeohandle, CacheEntry(feature, self._expires(stored.stored_at), stored.etag, stored.last_modified))
+
+    def put(self, simplegeohandle, feature, etag=None, last_modified=None):
+        if self.store is not None and not self.store.readonly:
+            old = self._entries.get(simplegeohandle)
+            # Putting the Feature which is already cached, as after a
+            # 304 Not Modified, only renews it in the store.
+            if old is None or old.feature is not feature or not self.store.touch(simplegeohandle, etag, last_modified):
+                self.store.put(simplegeohandle, feature, etag, last_modified)
+        entry = CacheEntry(feature, self._expires(self.clock.seconds()), etag, last_modified)
+        return self._insert(simplegeohandle, entry)
+
+    def _insert(self, simplegeohandle, entry):
+        feature = entry.feature
+        self._entries.pop(simplegeohandle, None)
+        self._entries[simplegeohandle] = entry
+        if self.index is not None:
+            self.index.insert(feature, simplegeohandle)
+        while len(self._entries) > self.maxsize:
+            (evicted, ign) = self._entries.popitem(last=False)
+            if self.index is not None:
+                self.index.remove(evicted)
+            self.evictions += 1
+        return entry
+
+    def invalidate(self, simplegeohandle):
+        """ Forget the cached feature for this handle, if any. """
+        self._entries.pop(simplegeohandle, None)
+        if self.index is not None:
+            self.index.remove(simplegeohandle)
+        if self.store is not None and not self.store.readonly:
+            self.store.delete(simplegeohandle)
+
+    def clear(self):
+        self._entries.clear()
+        if self.index is not None:
+            self.index.clear()
@@ -0,0 +1,128 @@
+from collections import deque
+
+from twisted.internet import reactor
+
+from pyutil.assertutil import precondition
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+DEFAULT_FAILURE_RATE = 0.5
+DEFAULT_WINDOW = 20
+DEFAULT_MIN_REQUESTS = 10
+DEFAULT_RESET_TIMEOUT = 30.0
+DEFAULT_PROBES = 1
+
+class CircuitOpenError(Exception):
+    """ A request wasn't sent because the circuit breaker for its
+    endpoint is open. """
+    def __init__(self, name):
+        Exception.__init__(self, name)
+        self.name = name
+
+    def __str__(self):
+        return "the circuit breaker for the %r endpoint is open" % (self.name,)
+
+class CircuitBreaker(object):
+    """
+    Decides whether requests to one endpoint should be sent, from how
+    the recent ones went.
+
+    The breaker starts closed, letting everything through and
+    remembering whether each of the last window requests failed. Once
+    at least min_requests have been seen and at least failure_rate of
+    them failed, it opens: allow() says no to everything, so callers
+    fail at once instead of waiting for a server which isn't
+    answering. After reset_timeout seconds it becomes half-open and
+    lets probes requests through; if they all succeed it closes
+    again, and if any fails it opens for another reset_timeout. Only
+    the results of those probes count while it is half-open: a request
+    let through earlier, while it was closed, may still be answered
+    then, but says nothing about whether the endpoint has recovered.
+
+    .state is CLOSED, OPEN or HALF_OPEN, and .times_opened counts how
+    often it has opened, for monitoring.
+    """
+    def __init__(self, failure_rate=DEFAULT_FAILURE_RATE, window=DEFAULT_WINDOW, min_requests=DEFAULT_MIN_REQUESTS, reset_timeout=DEFAULT_RESET_TIMEOUT, probes=DEFAULT_PROBES, clock=None):
+        precondition(0 < failure_rate <= 1, "failure_rate is required to be in (0, 1].", failure_rate=failure_rate)
+        precondition(isinstance(window, (int, long)) and window > 0, "window is required to be a positive integer.", window=window)
+        precondition(isinstance(min_requests, (int, long)) and 0 < min_requests <= window, "min_requests is required to be a positive integer no bigger than window.", min_requests=min_requests, window=window)
+        precondition(isinstance(probes, (int, long)) and probes > 0, "probes is required to be a positive integer.", probes=probes)
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.state = CLOSED
+        self.opened_at = None
+        self.times_opened = 0
+        self._outcomes = deque(maxlen=window)
+        self._failures = 0
+        self._probes = set()
+        self._probe_successes = 0
+
+    def allow(self):
+        """ Return a true token if a request may be sent now, or False
+        if not. Every request which is allowed must later be reported,
+        with its token, to exactly one of record_success(),
+        record_failure() or record_ignored(). """
+        if self.state == OPEN:
+            if self.clock.seconds() < self.opened_at + self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            self._probes.clear()
+            self._probe_successes = 0
+        if self.state == HALF_OPEN:
+            if len(self._probes) + self._probe_successes >= self.probes:
+                return False
+            probe = object()
+            self._probes.add(probe)
+            return probe
+        return True
+
+    def record_success(self, token=True):
+        if self.state == HALF_OPEN:
+            if token in self._probes:
+                self._probes.remove(token)
+                self._probe_successes += 1
+                if self._probe_successes >= self.probes:
+                    self._close()
+        elif self.state == CLOSED:
+            self._add(False)
+
+    def record_failure(self, token=True):
+        if self.state == HALF_OPEN:
+            if token in self._probes:
+                self._open()
+        elif self.state == CLOSED:
+            self._add(True)
+            if len(self._outcomes) >= self.min_requests and self._failures >= self.failure_rate * len(self._outcomes):
+                self._open()
+
+    def record_ignored(self, token=True):
+        """ The request was abandoned, e.g. cancelled, so it says
+        nothing about the endpoint. """
+        self._probes.discard(token)
+
+    def _add(self, failed):
+        if len(self._outcomes) == self._outcomes.maxlen:
+            self._failures -= self._outcomes[0]
+        self._outcomes.append(failed)
+        self._failures += failed
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = self.clock.seconds()
+        self.times_opened += 1
+        self._probes.clear()
+        self._outcomes.clear()
+        self._failures = 0
+
+    def _close(self):
+        self.state = CLOSED
+        self._probes.clear()
+        self._outcomes.clear()
+        self._failures = 0
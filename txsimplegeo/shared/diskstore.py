@@ -0,0 +1,471 @@
+import fcntl, mmap, os, struct, zlib
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from pyutil import jsonutil as json
+from pyutil.assertutil import precondition
+
+from offload import ThreadOffloader
+
+DEFAULT_MAX_BYTES = 256 * 2 ** 20
+
+# When the file grows past max_bytes it is rewritten with only the
+# live records, dropping the oldest of them until what is left fits
+# in this fraction of max_bytes, so that compactions are rare.
+COMPACT_TARGET = 0.5
+
+# Records are appended in memory and written to the file together
+# this many seconds after the first of them, rather than one by one.
+DEFAULT_FLUSH_DELAY = 0.1
+
+# The writer grows the file, and its map, by as much as it already
+# holds, but by at least MIN_GROWTH and at most MAX_GROWTH bytes,
+# instead of remapping it for every record. The space not yet used
+# is zeros, where reading the records stops.
+MIN_GROWTH = 2 ** 16
+MAX_GROWTH = 2 ** 26
+
+MAGIC = 'txsgfs1\n'
+
+# Each record is a header, the key (a simplegeohandle), and the
+# value: kind, key length, value length, when it was stored (seconds
+# from the store's clock) and the CRC-32 of the key and value.
+RECORD_HEADER = struct.Struct('>BHId')
+RECORD_CRC = struct.Struct('>I')
+HEADER_SIZE = RECORD_HEADER.size + RECORD_CRC.size
+
+# A TOUCH record's value is just the validators line: it marks the
+# feature stored under the key as stored afresh, as after a 304 Not
+# Modified, without writing the feature again.
+(PUT, DELETE, TOUCH) = (1, 2, 3)
+
+def _crc(key, value):
+    """ value may be a str or a buffer. """
+    return zlib.crc32(value, zlib.crc32(key)) & 0xffffffff
+
+def _record(kind, key, value, stored_at):
+    return RECORD_HEADER.pack(kind, len(key), len(value), stored_at) + RECORD_CRC.pack(_crc(key, value)) + key + value
+
+def _stored_value(etag, last_modified, text):
+    # The value of a PUT record is a line of JSON holding the
+    # validators, then the feature's GeoJSON.
+    return json.dumps([etag, last_modified]) + '\n' + text
+
+def _write_compacted(srcpath, tmppath, features):
+    """ Run by the offloader. Write a new store at tmppath holding
+    features, each a tuple (key, offset, length, stored_at, etag,
+    last_modified) of a feature whose JSON is at offset in the store
+    at srcpath, and make sure it is on disk. Returns where each
+    feature's record and JSON start in the new file, and its size. """
+    src = open(srcpath, 'rb')
+    try:
+        f = open(tmppath, 'wb')
+        try:
+            f.write(MAGIC)
+            pos = len(MAGIC)
+            positions = []
+            for (key, offset, length, stored_at, etag, last_modified) in features:
+                src.seek(offset)
+                text = src.read(length)
+                record = _record(PUT, key, _stored_value(etag, last_modified, text), stored_at)
+                f.write(record)
+                positions.append((pos, pos + len(record) - length))
+                pos += len(record)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+    finally:
+        src.close()
+    return (positions, pos)
+
+class StoredFeature(object):
+    """ What a DiskFeatureStore holds for one handle: where its
+    record starts and where its JSON is in the file, when it was
+    stored, and the HTTP validators it was stored with. """
+    __slots__ = ('record', 'offset', 'length', 'stored_at', 'etag', 'last_modified')
+
+    def __init__(self, record, offset, length, stored_at, etag, last_modified):
+        self.record = record
+        self.offset = offset
+        self.length = length
+        self.stored_at = stored_at
+        self.etag = etag
+        self.last_modified = last_modified
+
+class DiskFeatureStore(object):
+    """
+    A persistent store of Features keyed by simplegeohandle, in one
+    append-only file which is read through mmap.
+
+    put() appends a record holding the feature's GeoJSON text (and
+    its ETag and Last-Modified, if any), touch() appends a small
+    record renewing a stored feature's time and validators, and
+    delete() appends a tombstone; nothing is rewritten in place. An
+    index from handle to the latest record is kept in memory, and is
+    rebuilt on opening by reading through the file once. Records are
+    kept in memory and written to the file together flush_delay
+    seconds after the first of them (or when flush() or close() is
+    called, or one of them is read), so other processes see them only
+    then. Records are checksummed, so a record cut short by a crash
+    is ignored. get_json() returns a
+    buffer straight onto the mapped file, without copying; get()
+    decodes it into a Feature with Feature.from_json(), passing
+    use_decimal and compact, and without validating again.
+
+    When the file grows past max_bytes, put() starts compacting it:
+    the offloader (a ThreadOffloader, unless another is given) writes
+    the live features to a new file, each with the time and validators
+    it was last stored or touched with, oldest first, leaving out the
+    oldest ones if they wouldn't fit in COMPACT_TARGET of max_bytes.
+    Meanwhile the store goes on being used as usual. When the new
+    file is ready, the records appended since are copied onto its end
+    and it is renamed over the old one.
+
+    Only one process may open a path for writing at a time (opening a
+    second raises IOError), but any number may open it with
+    readonly=True. A read-only store looks for records written since
+    it last looked before every lookup (and when refresh() is
+    called), so it answers with the latest record for a handle even
+    if it found an older one before, and reopens the file if it has
+    been compacted. Since compaction
+    replaces the file rather than changing it, a reader never sees a
+    half-written file.
+
+    .compactions counts the compactions done by this store.
+    """
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, readonly=False, use_decimal=True, compact=False, clock=None, offloader=None, flush_delay=DEFAULT_FLUSH_DELAY):
+        precondition(max_bytes > len(MAGIC), "max_bytes is required to be a positive number of bytes.", max_bytes=max_bytes)
+        if clock is None:
+            clock = reactor
+        if offloader is None and not readonly:
+            offloader = ThreadOffloader()
+        self.clock = clock
+        self.offloader = offloader
+        self.path = path
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self.use_decimal = use_decimal
+        self.compact = compact
+        self.flush_delay = flush_delay
+        self.compactions = 0
+        # The records appended but not yet written, and the call which
+        # will write them.
+        self._pending = []
+        self._flush_call = None
+        # The deferreds waiting for the compaction under way, if any.
+        self._compacting = None
+        self._lockfile = None
+        if not readonly:
+            self._lockfile = open(path + '.lock', 'a')
+            try:
+                fcntl.flock(self._lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                self._lockfile.close()
+                self._lockfile = None
+                raise
+            if not os.path.exists(path):
+                self._create(path)
+        self._open()
+
+    def _create(self, path):
+        f = open(path, 'wb')
+        f.write(MAGIC)
+        f.close()
+
+    def _open(self):
+        if self.readonly:
+            self._file = open(self.path, 'rb')
+        else:
+            self._file = open(self.path, 'r+b')
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._map = None
+        self._mapped = 0
+        self._index = {}
+        self._scanned = len(MAGIC)
+        self._live_bytes = 0
+        self._remap()
+        if self._map is None or self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a feature store." % (self.path,))
+        self._scan()
+        # How much of the file the writer has written; _scanned counts
+        # the records appended since, too.
+        self._written = self._scanned
+        if not self.readonly:
+            self._clear_tail()
+
+    def _clear_tail(self):
+        """ Zero whatever follows the last complete record, such as a
+        record cut short by a crash, so that the records appended from
+        now on can be found. The file is never made shorter, since
+        readers may have mapped all of it. """
+        zeros = '\0' * MIN_GROWTH
+        for pos in xrange(self._scanned, self._mapped, len(zeros)):
+            chunk = self._map[pos:pos+len(zeros)]
+            if chunk.strip('\0'):
+                self._file.seek(pos)
+                self._file.write(zeros[:len(chunk)])
+        self._file.flush()
+
+    def _remap(self):
+        size = os.fstat(self._file.fileno()).st_size
+        if size == self._mapped:
+            return
+        # The old map isn't closed, since buffers from get_json() may
+        # still refer to it; it goes away with the last of them.
+        self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+        self._mapped = size
+
+    def _scan(self):
+        """ Index the complete records after those already indexed. """
+        m = self._map
+        pos = self._scanned
+        while pos + HEADER_SIZE <= self._mapped:
+            (kind, keylen, valuelen, stored_at) = RECORD_HEADER.unpack_from(m, pos)
+            (crc,) = RECORD_CRC.unpack_from(m, pos + RECORD_HEADER.size)
+            start = pos + HEADER_SIZE
+            end = start + keylen + valuelen
+            if kind == 0 or end > self._mapped:
+                # The unused end of the file, or a record still being
+                # written or cut short by a crash.
+                break
+            key = m[start:start+keylen]
+            if kind not in (PUT, DELETE, TOUCH) or _crc(key, buffer(m, start+keylen, valuelen)) != crc:
+                break
+            if kind == TOUCH:
+                stored = self._index.get(key)
+                if stored is not None:
+                    (stored.etag, stored.last_modified) = json.loads(m[start+keylen:end])
+                    stored.stored_at = stored_at
+            else:
+                self._forget(key)
+                if kind == PUT:
+                    self._index[key] = self._index_entry(pos, start + keylen, valuelen, stored_at)
+                    self._live_bytes += end - pos
+            pos = end
+        self._scanned = pos
+
+    def _index_entry(self, record, offset, length, stored_at):
+        newline = self._map.find('\n', offset, offset + length)
+        (etag, last_modified) = json.loads(self._map[offset:newline])
+        return StoredFeature(record, newline + 1, offset + length - newline - 1, stored_at, etag, last_modified)
+
+    def _forget(self, key):
+        old = self._index.pop(key, None)
+        if old is not None:
+            self._live_bytes -= old.offset + old.length - old.record
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, simplegeohandle):
+        return self.lookup(simplegeohandle) is not None
+
+    @property
+    def size(self):
+        """ The number of bytes of records in the file, counting those
+        not yet written. """
+        return self._scanned
+
+    def refresh(self):
+        """ Pick up records written (or a compaction done) by another
+        process since this store last looked. """
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return
+        if inode != self._inode:
+            self._close_file()
+            self._open()
+            return
+        self._remap()
+        self._scan()
+
+    def lookup(self, simplegeohandle):
+        """ Return the StoredFeature for the handle, or None. """
+        if self.readonly:
+            self.refresh()
+        return self._index.get(simplegeohandle)
+
+    def get_json(self, simplegeohandle):
+        """ Return a buffer of the stored GeoJSON text of the feature,
+        or None. The buffer is a view onto the mapped file, and stays
+        valid however long it is kept, even after the file has been
+        compacted. """
+        stored = self.lookup(simplegeohandle)
+        if stored is None:
+            return None
+        if self._pending and stored.offset + stored.length > self._written:
+            self.flush()
+        return buffer(self._map, stored.offset, stored.length)
+
+    def get(self, simplegeohandle):
+        """ Return the stored Feature, or None. """
+        stored = self.lookup(simplegeohandle)
+        if stored is None:
+            return None
+        # Imported here since txsimplegeo.shared imports this module.
+        from txsimplegeo.shared import Feature
+        if self._pending and stored.offset + stored.length > self._written:
+            self.flush()
+        text = self._map[stored.offset:stored.offset+stored.length]
+        return Feature.from_json(text, self.use_decimal, self.compact, validate=False)
+
+    def _append(self, kind, key, value, stored_at):
+        """ Append a record, to be written by flush(), and return
+        where it starts. """
+        precondition(not self.readonly, "This store was opened read-only.", path=self.path)
+        record = _record(kind, key, value, stored_at)
+        pos = self._scanned
+        self._pending.append(record)
+        self._scanned += len(record)
+        if self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.flush_delay, self.flush)
+        return pos
+
+    def flush(self):
+        """ Write the records appended so far to the file. """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if not self._pending:
+            return
+        data = ''.join(self._pending)
+        self._pending = []
+        if self._scanned > self._mapped:
+            self._file.truncate(max(self._scanned, self._mapped + min(max(self._mapped, MIN_GROWTH), MAX_GROWTH)))
+            self._remap()
+        self._file.seek(self._written)
+        self._file.write(data)
+        self._file.flush()
+        self._written += len(data)
+
+    def put(self, simplegeohandle, feature, etag=None, last_modified=None):
+        """ Store the Feature under the handle, replacing any feature
+        already stored under it, and start compacting the file if it
+        has grown past max_bytes. """
+        key = str(simplegeohandle)
+        text = feature.to_json()
+        value = _stored_value(etag, last_modified, text)
+        stored_at = self.clock.seconds()
+        record = self._append(PUT, key, value, stored_at)
+        self._forget(key)
+        end = record + HEADER_SIZE + len(key) + len(value)
+        self._index[key] = StoredFeature(record, end - len(text), len(text), stored_at, etag, last_modified)
+        self._live_bytes += end - record
+        if self._scanned > self.max_bytes and self._compacting is None:
+            self.compact_file().addErrback(log.err, "compacting %s failed" % (self.path,))
+
+    def touch(self, simplegeohandle, etag=None, last_modified=None):
+        """ Mark the feature stored under the handle as stored now,
+        with the given validators, as when a conditional request found
+        it unchanged. Returns False, and does nothing, if no feature
+        is stored under it. """
+        stored = self._index.get(simplegeohandle)
+        if stored is None:
+            return False
+        stored_at = self.clock.seconds()
+        self._append(TOUCH, str(simplegeohandle), json.dumps([etag, last_modified]), stored_at)
+        (stored.stored_at, stored.etag, stored.last_modified) = (stored_at, etag, last_modified)
+        return True
+
+    def delete(self, simplegeohandle):
+        """ Forget the feature stored under the handle, if any. """
+        if simplegeohandle in self._index:
+            self._append(DELETE, str(simplegeohandle), '', self.clock.seconds())
+            self._forget(simplegeohandle)
+
+    def compact_file(self):
+        """ Start rewriting the file with only the live features,
+        dropping the oldest ones if they don't fit in COMPACT_TARGET of
+        max_bytes. Returns a Deferred which fires once the new file is
+        in place (or, if a compaction is already under way, once that
+        one is done). """
+        precondition(not self.readonly, "This store was opened read-only.", path=self.path)
+        d = Deferred()
+        if self._compacting is not None:
+            self._compacting.append(d)
+            return d
+        self._compacting = [d]
+
+        live = sorted((stored.stored_at, stored.record, key, stored) for (key, stored) in self._index.iteritems())
+        budget = self.max_bytes * COMPACT_TARGET - len(MAGIC)
+        total = self._live_bytes
+        first = 0
+        while first < len(live) and total > budget:
+            stored = live[first][3]
+            total -= stored.offset + stored.length - stored.record
+            first += 1
+        features = [(key, stored.offset, stored.length, stored_at, stored.etag, stored.last_modified) for (stored_at, record, key, stored) in live[first:]]
+
+        # The worker reads the features from the file.
+        self.flush()
+        tmppath = self.path + '.compacting'
+        d2 = self.offloader.run(_write_compacted, self.path, tmppath, features)
+        d2.addCallback(self._swap, tmppath, features, self._written)
+        d2.addErrback(self._compaction_failed, tmppath)
+        d2.addBoth(self._compacted)
+        return d
+
+    def _swap(self, (positions, size), tmppath, features, copied):
+        """ Put the new file written by _write_compacted() in place of
+        the one it was written from, which had copied bytes then. """
+        if self._file is None:
+            # Closed meanwhile.
+            os.remove(tmppath)
+            return
+        self.flush()
+        f = open(tmppath, 'r+b')
+        f.seek(0, os.SEEK_END)
+        f.write(self._map[copied:self._written])
+        f.flush()
+        index = {}
+        for ((key, old_offset, length, stored_at, etag, last_modified), (record, offset)) in zip(features, positions):
+            index[key] = StoredFeature(record, offset, length, stored_at, etag, last_modified)
+        self._close_file()
+        self._file = f
+        self._inode = os.fstat(f.fileno()).st_ino
+        self._map = None
+        self._mapped = 0
+        self._index = index
+        self._scanned = size
+        self._live_bytes = size - len(MAGIC)
+        self._remap()
+        # Index the records which were copied onto the end.
+        self._scan()
+        self._written = self._scanned
+        os.rename(tmppath, self.path)
+        self.compactions += 1
+
+    def _compaction_failed(self, f, tmppath):
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+        return f
+
+    def _compacted(self, res):
+        (waiting, self._compacting) = (self._compacting, None)
+        for d in waiting:
+            if isinstance(res, Failure):
+                d.errback(res)
+            else:
+                d.callback(None)
+
+    def _close_file(self):
+        self._map = None
+        self._file.close()
+
+    def close(self):
+        if self._file is not None:
+            if not self.readonly:
+                self.flush()
+            self._close_file()
+            self._file = None
+        if self._lockfile is not None:
+            self._lockfile.close()
+            self._lockfile = None
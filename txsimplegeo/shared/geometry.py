@@ -0,0 +1,498 @@
+import math, operator
+
+from array import array
+from itertools import chain, izip
+from decimal import Decimal as D
+
+from pyutil import jsonutil as json
+from pyutil.assertutil import precondition
+
+try:
+    import numpy
+except ImportError:
+    # numpy is optional; without it the whole-array checks below use
+    # the (slower, but still C-level) builtin min() and max().
+    numpy = None
+
+NUMERIC_TYPES = frozenset([int, long, float, D])
+
+def is_numeric(x):
+    return isinstance(x, (int, long, float, D))
+
+def is_valid_lat(x):
+    return is_numeric(x) and (x <= 90) and (x >= -90)
+
+def is_valid_lon(x):
+    return is_numeric(x) and (x <= 180) and (x >= -180.0)
+
+def _all_numeric(xs, types):
+    """ types is set(map(type, xs)). """
+    if types <= NUMERIC_TYPES:
+        return True
+    # Fall back to isinstance() in case of subclasses.
+    return all(map(is_numeric, xs))
+
+def _is_pairs(struc):
+    """ Whether struc looks like a ring or part: a non-empty sequence
+    whose first element is a sequence starting with a number. """
+    return len(struc) and isinstance(struc[0], (list, tuple)) and len(struc[0]) and is_numeric(struc[0][0])
+
+def swap(tupleab):
+    return (tupleab[1], tupleab[0])
+
+def _not_pairs(le):
+    # _is_pairs() only looks at the first element, so a later one may
+    # turn out not to be a pair when unpacked.
+    return AssertionError("Every element is required to be a pair of numbers: %s" % (le,))
+
+def swap_pairs(pairs):
+    """ Swap each pair in a sequence of pairs, in one pass. Raises
+    AssertionError if an element isn't a pair. """
+    try:
+        return [(b, a) for (a, b) in pairs]
+    except (TypeError, ValueError), le:
+        raise _not_pairs(le)
+
+_FLOAT_TYPES = frozenset([int, long, float])
+
+def _has_nan(xs, types):
+    """ Whether any of the numbers xs, whose types are types, is NaN.
+    NaN fails every range check, but min() and max() can pass over it,
+    so it has to be looked for. """
+    if types <= _FLOAT_TYPES:
+        # Any NaN makes the sum NaN, the only value not equal to
+        # itself.
+        total = sum(xs)
+        return total != total
+    if types == set([D]):
+        return any(map(D.is_nan, xs))
+    return any(map(operator.ne, xs, xs))
+
+def _is_valid_bbox(bbox):
+    return (-90 <= bbox[0]) and (bbox[2] <= 90) and (-180 <= bbox[1]) and (bbox[3] <= 180)
+
+def _checked_pairs_bbox(pairs):
+    """ Return the bounding box of pairs if they are all valid,
+    otherwise None. """
+    try:
+        if set(map(len, pairs)) != set([2]):
+            return None
+    except TypeError:
+        # An element which isn't a pair at all.
+        return None
+    (lats, lons) = zip(*pairs)
+    (lattypes, lontypes) = (set(map(type, lats)), set(map(type, lons)))
+    if not (_all_numeric(lats, lattypes) and _all_numeric(lons, lontypes)):
+        return None
+    if _has_nan(lats, lattypes) or _has_nan(lons, lontypes):
+        return None
+    bbox = (min(lats), min(lons), max(lats), max(lons))
+    if not _is_valid_bbox(bbox):
+        return None
+    return bbox
+
+def validate_pairs(pairs):
+    """
+    Return True if pairs is a sequence of (lat, lon) pairs of numbers
+    with each lat in [-90, 90] and each lon in [-180, 180]. The whole
+    sequence is checked with a few passes of builtins instead of one
+    Python-level test per pair.
+    """
+    return _checked_pairs_bbox(pairs) is not None
+
+def _union(bbox1, bbox2):
+    if bbox1 is None:
+        return bbox2
+    if bbox2 is None:
+        return bbox1
+    return (min(bbox1[0], bbox2[0]), min(bbox1[1], bbox2[1]), max(bbox1[2], bbox2[2]), max(bbox1[3], bbox2[3]))
+
+def deep_swap(struc):
+    if isinstance(struc, CompactCoordinates):
+        return struc.to_geojson()
+    if is_numeric(struc[0]):
+        assert len(struc) == 2
+        assert is_numeric(struc[1])
+        return swap(struc)
+    if _is_pairs(struc):
+        return swap_pairs(struc)
+    return [deep_swap(sub) for sub in struc]
+
+def validated_extent(struc):
+    """
+    Check struc just as deep_validate_lat_lon() does, raising
+    AssertionError if it isn't valid, and return (bounding_box(struc),
+    number of vertices). The validation finds the extremes anyway, so
+    the bounding box comes for free.
+    """
+    if isinstance(struc, CompactCoordinates):
+        bbox = struc.bounding_box()
+        # numpy's min() and max() return NaN if there is any, so only
+        # the builtins' results need checking for it.
+        assert bbox is None or (_is_valid_bbox(bbox) and (numpy is not None or not _has_nan(struc.flat, _FLOAT_TYPES)))
+        return (bbox, struc.num_vertices())
+    precondition(isinstance(struc, (list, tuple, set)), 'argument must be a sequence (of sequences of...) numbers')
+    if is_numeric(struc[0]):
+        assert len(struc) == 2
+        assert is_numeric(struc[1])
+        assert is_valid_lat(struc[0])
+        assert is_valid_lon(struc[1])
+        return ((struc[0], struc[1], struc[0], struc[1]), 1)
+    if _is_pairs(struc):
+        bbox = _checked_pairs_bbox(struc)
+        assert bbox is not None
+        return (bbox, len(struc))
+    (bbox, n) = (None, 0)
+    for sub in struc:
+        (subbbox, subn) = validated_extent(sub)
+        bbox = _union(bbox, subbbox)
+        n += subn
+    return (bbox, n)
+
+def deep_validate_lat_lon(struc):
+    validated_extent(struc)
+    return True
+
+def iter_pairs(struc):
+    """ Return an iterable of every lat/lon pair in struc, which is a
+    lone pair or nested sequences of pairs. """
+    if isinstance(struc, CompactCoordinates):
+        flat = struc.flat
+        return izip(flat[0::2], flat[1::2])
+    if not len(struc):
+        return []
+    if is_numeric(struc[0]):
+        return [struc]
+    if _is_pairs(struc):
+        return struc
+    return chain.from_iterable([iter_pairs(sub) for sub in struc])
+
+def bounding_box(struc):
+    """ Return the (minlat, minlon, maxlat, maxlon) of the pairs in
+    struc, in the same forms as deep_validate_lat_lon() takes, or None
+    if there are none. """
+    if isinstance(struc, CompactCoordinates):
+        return struc.bounding_box()
+    pairs = list(iter_pairs(struc))
+    if not pairs:
+        return None
+    (lats, lons) = zip(*pairs)
+    return (min(lats), min(lons), max(lats), max(lons))
+
+def extent(struc):
+    """ Return (bounding_box(struc), number of vertices), without
+    validating struc. """
+    if isinstance(struc, CompactCoordinates):
+        return (struc.bounding_box(), struc.num_vertices())
+    pairs = list(iter_pairs(struc))
+    if not pairs:
+        return (None, 0)
+    (lats, lons) = zip(*pairs)
+    return ((min(lats), min(lons), max(lats), max(lons)), len(pairs))
+
+def vertex_centroid(struc):
+    """ Return the (lat, lon) mean of the vertices in struc, as
+    floats, or None if there are none. This is the centroid of the
+    vertices, not of the area, so a ring's closing vertex counts
+    twice. """
+    if isinstance(struc, CompactCoordinates):
+        n = struc.num_vertices()
+        if not n:
+            return None
+        if numpy is not None:
+            a = numpy.frombuffer(struc.flat, dtype=numpy.float64)
+            return (float(a[0::2].mean()), float(a[1::2].mean()))
+        return (math.fsum(struc.flat[0::2]) / n, math.fsum(struc.flat[1::2]) / n)
+    pairs = list(iter_pairs(struc))
+    if not pairs:
+        return None
+    (lats, lons) = zip(*pairs)
+    n = len(pairs)
+    return (math.fsum(map(float, lats)) / n, math.fsum(map(float, lons)) / n)
+
+# iter_geojson_coordinates() yields the pairs of a long ring or line
+# in pieces of at most this many pairs.
+PAIRS_PER_CHUNK = 1024
+
+def _number_json(x):
+    if type(x) is float:
+        return repr(x)
+    if isinstance(x, (D, int, long)) and not isinstance(x, bool):
+        return str(x)
+    return json.dumps(x)
+
+def _swapped_pairs_json(pairs):
+    """ Return the JSON text of pairs, each swapped, without the
+    enclosing brackets. Raises AssertionError if an element isn't a
+    pair. """
+    try:
+        types = set(map(type, chain.from_iterable(pairs)))
+        if types == set([float]):
+            # repr() is how the JSON encoder writes a float.
+            return ','.join(['[%r,%r]' % (b, a) for (a, b) in pairs])
+        if types <= set([D, int, long]):
+            return ','.join(['[%s,%s]' % (b, a) for (a, b) in pairs])
+        return ','.join(['[%s,%s]' % (_number_json(b), _number_json(a)) for (a, b) in pairs])
+    except (TypeError, ValueError), le:
+        raise _not_pairs(le)
+
+def iter_geojson_coordinates(struc):
+    """
+    Yield the JSON text of the GeoJSON coordinates for struc, which is
+    in SimpleGeo (lat, lon) order like a Feature's coordinates, in
+    pieces. This is the same as encoding deep_swap(struc), but it
+    doesn't build the swapped copy: each pair is swapped as it is
+    written out.
+    """
+    if isinstance(struc, CompactCoordinates):
+        struc = struc._root()
+    if not len(struc):
+        yield '[]'
+        return
+    if isinstance(struc, CoordinatesView) and struc._level == struc._cc.depth:
+        # The pairs are floats, straight from the flat array.
+        yield '['
+        for start in xrange(struc._start, struc._stop, PAIRS_PER_CHUNK):
+            if start != struc._start:
+                yield ','
+            it = iter(struc._cc.flat[2*start:2*min(start+PAIRS_PER_CHUNK, struc._stop)])
+            yield ','.join(['[%r,%r]' % (b, a) for (a, b) in izip(it, it)])
+        yield ']'
+    elif is_numeric(struc[0]):
+        assert len(struc) == 2
+        yield '[%s,%s]' % (_number_json(struc[1]), _number_json(struc[0]))
+    elif _is_pairs(struc):
+        yield '['
+        for start in xrange(0, len(struc), PAIRS_PER_CHUNK):
+            if start:
+                yield ','
+            yield _swapped_pairs_json(struc[start:start+PAIRS_PER_CHUNK])
+        yield ']'
+    else:
+        yield '['
+        for i, sub in enumerate(struc):
+            if i:
+                yield ','
+            for chunk in iter_geojson_coordinates(sub):
+                yield chunk
+        yield ']'
+
+def _nesting_depth(struc):
+    """ How many levels of sequences there are above the lat/lon
+    pairs: 0 for a Point, 1 for a LineString, 2 for a Polygon, 3 for
+    a MultiPolygon. """
+    depth = 0
+    while len(struc) and isinstance(struc[0], (list, tuple)):
+        depth += 1
+        struc = struc[0]
+    if not len(struc):
+        # An empty sequence of pairs.
+        depth += 1
+    return depth
+
+def _flatten(struc, level, depth, flat, offsets, swap):
+    if level == depth:
+        if swap:
+            for (a, b) in struc:
+                flat.append(b)
+                flat.append(a)
+        else:
+            for (a, b) in struc:
+                flat.append(a)
+                flat.append(b)
+        return
+
+    offs = offsets[level]
+    for sub in struc:
+        _flatten(sub, level+1, depth, flat, offsets, swap)
+        if level+1 == depth:
+            offs.append(len(flat) // 2)
+        else:
+            offs.append(len(offsets[level+1]) - 1)
+
+class CompactCoordinates(object):
+    """
+    A compact stand-in for a Feature's nested coordinates lists.
+
+    All of the lat/lon pairs are stored, in SimpleGeo (lat, lon)
+    order, in one flat array('d') -- 16 bytes per vertex instead of
+    the hundreds of bytes taken by a tuple of two Python numbers --
+    and the nesting (rings of a polygon, polygons of a multipolygon)
+    is recorded in arrays of offsets.
+
+    Indexing and iterating work the same as for the nested lists: a
+    pair comes back as a (lat, lon) tuple of floats and each level of
+    nesting comes back as a sequence view onto the shared arrays.
+    Numbers are stored as floats, so Decimal coordinates lose any
+    precision beyond that of a float.
+    """
+    __slots__ = ('depth', 'flat', 'offsets')
+
+    def __init__(self, depth, flat, offsets):
+        """
+        depth is the number of levels of sequences above the pairs
+        and flat is an array('d') of lat, lon, lat, lon... For each
+        level l from 1 to depth-1, offsets[l] is an array('l') such
+        that element i of level l holds elements offsets[l][i] up to
+        offsets[l][i+1] of level l+1 (level depth being the pairs).
+        Use from_nested() instead of calling this directly.
+        """
+        self.depth = depth
+        self.flat = flat
+        self.offsets = offsets
+
+    @classmethod
+    def from_nested(cls, struc, swap=False):
+        """
+        Build from nested sequences of pairs. If swap is True then the
+        pairs are in GeoJSON (lon, lat) order, as in a decoded GeoJSON
+        geometry, and are swapped on the way in.
+        """
+        depth = _nesting_depth(struc)
+        flat = array('d')
+        offsets = [None] + [array('l', [0]) for level in range(1, depth)]
+        if depth == 0:
+            _flatten([struc], 1, 1, flat, offsets, swap)
+        else:
+            _flatten(struc, 1, depth, flat, offsets, swap)
+        return cls(depth, flat, offsets)
+
+    def _count(self, level):
+        if level == self.depth:
+            return len(self.flat) // 2
+        return len(self.offsets[level]) - 1
+
+    def _root(self):
+        if self.depth == 0:
+            return (self.flat[0], self.flat[1])
+        return CoordinatesView(self, 1, 0, self._count(1))
+
+    def __len__(self):
+        return len(self._root())
+
+    def __getitem__(self, i):
+        return self._root()[i]
+
+    def __iter__(self):
+        return iter(self._root())
+
+    def __eq__(self, other):
+        if isinstance(other, (CompactCoordinates, CoordinatesView)):
+            other = other.to_list()
+        return self.to_list() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.to_list())
+
+    def num_vertices(self):
+        return len(self.flat) // 2
+
+    def bounding_box(self):
+        """ Return (minlat, minlon, maxlat, maxlon), or None if there
+        are no pairs. """
+        if not self.flat:
+            return None
+        if numpy is not None:
+            a = numpy.frombuffer(self.flat, dtype=numpy.float64)
+            (lats, lons) = (a[0::2], a[1::2])
+            return (float(lats.min()), float(lons.min()), float(lats.max()), float(lons.max()))
+        (lats, lons) = (self.flat[0::2], self.flat[1::2])
+        return (min(lats), min(lons), max(lats), max(lons))
+
+    def to_list(self):
+        """ Return the coordinates as nested lists of (lat, lon)
+        tuples. """
+        root = self._root()
+        if self.depth == 0:
+            return root
+        return root.to_list()
+
+    def swapped(self):
+        """ Return a CompactCoordinates with the same nesting and each
+        pair swapped, e.g. in GeoJSON (lon, lat) order. """
+        flat = array('d', self.flat)
+        flat[0::2] = self.flat[1::2]
+        flat[1::2] = self.flat[0::2]
+        return CompactCoordinates(self.depth, flat, self.offsets)
+
+    def to_geojson(self):
+        """ Return the coordinates as nested lists of (lon, lat)
+        tuples, for a GeoJSON geometry. """
+        return self.swapped().to_list()
+
+    def is_valid_lat_lon(self):
+        """ Return True if every lat is within [-90, 90] and every lon
+        is within [-180, 180]. """
+        if not self.flat:
+            return True
+        if numpy is not None:
+            # A zero-copy view of the array.
+            a = numpy.frombuffer(self.flat, dtype=numpy.float64)
+            (lats, lons) = (a[0::2], a[1::2])
+            return bool((-90 <= lats.min()) and (lats.max() <= 90) and (-180 <= lons.min()) and (lons.max() <= 180))
+        (lats, lons) = (self.flat[0::2], self.flat[1::2])
+        return (-90 <= min(lats)) and (max(lats) <= 90) and (-180 <= min(lons)) and (max(lons) <= 180) and not _has_nan(self.flat, _FLOAT_TYPES)
+
+class CoordinatesView(object):
+    """
+    One level of nesting of a CompactCoordinates: the elements from
+    start to stop of the given level.
+    """
+    __slots__ = ('_cc', '_level', '_start', '_stop')
+
+    def __init__(self, cc, level, start, stop):
+        self._cc = cc
+        self._level = level
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def _element(self, i):
+        cc = self._cc
+        if self._level == cc.depth:
+            return (cc.flat[2*i], cc.flat[2*i+1])
+        offs = cc.offsets[self._level]
+        return CoordinatesView(cc, self._level+1, offs[i], offs[i+1])
+
+    def __getitem__(self, i):
+        n = self._stop - self._start
+        if isinstance(i, slice):
+            return [self._element(self._start + j) for j in xrange(*i.indices(n))]
+        if i < 0:
+            i += n
+        if not (0 <= i < n):
+            raise IndexError(i)
+        return self._element(self._start + i)
+
+    def __iter__(self):
+        cc = self._cc
+        if self._level == cc.depth:
+            it = iter(cc.flat[2*self._start:2*self._stop])
+            return izip(it, it)
+        return (self._element(i) for i in xrange(self._start, self._stop))
+
+    def __eq__(self, other):
+        if isinstance(other, (CompactCoordinates, CoordinatesView)):
+            other = other.to_list()
+        return self.to_list() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.to_list())
+
+    def to_list(self):
+        if self._level == self._cc.depth:
+            return list(self)
+        return [sub.to_list() for sub in self]
+
+    def to_geojson(self):
+        if self._level == self._cc.depth:
+            return [(lon, lat) for (lat, lon) in self]
+        return [sub.to_geojson() for sub in self]
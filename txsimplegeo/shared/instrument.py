@@ -0,0 +1,211 @@
+import bisect
+
+from zope.interface import Interface, implements
+
+from pyutil.assertutil import precondition
+
+class RequestTiming(object):
+    """
+    When each stage of one request to the SimpleGeo service happened,
+    in seconds from the Client's clock, or None if the request didn't
+    get that far (or the stage isn't measured for this kind of
+    request).
+
+    queued_at: when the request was handed to the Client's scheduler.
+    sent_at: when the scheduler let it go and it was given to the Agent.
+    connected_at: when a connection was ready for it -- immediately if
+      a pooled connection was reused, otherwise after DNS resolution
+      and the TCP connect. Only measured with a
+      CountingHTTPConnectionPool.
+    response_at: when the response headers had arrived.
+    body_done_at: when the whole response body had arrived.
+
+    decode and construct are the seconds spent decoding the body's JSON
+    and building Features from it, bytes_received is the length of the
+    body and code is the HTTP status.
+
+    If the request was retried (see RetryPolicy) then the stages are
+    those of the attempt whose response was used, retries is the
+    number of earlier attempts, and hedged is True if a duplicate was
+    sent because the first attempt was slow.
+    """
+    __slots__ = ('name', 'method', 'url', 'queued_at', 'sent_at', 'connected_at', 'response_at', 'body_done_at', 'decode', 'construct', 'bytes_received', 'code', 'retries', 'hedged')
+
+    def __init__(self, name, method, url, queued_at):
+        self.name = name
+        self.method = method
+        self.url = url
+        self.queued_at = queued_at
+        self.sent_at = None
+        self.connected_at = None
+        self.response_at = None
+        self.body_done_at = None
+        self.decode = None
+        self.construct = None
+        self.bytes_received = None
+        self.code = None
+        self.retries = 0
+        self.hedged = False
+
+    def _between(self, start, end):
+        if start is None or end is None:
+            return None
+        return end - start
+
+    @property
+    def queue_wait(self):
+        return self._between(self.queued_at, self.sent_at)
+
+    @property
+    def connect(self):
+        return self._between(self.sent_at, self.connected_at)
+
+    @property
+    def ttfb(self):
+        """ Time to first byte: from sending the request until the
+        response headers arrived. """
+        return self._between(self.sent_at, self.response_at)
+
+    @property
+    def body(self):
+        return self._between(self.response_at, self.body_done_at)
+
+    def _connected(self, clock):
+        """ Return a callback for the connection's deferred which
+        records when it fired. """
+        def _record(conn):
+            self.connected_at = clock.seconds()
+            return conn
+        return _record
+
+# The durations, all in seconds, that an IInstrumentation might
+# aggregate.
+PHASES = ('queue_wait', 'connect', 'ttfb', 'body', 'decode', 'construct')
+
+class IInstrumentation(Interface):
+    def request_finished(timing):
+        """ Called once for each request, with its RequestTiming,
+        when the Client has finished with the response (or with the
+        failure). This is called from the reactor thread for every
+        request, so it should be quick. """
+
+class NullInstrumentation(object):
+    """ Records nothing. The default. """
+    implements(IInstrumentation)
+
+    def request_finished(self, timing):
+        pass
+
+# Bucket boundaries for timings: 1ms, 2ms, 4ms, ... about 9 minutes.
+DEFAULT_SECONDS_BOUNDS = tuple([0.001 * 2 ** i for i in range(20)])
+
+# Bucket boundaries for sizes: 1KiB, 2KiB, ... 1GiB.
+DEFAULT_BYTES_BOUNDS = tuple([2 ** i for i in range(10, 31)])
+
+class Histogram(object):
+    """
+    Counts values into buckets: bucket i holds the values greater than
+    bounds[i-1] and at most bounds[i], and the last bucket holds those
+    greater than all of the bounds. Adding a value takes one binary
+    search, and memory doesn't grow with the number of values.
+    """
+    def __init__(self, bounds=DEFAULT_SECONDS_BOUNDS):
+        precondition(list(bounds) == sorted(bounds), "bounds are required to be in increasing order.", bounds=bounds)
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / float(self.count)
+
+    def percentile(self, p):
+        """ Return an upper bound for the p'th percentile (0 < p <=
+        100): the upper boundary of the bucket it falls in, or the
+        largest value seen if that is smaller. None if empty. """
+        precondition(0 < p <= 100, "p is required to be in (0, 100].", p=p)
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+class HistogramInstrumentation(object):
+    """
+    Aggregates timings into a Histogram per phase (see PHASES), and
+    the body sizes into .bytes_received, across all requests and, in
+    .by_name, separately for each endpoint name ('feature',
+    'features', ...). Also counts responses by HTTP status in .codes,
+    and retried and hedged requests in .retries and .hedges.
+    """
+    implements(IInstrumentation)
+
+    def __init__(self, seconds_bounds=DEFAULT_SECONDS_BOUNDS, bytes_bounds=DEFAULT_BYTES_BOUNDS):
+        self.seconds_bounds = seconds_bounds
+        self.bytes_bounds = bytes_bounds
+        self.phases = self._new_phases()
+        self.by_name = {}
+        self.bytes_received = Histogram(bytes_bounds)
+        self.codes = {}
+        self.retries = 0
+        self.hedges = 0
+
+    def _new_phases(self):
+        return dict([(phase, Histogram(self.seconds_bounds)) for phase in PHASES])
+
+    def request_finished(self, timing):
+        named = self.by_name.get(timing.name)
+        if named is None:
+            named = self.by_name[timing.name] = self._new_phases()
+        for phase in PHASES:
+            value = getattr(timing, phase)
+            if value is not None:
+                self.phases[phase].add(value)
+                named[phase].add(value)
+        if timing.bytes_received is not None:
+            self.bytes_received.add(timing.bytes_received)
+        self.codes[timing.code] = self.codes.get(timing.code, 0) + 1
+        self.retries += timing.retries
+        if timing.hedged:
+            self.hedges += 1
+
+    def percentile(self, phase, p, name=None, min_count=1):
+        """ Return the p'th percentile of phase across all requests,
+        or across those with the given endpoint name, or None if fewer
+        than min_count have been recorded. """
+        if name is None:
+            h = self.phases[phase]
+        elif name in self.by_name:
+            h = self.by_name[name][phase]
+        else:
+            return None
+        if h.count < min_count:
+            return None
+        return h.percentile(p)
+
+    def summary(self):
+        """ Return a dict mapping each phase to a dict of its count,
+        mean and 50th, 95th and 99th percentiles, and max. """
+        summary = {}
+        for (phase, h) in self.phases.iteritems():
+            summary[phase] = { 'count': h.count, 'mean': h.mean(), 'p50': h.percentile(50), 'p95': h.percentile(95), 'p99': h.percentile(99), 'max': h.max }
+        return summary
@@ -0,0 +1,326 @@
+import re
+from decimal import Decimal as D
+
+from pyutil import jsonutil as json
+
+# Each token is preceded by optional whitespace and is one of:
+# structural punctuation, a run of characters which can make up a
+# number, a run of lowercase letters (true, false, or null), or the
+# opening quote of a string.
+TOKEN_R = re.compile(r'[ \t\n\r]*(?:([\[\]{},:])|(-[-+0-9.eE]*|[0-9][-+0-9.eE]*)|([a-z]+)|("))')
+NUMBER_R = re.compile(r'-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?$')
+WHITESPACE_R = re.compile(r'[ \t\n\r]*')
+# The body of a string up to its closing quote, or as far as the text
+# goes if that hasn't come yet. It never stops between a backslash
+# and the character it escapes, so a scan can be resumed from where
+# this stopped once more text arrives.
+STRING_BODY_R = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+LITERALS = { 'true': True, 'false': False, 'null': None }
+
+# What the decoder expects to see next.
+(VALUE, VALUE_OR_END, KEY, KEY_OR_END, COLON, COMMA_OR_END, DONE) = range(7)
+
+class IncrementalJSONDecoder(object):
+    """
+    A push-style JSON decoder. Pass the text to feed() in as many
+    pieces as you like, split anywhere, then call close() to get the
+    decoded value. Objects and arrays are built up as their contents
+    arrive, so only the unparsed tail of the text (usually less than
+    one token) is held besides the partially decoded value.
+
+    Numbers with a fraction or exponent are decoded with parse_float,
+    which defaults to decimal.Decimal to match
+    txsimplegeo.shared.json_decode(). Errors are reported by raising
+    ValueError, either from feed() or, if the text was merely
+    incomplete, from close().
+    """
+    def __init__(self, parse_float=D):
+        self.parse_float = parse_float
+        self._buf = ''
+        self._stack = []
+        self._key = None
+        self._expect = VALUE
+        self._value = None
+        # How far into _buf an unterminated string at its start is
+        # already known not to end.
+        self._scanned = 0
+
+    def feed(self, data):
+        if self._buf:
+            self._buf += data
+        else:
+            self._buf = data
+        self._parse(final=False)
+
+    def close(self):
+        self._parse(final=True)
+        if self._expect != DONE:
+            raise ValueError("Unexpected end of JSON text.")
+        return self._value
+
+    def unparsed(self):
+        """ Return the text fed so far which hasn't been decoded yet. """
+        return self._buf
+
+    def _parse(self, final):
+        buf = self._buf
+        buflen = len(buf)
+        pos = 0
+        scanned = self._scanned
+        self._scanned = 0
+        try:
+            while True:
+                mo = TOKEN_R.match(buf, pos)
+                if mo is None:
+                    wsend = WHITESPACE_R.match(buf, pos).end()
+                    if wsend != buflen:
+                        raise ValueError("Unexpected character %r at char %d of the remaining JSON text." % (buf[wsend], wsend))
+                    pos = wsend
+                    break
+
+                (punct, number, literal, quote) = mo.groups()
+                if punct is not None:
+                    self._punct(punct)
+                elif quote is not None:
+                    # Only the first token can be a string which was
+                    # left unterminated by the last piece.
+                    end = STRING_BODY_R.match(buf, max(mo.end(), scanned)).end()
+                    scanned = 0
+                    if buf[end:end+1] != '"' and not final:
+                        # Unterminated so far. Carry on from here once
+                        # more text comes, rather than scanning the
+                        # whole string again each time.
+                        self._scanned = end - pos
+                        break
+                    (s, end) = json.decoder.scanstring(buf, mo.end())
+                    self._string(s)
+                    pos = end
+                    continue
+                else:
+                    if mo.end() == buflen and not final:
+                        # The number or literal may continue in the
+                        # next piece.
+                        break
+                    if number is not None:
+                        self._add_value(self._number(number))
+                    else:
+                        if literal not in LITERALS:
+                            raise ValueError("Invalid literal %r." % (literal,))
+                        self._add_value(LITERALS[literal])
+                pos = mo.end()
+        finally:
+            self._buf = buf[pos:]
+
+    def _number(self, s):
+        mo = NUMBER_R.match(s)
+        if mo is None:
+            raise ValueError("Invalid number %r." % (s,))
+        if mo.group(1) or mo.group(2):
+            return self.parse_float(s)
+        return int(s)
+
+    def _punct(self, c):
+        expect = self._expect
+        if c == ',':
+            if expect != COMMA_OR_END:
+                raise ValueError("Unexpected ','.")
+            if isinstance(self._stack[-1][0], dict):
+                self._expect = KEY
+            else:
+                self._expect = VALUE
+        elif c == ':':
+            if expect != COLON:
+                raise ValueError("Unexpected ':'.")
+            self._expect = VALUE
+        elif c == '{' or c == '[':
+            if expect != VALUE and expect != VALUE_OR_END:
+                raise ValueError("Unexpected %r." % (c,))
+            if c == '{':
+                container = {}
+                self._expect = KEY_OR_END
+            else:
+                container = []
+                self._expect = VALUE_OR_END
+            self._stack.append((container, self._key))
+            self._key = None
+        elif c == '}':
+            if (expect != KEY_OR_END and expect != COMMA_OR_END) or not isinstance(self._stack[-1][0], dict):
+                raise ValueError("Unexpected '}'.")
+            self._close_container()
+        else: # ']'
+            if (expect != VALUE_OR_END and expect != COMMA_OR_END) or not isinstance(self._stack[-1][0], list):
+                raise ValueError("Unexpected ']'.")
+            self._close_container()
+
+    def _close_container(self):
+        (container, self._key) = self._stack.pop()
+        # The enclosing container (if any) was expecting a value when
+        # this one was opened.
+        self._expect = VALUE
+        self._add_value(container)
+
+    def _string(self, s):
+        expect = self._expect
+        if expect == KEY or expect == KEY_OR_END:
+            self._key = s
+            self._expect = COLON
+        else:
+            self._add_value(s)
+
+    def _add_value(self, value):
+        expect = self._expect
+        if expect != VALUE and expect != VALUE_OR_END:
+            raise ValueError("Unexpected value %r." % (value,))
+        if not self._stack:
+            self._value = value
+            self._expect = DONE
+            return
+        container = self._stack[-1][0]
+        if isinstance(container, dict):
+            container[self._key] = value
+            self._key = None
+        else:
+            container.append(value)
+        self._expect = COMMA_OR_END
+
+# Within a JSON object the only characters that matter for finding
+# where it ends are braces and the quotes which start strings (which
+# might contain braces). In particular this skips over a geometry's
+# coordinate arrays without looking at each number or bracket.
+OBJECT_SKIP_R = re.compile(r'[{}"]')
+
+def _skip_object(s, idx):
+    """ s[idx] is the '{' which opens a JSON object. Return the index
+    just past the matching '}'. """
+    depth = 0
+    pos = idx
+    while True:
+        mo = OBJECT_SKIP_R.search(s, pos)
+        if mo is None:
+            raise ValueError("Unterminated object starting at char %d." % (idx,))
+        c = mo.group()
+        if c == '"':
+            (ign, pos) = json.decoder.scanstring(s, mo.end())
+            continue
+        if c == '{':
+            depth += 1
+        else:
+            depth -= 1
+        pos = mo.end()
+        if depth == 0:
+            return pos
+
+def decode_object_deferring(text, deferkey, parse_float=D):
+    """
+    Decode text, which must be a JSON object, except that if the
+    object has a member named deferkey whose value is itself an
+    object, that value is not decoded. Returns a tuple of (the decoded
+    object without deferkey, the text of deferkey's value or None).
+    Raises ValueError if the text isn't a well-formed JSON object.
+
+    This is for when decoding one member, such as a large geometry,
+    may not be necessary at all, or can wait until later. Finding the
+    end of the deferred value costs a C-speed regex scan rather than a
+    full decode.
+    """
+    decoder = json.JSONDecoder(parse_float=parse_float)
+    ws = WHITESPACE_R.match
+    obj = {}
+    deferred = None
+
+    idx = ws(text, 0).end()
+    if text[idx:idx+1] != '{':
+        raise ValueError("Expected a JSON object.")
+    idx = ws(text, idx+1).end()
+    if text[idx:idx+1] == '}':
+        idx += 1
+    else:
+        while True:
+            if text[idx:idx+1] != '"':
+                raise ValueError("Expected a property name at char %d." % (idx,))
+            (key, idx) = json.decoder.scanstring(text, idx+1)
+            idx = ws(text, idx).end()
+            if text[idx:idx+1] != ':':
+                raise ValueError("Expected ':' at char %d." % (idx,))
+            idx = ws(text, idx+1).end()
+            if key == deferkey and text[idx:idx+1] == '{':
+                end = _skip_object(text, idx)
+                deferred = text[idx:end]
+                obj.pop(key, None)
+                idx = end
+            else:
+                (obj[key], idx) = decoder.raw_decode(text, idx)
+            idx = ws(text, idx).end()
+            c = text[idx:idx+1]
+            idx += 1
+            if c == '}':
+                break
+            if c != ',':
+                raise ValueError("Expected ',' or '}' at char %d." % (idx-1,))
+            idx = ws(text, idx).end()
+
+    if ws(text, idx).end() != len(text):
+        raise ValueError("Extra data after the JSON object at char %d." % (idx,))
+    return (obj, deferred)
+
+def iter_array_member(text, key, parse_float=D):
+    """
+    text must be a JSON object with a member named key whose value is
+    an array, such as a GeoJSON FeatureCollection and its "features".
+    Yield the elements of that array one at a time, each decoded only
+    when it is reached, so that the whole decoded array is never in
+    memory at once. The other members are decoded and thrown away.
+    Raises ValueError if the text isn't a well-formed JSON object or
+    has no such array.
+    """
+    decoder = json.JSONDecoder(parse_float=parse_float)
+    ws = WHITESPACE_R.match
+    found = False
+
+    idx = ws(text, 0).end()
+    if text[idx:idx+1] != '{':
+        raise ValueError("Expected a JSON object.")
+    idx = ws(text, idx+1).end()
+    if text[idx:idx+1] == '}':
+        idx += 1
+    else:
+        while True:
+            if text[idx:idx+1] != '"':
+                raise ValueError("Expected a property name at char %d." % (idx,))
+            (k, idx) = json.decoder.scanstring(text, idx+1)
+            idx = ws(text, idx).end()
+            if text[idx:idx+1] != ':':
+                raise ValueError("Expected ':' at char %d." % (idx,))
+            idx = ws(text, idx+1).end()
+            if k == key and text[idx:idx+1] == '[' and not found:
+                found = True
+                idx = ws(text, idx+1).end()
+                if text[idx:idx+1] == ']':
+                    idx += 1
+                else:
+                    while True:
+                        (value, idx) = decoder.raw_decode(text, idx)
+                        yield value
+                        idx = ws(text, idx).end()
+                        c = text[idx:idx+1]
+                        idx += 1
+                        if c == ']':
+                            break
+                        if c != ',':
+                            raise ValueError("Expected ',' or ']' at char %d." % (idx-1,))
+                        idx = ws(text, idx).end()
+            else:
+                (ign, idx) = decoder.raw_decode(text, idx)
+            idx = ws(text, idx).end()
+            c = text[idx:idx+1]
+            idx += 1
+            if c == '}':
+                break
+            if c != ',':
+                raise ValueError("Expected ',' or '}' at char %d." % (idx-1,))
+            idx = ws(text, idx).end()
+
+    if ws(text, idx).end() != len(text):
+        raise ValueError("Extra data after the JSON object at char %d." % (idx,))
+    if not found:
+        raise ValueError("No %r array in the JSON object." % (key,))
@@ -0,0 +1,52 @@
+# The response headers which a ResponseMetadata keeps by default.
+DEFAULT_METADATA_HEADERS = ('Content-Type', 'Date', 'ETag', 'Last-Modified')
+
+class ResponseMetadata(object):
+    """
+    What is worth remembering about the HTTP response which a Feature
+    came from, in a few dozen bytes, instead of the whole
+    twisted.web.client.Response (which keeps its headers, its request
+    and its connection's transport alive for as long as the Feature
+    is).
+
+    code is the HTTP status, received_at the Client clock's time when
+    the response headers arrived, ttfb and body the seconds taken to
+    get the headers and then the body (as in RequestTiming; None if
+    not measured), and headers a tuple of (name, value) for those of
+    the selected headers which the response had. Every Feature from
+    one response shares one ResponseMetadata.
+    """
+    __slots__ = ('code', 'received_at', 'ttfb', 'body', 'headers')
+
+    def __init__(self, code, received_at=None, ttfb=None, body=None, headers=()):
+        self.code = code
+        self.received_at = received_at
+        self.ttfb = ttfb
+        self.body = body
+        self.headers = headers
+
+    @classmethod
+    def from_response(cls, resp, timing=None, header_names=DEFAULT_METADATA_HEADERS):
+        """ Summarize the twisted.web.client.Response and the
+        request's RequestTiming, keeping the last value of each of the
+        headers named in header_names. """
+        headers = []
+        for name in header_names:
+            values = resp.headers.getRawHeaders(name)
+            if values:
+                headers.append((name, values[-1]))
+        if timing is None:
+            return cls(resp.code, headers=tuple(headers))
+        return cls(resp.code, timing.response_at, timing.ttfb, timing.body, tuple(headers))
+
+    def header(self, name, default=None):
+        """ Return the kept value of the named header (in any case),
+        or default. """
+        name = name.lower()
+        for (k, v) in self.headers:
+            if k.lower() == name:
+                return v
+        return default
+
+    def __repr__(self):
+        return "%s(%r, %r, %r, %r, %r)" % (self.__class__.__name__, self.code, self.received_at, self.ttfb, self.body, self.headers)
@@ -1,7 +1,7 @@
 # copied from https://github.com/simplegeo/python-oauth2 and modified
 # to do only what we need here
 
-import hashlib, hmac, urllib
+import binascii, hashlib, hmac, os, re, urllib, urlparse
 
 def to_unicode(s):
     """ Convert to unicode, raise exception with instructive error
@@ -15,9 +15,18 @@ def to_unicode(s):
             raise TypeError('You are required to pass either a unicode object or a utf-8 string here. You passed a Python string object which contained non-utf-8: %r. The UnicodeDecodeError that resulted from attempting to interpret it as utf-8 was: %s' % (s, le,))
     return s
 
+# The same as urllib.quote(s, safe='~'), but only the characters which
+# need quoting are visited in Python code, which makes a big
+# difference for long, mostly safe strings such as URLs.
+_UNSAFE_R = re.compile(r'[^A-Za-z0-9_.~-]')
+_QUOTED = dict([(chr(i), '%%%02X' % (i,)) for i in range(256)])
+
+def _quote_char(mo):
+    return _QUOTED[mo.group()]
+
 def escape(s):
     """Escape a URL including any /."""
-    return urllib.quote(to_unicode(s).encode('utf-8'), safe='~')
+    return _UNSAFE_R.sub(_quote_char, to_unicode(s).encode('utf-8'))
 
 def normalize_parameters(params):
     items = []
@@ -37,6 +46,19 @@ def normalize_parameters(params):
     # Spaces must be encoded with "%20" instead of "+"
     return urllib.urlencode(sorted(items)).replace('+', '%20').replace('%7E', '~')
 
+def normalize_url(url):
+    """
+    Split url into the URL that is signed (its query and fragment
+    removed, its scheme and host lowercased, and the port removed if
+    it is the default for the scheme) and a dict of its query
+    parameters, which must be signed too.
+    """
+    (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+    (scheme, netloc) = (scheme.lower(), netloc.lower())
+    if (scheme, netloc[-3:]) == ('http', ':80') or (scheme, netloc[-4:]) == ('https', ':443'):
+        netloc = netloc[:netloc.rindex(':')]
+    return ('%s://%s%s' % (scheme, netloc, path), urlparse.parse_qs(query, keep_blank_values=True))
+
 def signing_base(method, url, params, secret):
     sig = [
         escape(method),
@@ -48,20 +70,75 @@ def signing_base(method, url, params, secret):
     raw = '&'.join(sig)
     return key, raw
 
-def sign_request(key, secret, method, url, params, realm):
-    params['oauth_consumer_key'] = key
-    params['oauth_signature_method'] = 'HMAC-SHA1'
+class Signer(object):
+    """
+    Signs requests with one consumer key and secret. What is the same
+    for every request is escaped just once: the signing key, with
+    which an HMAC-SHA1 object is keyed (each signature is made from a
+    copy of it), and the consumer key, signature method and version
+    in the Authorization header. Make one Signer and reuse it rather
+    than calling sign_request() for every request.
+    """
+    def __init__(self, key, secret, realm):
+        self.key = key
+        self.realm = realm
+        self._hmac = hmac.new('%s&' % escape(secret), digestmod=hashlib.sha1)
+        # (name, value) -> escaped value, for the oauth_ parameters
+        # which don't change from one request to the next.
+        self._escaped = {
+            ('oauth_consumer_key', key): escape(key),
+            ('oauth_signature_method', 'HMAC-SHA1'): 'HMAC-SHA1',
+            ('oauth_version', '1.0'): '1.0',
+            }
+
+    def signature(self, method, url, params):
+        raw = '&'.join([escape(method), escape(url), escape(normalize_parameters(params))])
+        h = self._hmac.copy()
+        h.update(raw)
+        return h.hexdigest()
 
-    key, raw = signing_base(method, url, params, secret)
+    def sign_request(self, method, url, params):
+        """ Add the oauth_ parameters, including the signature, to
+        the dict params and return the value for an Authorization
+        header. """
+        params['oauth_consumer_key'] = self.key
+        params['oauth_signature_method'] = 'HMAC-SHA1'
 
-    params['oauth_signature'] = hmac.new(key, raw, hashlib.sha1).hexdigest()
+        params['oauth_signature'] = self.signature(method, url, params)
+
+        escaped = self._escaped
+        oauth_params = ((k, escaped.get((k, v)) or escape(v)) for k, v in params.iteritems() if k.startswith('oauth_'))
+        header_params = ('%s="%s"' % (k, v) for k, v in oauth_params)
+        params_header = ', '.join(header_params)
+
+        auth_header = 'OAuth realm="%s"' % self.realm
+        if params_header:
+            auth_header = "%s, %s" % (auth_header, params_header)
+
+        return auth_header
+
+def sign_request(key, secret, method, url, params, realm):
+    return Signer(key, secret, realm).sign_request(method, url, params)
 
-    oauth_params = ((k, escape(to_unicode(v))) for k, v in params.iteritems() if k.startswith('oauth_'))
-    header_params = ('%s="%s"' % (k, v) for k, v in oauth_params)
-    params_header = ', '.join(header_params)
+# Each nonce is this many random bytes, written in hex.
+NONCE_BYTES = 16
 
-    auth_header = 'OAuth realm="%s"' % realm
-    if params_header:
-        auth_header = "%s, %s" % (auth_header, params_header)
+class NoncePool(object):
+    """
+    Hands out random nonces, reading randomness from os.urandom() for
+    batch_size nonces at a time instead of making a system call (and
+    an encoding call) for every nonce. Not thread-safe: take nonces
+    from one thread.
+    """
+    def __init__(self, batch_size=256):
+        self.batch_size = batch_size
+        self._buf = ''
+        self._pos = 0
 
-    return auth_header
+    def next(self):
+        if self._pos >= len(self._buf):
+            self._buf = binascii.hexlify(os.urandom(NONCE_BYTES * self.batch_size))
+            self._pos = 0
+        pos = self._pos
+        self._pos = pos + 2 * NONCE_BYTES
+        return self._buf[pos:self._pos]
@@ -0,0 +1,195 @@
+import cPickle, time
+
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+from pyutil.assertutil import precondition
+
+# Response bodies at least this many bytes long are decoded by the
+# Client's offloader, if it has one; smaller ones are decoded inline,
+# where handing them off would cost more than it saves.
+DEFAULT_OFFLOAD_THRESHOLD = 2 ** 16
+
+# A ProcessOffloader gives up on a call after this many seconds, in
+# case the worker process running it died.
+DEFAULT_PROCESS_TIMEOUT = 60
+
+class OffloadError(Exception):
+    """ A function run in a worker process raised an exception which
+    couldn't be sent back to this process; this carries its type and
+    message instead. """
+
+def _call_timed(f, args):
+    return (time.time(), f(*args))
+
+def _call_timed_in_process(payload):
+    """ Run in a worker process, with the function and its arguments
+    pickled by ProcessOffloader.run(). The result is pickled here and
+    exceptions are returned rather than raised, since
+    multiprocessing.Pool in Python 2 only calls back on success: if it
+    failed to pickle something, or the function raised, nothing would
+    ever fire. """
+    started = time.time()
+    try:
+        (f, args) = cPickle.loads(payload)
+        return (started, True, cPickle.dumps(f(*args), 2))
+    except Exception, e:
+        try:
+            cPickle.loads(cPickle.dumps(e, 2))
+        except Exception:
+            e = OffloadError("%s: %s" % (type(e).__name__, e))
+        return (started, False, e)
+
+class _Offloader(object):
+    """
+    Runs functions somewhere other than the reactor thread. run()
+    returns a deferred which fires, in the reactor thread, with the
+    function's result.
+
+    For monitoring, .pending is the number of calls submitted but not
+    yet finished, and .last_wait, .max_wait and mean_wait() tell how
+    many seconds calls waited for a free worker before they started.
+    """
+    def __init__(self):
+        self.pending = 0
+        self.num_started = 0
+        self.total_wait = 0.0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+
+    def mean_wait(self):
+        """ The mean number of seconds that calls spent waiting for a
+        worker. """
+        if not self.num_started:
+            return 0.0
+        return self.total_wait / self.num_started
+
+    def _started(self, submitted, started):
+        self.pending -= 1
+        wait = max(0.0, started - submitted)
+        self.num_started += 1
+        self.total_wait += wait
+        self.last_wait = wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def close(self):
+        """ Release the workers. """
+
+class ThreadOffloader(_Offloader):
+    """
+    Runs functions in a thread pool: the reactor's own thread pool
+    unless threadpool is given. This keeps the reactor responsive
+    while a large body is decoded, but since the decoding holds the
+    GIL it doesn't use more than one core.
+    """
+    def __init__(self, threadpool=None):
+        _Offloader.__init__(self)
+        self.threadpool = threadpool
+
+    def run(self, f, *args):
+        submitted = time.time()
+        self.pending += 1
+        if self.threadpool is None:
+            d = threads.deferToThread(_call_timed, f, args)
+        else:
+            d = threads.deferToThreadPool(reactor, self.threadpool, _call_timed, f, args)
+        def _done((started, result)):
+            self._started(submitted, started)
+            return result
+        def _failed(f):
+            self.pending -= 1
+            return f
+        d.addCallbacks(_done, _failed)
+        return d
+
+class ProcessOffloader(_Offloader):
+    """
+    Runs functions in a multiprocessing.Pool of worker processes (one
+    per CPU unless processes is given), so that several large bodies
+    can be decoded in parallel on several cores. The function, its
+    arguments and its result are pickled to get to and from the
+    worker, so the function must be defined at module level. Call
+    close() to stop the workers.
+
+    A call which hasn't finished timeout seconds after it was
+    submitted (None for no limit) fails with OffloadError, since a
+    worker process which dies takes the call it was running with it.
+    """
+    def __init__(self, processes=None, timeout=DEFAULT_PROCESS_TIMEOUT):
+        # Imported here since it starts a thread or two on import on
+        # some platforms, and most Clients don't need it.
+        import multiprocessing
+        precondition(processes is None or (isinstance(processes, (int, long)) and processes > 0), "processes is required to be None or a positive integer.", processes=processes)
+        precondition(timeout is None or timeout > 0, "timeout is required to be None or a positive number of seconds.", timeout=timeout)
+        _Offloader.__init__(self)
+        self.timeout = timeout
+        # Whether any call has timed out, in which case the pool may
+        # be waiting for a result which will never come.
+        self._abandoned = False
+        self._pool = multiprocessing.Pool(processes)
+
+    def run(self, f, *args):
+        submitted = time.time()
+        self.pending += 1
+        d = Deferred()
+        try:
+            # If f can't be pickled and unpickled then no worker can
+            # run it, so say so plainly here. (It is pickled by name,
+            # so this is cheap.)
+            try:
+                ok = cPickle.loads(cPickle.dumps(f, 2)) == f
+            except Exception:
+                ok = False
+            if not ok:
+                raise TypeError("%r is required to be a module-level function so that it can be pickled." % (f,))
+            # Pickled here rather than by the pool, which wouldn't
+            # call back if it failed.
+            payload = cPickle.dumps((f, args), 2)
+        except Exception:
+            self.pending -= 1
+            d.errback(Failure())
+            return d
+
+        def _done(started, ok, result):
+            if d.called:
+                # Timed out.
+                return
+            if timer is not None:
+                timer.cancel()
+            self._started(submitted, started)
+            if ok:
+                d.callback(result)
+            else:
+                d.errback(Failure(result))
+        def _callback((started, ok, result)):
+            # Called in one of the pool's threads.
+            if ok:
+                try:
+                    result = cPickle.loads(result)
+                except Exception, e:
+                    (ok, result) = (False, OffloadError("%s: %s" % (type(e).__name__, e)))
+            reactor.callFromThread(_done, started, ok, result)
+        def _timed_out():
+            self._abandoned = True
+            self.pending -= 1
+            d.errback(Failure(OffloadError("no result from the worker process within %s seconds" % (self.timeout,))))
+
+        timer = None
+        if self.timeout is not None:
+            timer = reactor.callLater(self.timeout, _timed_out)
+        try:
+            self._pool.apply_async(_call_timed_in_process, (payload,), callback=_callback)
+        except Exception:
+            if timer is not None:
+                timer.cancel()
+            self.pending -= 1
+            d.errback(Failure())
+        return d
+
+    def close(self):
+        if self._abandoned:
+            self._pool.terminate()
+        else:
+            self._pool.close()
+        self._pool.join()
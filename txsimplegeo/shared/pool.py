@@ -0,0 +1,39 @@
+from twisted.web.client import HTTPConnectionPool
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    """
+    An HTTPConnectionPool which keeps count of how many times it was
+    able to hand out an already-open persistent connection (.hits)
+    and how many times it had to open a new TCP connection instead
+    (.misses).
+
+    If .connection_observer is set when getConnection() is called,
+    then it is added as a callback to the deferred connection (it must
+    return the connection it is given) and then unset. Client uses
+    this to time how long each request waits for its connection.
+    """
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.hits = 0
+        self.misses = 0
+        self.connection_observer = None
+
+    def getConnection(self, key, endpoint):
+        misses = self.misses
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        if self.misses == misses:
+            self.hits += 1
+        observer = self.connection_observer
+        if observer is not None:
+            self.connection_observer = None
+            d.addCallback(observer)
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self.misses += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def num_cached_connections(self):
+        """ Return the number of idle persistent connections currently
+        held in the pool. """
+        return sum([len(conns) for conns in self._connections.itervalues()])
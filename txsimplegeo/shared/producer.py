@@ -0,0 +1,93 @@
+from zope.interface import implements
+
+from twisted.internet import defer, task
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
+
+from pyutil.assertutil import precondition
+
+# ChunkedProducer writes at most this many bytes to the transport at a
+# time.
+DEFAULT_CHUNK_SIZE = 2 ** 16
+
+def rechunk(pieces, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the concatenation of the strings from the iterable pieces,
+    in chunks of chunk_size bytes (except for the last one, which may
+    be shorter). Small pieces are joined together and big ones are
+    split, and no more than about one chunk is held at once.
+    """
+    precondition(isinstance(chunk_size, (int, long)) and chunk_size > 0, "chunk_size is required to be a positive integer.", chunk_size=chunk_size)
+    buf = []
+    buflen = 0
+    for piece in pieces:
+        buf.append(piece)
+        buflen += len(piece)
+        if buflen >= chunk_size:
+            s = ''.join(buf)
+            for i in xrange(0, len(s) - chunk_size + 1, chunk_size):
+                yield s[i:i+chunk_size]
+            rest = s[len(s) - len(s) % chunk_size:]
+            buf = [rest]
+            buflen = len(rest)
+    if buflen:
+        yield ''.join(buf)
+
+class ChunkedProducer(object):
+    implements(IBodyProducer)
+    """
+    An IBodyProducer which writes a request body, given as an iterable
+    of strings, in chunks of at most chunk_size bytes, so that a big
+    body never has to be in memory all at once. The iterable is only
+    advanced as fast as the transport takes the data: each chunk is
+    written from a separate iteration of a cooperative task, and the
+    task is paused whenever the transport asks us to pause. A
+    generator such as Feature.iter_json() or
+    iter_feature_collection_json() is a good source of pieces.
+
+    Pass length if the total length of the body is known in advance;
+    otherwise the body is sent with chunked transfer-encoding.
+
+    .bytes_written counts what has been written so far.
+    """
+    def __init__(self, pieces, length=UNKNOWN_LENGTH, chunk_size=DEFAULT_CHUNK_SIZE, cooperator=task):
+        self.length = length
+        self._chunks = rechunk(pieces, chunk_size)
+        self._cooperate = cooperator.cooperate
+        self._task = None
+        self.bytes_written = 0
+
+    def startProducing(self, consumer):
+        self._task = self._cooperate(self._writeloop(consumer))
+        d = self._task.whenDone()
+        def _maybe_stopped(reason):
+            if reason.check(defer.CancelledError):
+                self.stopProducing()
+            elif not reason.check(task.TaskStopped):
+                return reason
+            # IBodyProducer.startProducing's Deferred isn't supposed
+            # to fire if stopProducing is called.
+            return defer.Deferred()
+        d.addCallbacks(lambda ign: None, _maybe_stopped)
+        return d
+
+    def _writeloop(self, consumer):
+        for chunk in self._chunks:
+            consumer.write(chunk)
+            self.bytes_written += len(chunk)
+            yield None
+
+    def pauseProducing(self):
+        self._task.pause()
+
+    def resumeProducing(self):
+        self._task.resume()
+
+    def stopProducing(self):
+        if self._task is not None:
+            try:
+                self._task.stop()
+            except task.TaskDone:
+                pass
+        # Let the source of the pieces clean up now instead of whenever
+        # it is garbage collected.
+        self._chunks.close()
@@ -0,0 +1,173 @@
+import weakref
+
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+from pyutil.assertutil import precondition
+
+from retry import parse_retry_after
+
+# The response headers from which a TokenBucket learns how much of its
+# quota is left: the number of requests remaining, and when the count
+# resets, either in seconds from now or as a POSIX time.
+REMAINING_HEADER = 'X-RateLimit-Remaining'
+RESET_HEADER = 'X-RateLimit-Reset'
+
+# Reset header values bigger than this are POSIX times rather than
+# numbers of seconds.
+_EPOCH_THRESHOLD = 10 ** 9
+
+# Slack for floating-point rounding when deciding whether a whole token
+# has accumulated, so that a timer which fires on time always finds one.
+_EPSILON = 1e-9
+
+def _int_header(headers, name):
+    values = headers.getRawHeaders(name)
+    if not values:
+        return None
+    try:
+        return int(values[-1])
+    except ValueError:
+        return None
+
+class TokenBucket(object):
+    """
+    Lets requests go at most rate per second on average, with bursts
+    of at most burst (default: rate, or 1 if that is less).
+
+    acquire() returns a deferred which fires when the caller may go
+    ahead. Callers which have to wait are let go in the order they
+    called acquire(), each as soon as a token has accumulated, so
+    a burst of requests is spread out at the rate instead of all
+    going at once and all being throttled by the server.
+
+    The rate can be changed at any time with set_rate(), or learned
+    from the server's responses with update_from_response(): it is
+    lowered to spread the remaining quota evenly until the quota
+    resets (never below min_rate, default rate/100, nor above the
+    rate given here), and a 429 response with a Retry-After header
+    holds everything back until then.
+
+    For monitoring, .num_waited counts the acquire() calls which had to
+    wait and .queue_depth is the number waiting now.
+    """
+    def __init__(self, rate, burst=None, min_rate=None, clock=None):
+        precondition(rate > 0, "rate is required to be a positive number of requests per second.", rate=rate)
+        if burst is None:
+            burst = max(1, rate)
+        precondition(burst >= 1, "burst is required to be at least 1.", burst=burst)
+        if min_rate is None:
+            min_rate = rate / 100.0
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = clock.seconds()
+        self.num_waited = 0
+        self._waiters = deque()
+        self._timer = None
+
+    @property
+    def queue_depth(self):
+        return len(self._waiters)
+
+    def _refill(self):
+        now = self.clock.seconds()
+        if now > self.updated:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """ Return a deferred which fires with None when a token has
+        been taken. Cancelling it gives up the place in the queue. """
+        d = Deferred(self._cancel)
+        if self._waiters:
+            self.num_waited += 1
+            self._waiters.append(d)
+            return d
+        self._refill()
+        if self.tokens >= 1 - _EPSILON:
+            self.tokens -= 1
+            d.callback(None)
+            return d
+        self.num_waited += 1
+        self._waiters.append(d)
+        self._schedule()
+        return d
+
+    def _cancel(self, d):
+        self._waiters.remove(d)
+
+    def _schedule(self):
+        if self._timer is None and self._waiters:
+            self._timer = self.clock.callLater(max(0, (1 - self.tokens) / float(self.rate)), self._release)
+
+    def _release(self):
+        self._timer = None
+        self._refill()
+        while self._waiters and self.tokens >= 1 - _EPSILON:
+            self.tokens -= 1
+            self._waiters.popleft().callback(None)
+        self._schedule()
+
+    def _reschedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._release()
+
+    def set_rate(self, rate, burst=None):
+        """ Change the rate (and the burst size, if given) from now
+        on. """
+        precondition(rate > 0, "rate is required to be a positive number of requests per second.", rate=rate)
+        self._refill()
+        self.rate = rate
+        if burst is not None:
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+        self._reschedule()
+
+    def hold(self, seconds):
+        """ Let nothing go for the next seconds seconds. """
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+        self._reschedule()
+
+    def update_from_response(self, resp):
+        """ Adjust the rate to what the headers of the
+        twisted.web.client.Response say about the quota. """
+        now = self.clock.seconds()
+        remaining = _int_header(resp.headers, REMAINING_HEADER)
+        reset = _int_header(resp.headers, RESET_HEADER)
+        if remaining is not None and reset is not None:
+            if reset > _EPOCH_THRESHOLD:
+                reset -= now
+            if reset > 0:
+                self.set_rate(max(self.min_rate, min(self.max_rate, remaining / float(reset))))
+        if resp.code == 429:
+            values = resp.headers.getRawHeaders('retry-after')
+            if values:
+                retry_after = parse_retry_after(values[-1], now)
+                if retry_after:
+                    self.hold(retry_after)
+
+# consumer key -> the TokenBucket shared by every Client using it
+_limiters = weakref.WeakValueDictionary()
+
+def shared_limiter(key, rate, burst=None, min_rate=None, clock=None):
+    """
+    Return the TokenBucket for the OAuth consumer key, making one if
+    there isn't one already, so that every Client with the same key
+    draws on the same quota. An existing TokenBucket is returned
+    as it is; the other arguments are only used to make a new one.
+    """
+    limiter = _limiters.get(key)
+    if limiter is None:
+        limiter = _limiters[key] = TokenBucket(rate, burst, min_rate, clock)
+    return limiter
@@ -0,0 +1,118 @@
+import random
+
+from twisted.internet import error
+from twisted.python.failure import Failure
+from twisted.web._newclient import RequestTransmissionFailed, ResponseNeverReceived
+from twisted.web.http import stringToDatetime
+
+from pyutil.assertutil import precondition
+
+# Statuses which mean that the same request might well succeed if it
+# is sent again a little later.
+DEFAULT_RETRY_CODES = (429, 500, 502, 503, 504)
+
+# Connection errors after which a request is worth sending again: the
+# connection was refused, timed out or reset, or it was closed before
+# a response arrived (as happens when the server drops an idle
+# persistent connection just as we reuse it).
+DEFAULT_RETRY_ERRORS = (error.ConnectError, error.ConnectionLost, error.TimeoutError, ResponseNeverReceived, RequestTransmissionFailed)
+
+# Only requests which can safely be sent twice are retried or hedged
+# by default.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BASE_DELAY = 0.1
+DEFAULT_MAX_DELAY = 30.0
+
+def parse_retry_after(value, now):
+    """
+    Return the number of seconds from now (a POSIX time) which the
+    value of a Retry-After header asks us to wait: it is either a
+    number of seconds or an HTTP-date. Returns None if the value is
+    neither.
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, stringToDatetime(value) - now)
+    except (ValueError, IndexError, KeyError):
+        return None
+
+class RetryPolicy(object):
+    """
+    Tells a Client when to send a request again.
+
+    A request whose method is in methods is retried, up to max_retries
+    times, if it fails with one of retry_errors or gets a response
+    with one of the statuses in retry_codes. The n'th retry waits a
+    random time between 0 and min(max_delay, base_delay * 2**n)
+    seconds ("full jitter"), so that many Clients backing off at once
+    don't all come back at once. If the response has a Retry-After
+    header then the retry waits at least that long, or, if that is
+    more than max_delay, the response is given up on and returned.
+
+    If hedge_after is given then a GET (or HEAD) which has been sent
+    but hasn't had a response after that many seconds is sent a
+    second time, and whichever response comes first is used. It is
+    either a number or a function which takes the request's endpoint
+    name ('feature', 'features', ...) and returns a number of seconds,
+    or None not to hedge. To hedge at the 95th percentile of observed
+    latency, use a HistogramInstrumentation:
+
+        inst = HistogramInstrumentation()
+        policy = RetryPolicy(hedge_after=lambda name: inst.percentile('ttfb', 95, name, min_count=100))
+        client = Client(key, secret, instrumentation=inst, retry_policy=policy)
+    """
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY, retry_codes=DEFAULT_RETRY_CODES, retry_errors=DEFAULT_RETRY_ERRORS, methods=IDEMPOTENT_METHODS, hedge_after=None, random=random.random):
+        precondition(isinstance(max_retries, (int, long)) and max_retries >= 0, "max_retries is required to be a non-negative integer.", max_retries=max_retries)
+        precondition(base_delay >= 0 and max_delay >= 0, "base_delay and max_delay are required to be non-negative numbers of seconds.", base_delay=base_delay, max_delay=max_delay)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_codes = frozenset(retry_codes)
+        self.retry_errors = tuple(retry_errors)
+        self.methods = frozenset(methods)
+        self.hedge_after = hedge_after
+        self.random = random
+
+    def backoff(self, retries):
+        """ Return how many seconds to wait before the retry which
+        follows retries earlier retries. """
+        return self.random() * min(self.max_delay, self.base_delay * 2 ** retries)
+
+    def retry_delay(self, retries, result, now):
+        """
+        result is the outcome of an attempt at a request: a
+        twisted.web.client.Response or a Failure. Return the number of
+        seconds to wait before sending it again, or None if it
+        shouldn't be, given that it has already been retried retries
+        times.
+        """
+        if retries >= self.max_retries:
+            return None
+        if isinstance(result, Failure):
+            if not result.check(*self.retry_errors):
+                return None
+            return self.backoff(retries)
+        if result.code not in self.retry_codes:
+            return None
+        delay = self.backoff(retries)
+        values = result.headers.getRawHeaders('retry-after')
+        if values:
+            retry_after = parse_retry_after(values[-1], now)
+            if retry_after is not None:
+                if retry_after > self.max_delay:
+                    return None
+                delay = max(delay, retry_after)
+        return delay
+
+    def hedge_delay(self, method, name):
+        """ Return how many seconds to wait for a response before
+        sending a duplicate of a request, or None not to. """
+        if method not in ('GET', 'HEAD') or self.hedge_after is None:
+            return None
+        if callable(self.hedge_after):
+            return self.hedge_after(name)
+        return self.hedge_after
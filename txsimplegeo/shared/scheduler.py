@@ -0,0 +1,117 @@
+import heapq, itertools
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+
+from pyutil.assertutil import precondition
+
+# Lower numbers run first. Operations with equal priority run in the
+# order they were scheduled.
+DEFAULT_PRIORITY = 0
+
+class RequestScheduler(object):
+    """
+    Runs at most max_in_flight operations at a time. Operations
+    scheduled while all of the slots are taken wait in a queue ordered
+    by priority and then first-in-first-out, and are started as
+    earlier operations finish. If max_in_flight is None then there is
+    no limit and everything starts immediately.
+
+    For monitoring, .queue_depth is the number of operations waiting,
+    .in_flight is the number running, and .last_wait, .max_wait and
+    mean_wait() tell how many seconds operations spent in the queue
+    before they were started.
+    """
+    def __init__(self, max_in_flight, clock=None):
+        precondition(max_in_flight is None or (isinstance(max_in_flight, (int, long)) and max_in_flight > 0), "max_in_flight is required to be None or a positive integer.", max_in_flight=max_in_flight)
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._queue = []
+        self._counter = itertools.count()
+        self._starting = False
+
+        self.num_started = 0
+        self.total_wait = 0.0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def mean_wait(self):
+        """ The mean number of seconds that started operations spent
+        waiting in the queue. """
+        if not self.num_started:
+            return 0.0
+        return self.total_wait / self.num_started
+
+    def oldest_wait(self):
+        """ How many seconds the longest-waiting queued operation has
+        been waiting so far. """
+        if not self._queue:
+            return 0.0
+        return self.clock.seconds() - min([entry[2] for entry in self._queue])
+
+    def run(self, f, *args, **kwargs):
+        return self.schedule(DEFAULT_PRIORITY, f, *args, **kwargs)
+
+    def schedule(self, priority, f, *args, **kwargs):
+        """
+        Call f(*args, **kwargs) once a slot is free. Returns a deferred
+        which fires with the result of f (or of the deferred that f
+        returned). The slot is freed when that result is available.
+
+        Cancelling the returned deferred removes the operation from
+        the queue if it hasn't started yet, or else cancels the
+        deferred that f returned.
+        """
+        entry = [priority, self._counter.next(), self.clock.seconds(), f, args, kwargs, None]
+        def _cancel(d):
+            if entry in self._queue:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+            elif entry[6] is not None:
+                entry[6].cancel()
+        d = Deferred(_cancel)
+        entry.append(d)
+        heapq.heappush(self._queue, entry)
+        self._start_queued()
+        return d
+
+    def _start_queued(self):
+        if self._starting:
+            # Operations which finish synchronously free their slot
+            # while we are still in the loop below; the loop will
+            # pick up the freed slot, so don't recurse.
+            return
+        self._starting = True
+        try:
+            self._start_queued_loop()
+        finally:
+            self._starting = False
+
+    def _start_queued_loop(self):
+        while self._queue and (self.max_in_flight is None or self.in_flight < self.max_in_flight):
+            entry = heapq.heappop(self._queue)
+            (priority, seq, enqueued_at, f, args, kwargs, ign, d) = entry
+
+            wait = self.clock.seconds() - enqueued_at
+            self.num_started += 1
+            self.total_wait += wait
+            self.last_wait = wait
+            self.max_wait = max(self.max_wait, wait)
+
+            self.in_flight += 1
+            d2 = maybeDeferred(f, *args, **kwargs)
+            entry[6] = d2
+            d2.addBoth(self._release)
+            d2.chainDeferred(d)
+
+    def _release(self, res):
+        self.in_flight -= 1
+        self._start_queued()
+        return res
@@ -0,0 +1,260 @@
+import heapq, math
+
+from pyutil.assertutil import precondition
+
+# The mean radius of the Earth, in meters.
+EARTH_RADIUS = 6371008.8
+
+# The side of a GridIndex cell, in degrees: about 11km of latitude.
+DEFAULT_CELL_SIZE = 0.1
+
+# A feature whose bounding box covers more than this many cells is
+# kept in one list of large features, which every query checks,
+# instead of in every one of its cells.
+MAX_CELLS_PER_FEATURE = 64
+
+def distance(lat1, lon1, lat2, lon2):
+    """ The great-circle distance in meters between two points, by the
+    haversine formula. """
+    (lat1, lon1, lat2, lon2) = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+def distance_to_box(lat, lon, bbox):
+    """ The distance in meters from the point to the nearest point of
+    the (minlat, minlon, maxlat, maxlon) box: 0 if it is inside. (The
+    nearest point is found in lat/lon, which is exact enough for boxes
+    much smaller than a hemisphere.) """
+    (minlat, minlon, maxlat, maxlon) = bbox
+    return distance(lat, lon, min(max(lat, minlat), maxlat), min(max(lon, minlon), maxlon))
+
+def _distance_to_meridian(lat, dlon):
+    """ The distance in meters from a point to the meridian dlon
+    degrees east or west of it. """
+    if dlon >= 90:
+        # The nearest point of the meridian is the nearer pole.
+        return EARTH_RADIUS * math.radians(90 - abs(lat))
+    return EARTH_RADIUS * math.asin(math.cos(math.radians(lat)) * math.sin(math.radians(dlon)))
+
+def _intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+class GridIndex(object):
+    """
+    An index of Features by location, for finding the ones in a
+    bounding box or nearest to a point without looking at all of them.
+
+    The surface is divided into cells of cell_size by cell_size
+    degrees and each feature is listed in every cell which its
+    bounding box touches (very large features are listed separately;
+    see MAX_CELLS_PER_FEATURE). Inserting or removing a feature only
+    touches its own cells.
+
+    Features are looked up by key, which is their simplegeohandle
+    unless another is given to insert(). Everything is in SimpleGeo
+    (lat, lon) order, and bounding boxes are tuples of (minlat,
+    minlon, maxlat, maxlon). Boxes crossing the antimeridian aren't
+    supported. Distances are in meters, to the nearest point of each
+    feature's bounding box (so, for a Point, to the point).
+
+    A FeatureCache made with index=GridIndex() keeps the index up to
+    date with what it holds.
+    """
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        precondition(cell_size > 0, "cell_size is required to be a positive number of degrees.", cell_size=cell_size)
+        self.cell_size = float(cell_size)
+        self._cells = {} # (row, col) -> set of keys
+        self._large = set()
+        self._entries = {} # key -> (feature, bbox, cells or None)
+        self._extent = None # (minrow, mincol, maxrow, maxcol) of every cell ever used
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _cell_range(self, bbox):
+        size = self.cell_size
+        return (int(math.floor(bbox[0] / size)), int(math.floor(bbox[1] / size)), int(math.floor(bbox[2] / size)), int(math.floor(bbox[3] / size)))
+
+    def insert(self, feature, key=None):
+        """ Add the feature, replacing any feature already indexed
+        under the same key. Features without any coordinates are not
+        indexed. """
+        if key is None:
+            key = feature.id
+        precondition(key is not None, "key is required if the feature has no simplegeohandle.", feature=feature)
+        self.remove(key)
+        bbox = feature.bbox
+        if bbox is None:
+            return
+        bbox = tuple(map(float, bbox))
+        (r0, c0, r1, c1) = self._cell_range(bbox)
+        if (r1 - r0 + 1) * (c1 - c0 + 1) > MAX_CELLS_PER_FEATURE:
+            self._large.add(key)
+            self._entries[key] = (feature, bbox, None)
+            return
+        cells = [(r, c) for r in xrange(r0, r1 + 1) for c in xrange(c0, c1 + 1)]
+        for cell in cells:
+            self._cells.setdefault(cell, set()).add(key)
+        self._entries[key] = (feature, bbox, cells)
+        if self._extent is None:
+            self._extent = (r0, c0, r1, c1)
+        else:
+            (er0, ec0, er1, ec1) = self._extent
+            self._extent = (min(er0, r0), min(ec0, c0), max(er1, r1), max(ec1, c1))
+
+    def remove(self, key):
+        """ Remove the feature indexed under key, if there is one. """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        cells = entry[2]
+        if cells is None:
+            self._large.discard(key)
+            return
+        for cell in cells:
+            keys = self._cells[cell]
+            keys.discard(key)
+            if not keys:
+                del self._cells[cell]
+
+    def clear(self):
+        self._cells.clear()
+        self._large.clear()
+        self._entries.clear()
+        self._extent = None
+
+    def get(self, key):
+        """ Return the feature indexed under key, or None. """
+        entry = self._entries.get(key)
+        return entry and entry[0]
+
+    def intersecting(self, bbox):
+        """ Return a list of (key, feature) for the features whose
+        bounding boxes intersect bbox. """
+        bbox = tuple(map(float, bbox))
+        (r0, c0, r1, c1) = self._cell_range(bbox)
+        if (r1 - r0 + 1) * (c1 - c0 + 1) > len(self._cells):
+            # Quicker to look at every feature than every cell.
+            candidates = self._entries.iterkeys()
+        else:
+            candidates = set(self._large)
+            for r in xrange(r0, r1 + 1):
+                for c in xrange(c0, c1 + 1):
+                    keys = self._cells.get((r, c))
+                    if keys:
+                        candidates.update(keys)
+        result = []
+        for key in candidates:
+            (feature, fbbox, ign) = self._entries[key]
+            if _intersects(bbox, fbbox):
+                result.append((key, feature))
+        return result
+
+    def nearest(self, lat, lon, k=1, max_distance=None):
+        """
+        Return a list of up to k (distance, key, feature) tuples for
+        the features nearest to (lat, lon), nearest first, leaving out
+        any farther than max_distance meters.
+
+        Cells are searched in rings of increasing size around the
+        point's cell, stopping once no unsearched cell can be closer
+        than the k'th nearest feature found so far. If the rings would
+        come to more cells than are in use, which happens when the
+        features are sparse and far from the point, every feature is
+        looked at instead.
+        """
+        precondition(isinstance(k, (int, long)) and k > 0, "k is required to be a positive integer.", k=k)
+        if max_distance is None:
+            max_distance = float('inf')
+        # A max-heap, by way of negated distances, of the best k.
+        best = []
+        seen = set()
+        def _consider(keys):
+            for key in keys:
+                if key in seen:
+                    continue
+                seen.add(key)
+                (feature, fbbox, ign) = self._entries[key]
+                d = distance_to_box(lat, lon, fbbox)
+                if d > max_distance:
+                    continue
+                if len(best) < k:
+                    heapq.heappush(best, (-d, key, feature))
+                elif d < -best[0][0]:
+                    heapq.heapreplace(best, (-d, key, feature))
+
+        _consider(self._large)
+        if self._extent is not None:
+            size = self.cell_size
+            row = int(math.floor(lat / size))
+            col = int(math.floor(lon / size))
+            (er0, ec0, er1, ec1) = self._extent
+            # Rings nearer than this don't reach any indexed cell.
+            ring = max(0, er0 - row, row - er1, ec0 - col, col - ec1)
+            searched = 0
+            while True:
+                cells = self._ring_size(row, col, ring, self._extent)
+                if searched + cells > len(self._cells):
+                    # Quicker to look at every feature than at the
+                    # cells left.
+                    _consider(self._entries.iterkeys())
+                    break
+                searched += cells
+                for (r, c) in self._ring(row, col, ring, self._extent):
+                    keys = self._cells.get((r, c))
+                    if keys:
+                        _consider(keys)
+                if row - ring <= er0 and col - ring <= ec0 and row + ring >= er1 and col + ring >= ec1:
+                    # Every indexed cell has been searched.
+                    break
+                # The closest that anything in the next ring could be:
+                # the distance to the edge of the rings so far. The
+                # longitudes not yet searched wrap around the
+                # antimeridian, so they begin at +-180 if the rings
+                # reach past it, and once the rings span every
+                # longitude only the parallels bound them.
+                (west, east) = (max(-180, (col - ring) * size), min(180, (col + ring + 1) * size))
+                bounds = [
+                    EARTH_RADIUS * math.radians(lat - (row - ring) * size),
+                    EARTH_RADIUS * math.radians((row + ring + 1) * size - lat)]
+                if west > -180 or east < 180:
+                    bounds.append(_distance_to_meridian(lat, lon - west))
+                    bounds.append(_distance_to_meridian(lat, east - lon))
+                bound = min(bounds)
+                if bound > max_distance or (len(best) == k and bound >= -best[0][0]):
+                    break
+                ring += 1
+        return [(-negd, key, feature) for (negd, key, feature) in sorted(best, reverse=True)]
+
+    def _ring(self, row, col, ring, extent):
+        """ The cells within extent whose row and column are both
+        within ring of (row, col), and at least one of them exactly
+        ring away. """
+        (er0, ec0, er1, ec1) = extent
+        cells = []
+        (cmin, cmax) = (max(col - ring, ec0), min(col + ring, ec1))
+        for r in set([row - ring, row + ring]):
+            if er0 <= r <= er1:
+                cells.extend([(r, c) for c in xrange(cmin, cmax + 1)])
+        (rmin, rmax) = (max(row - ring + 1, er0), min(row + ring - 1, er1))
+        for c in set([col - ring, col + ring]):
+            if ec0 <= c <= ec1:
+                cells.extend([(r, c) for r in xrange(rmin, rmax + 1)])
+        return cells
+
+    def _ring_size(self, row, col, ring, extent):
+        """ The number of cells which _ring() would return. """
+        (er0, ec0, er1, ec1) = extent
+        cols = max(0, min(col + ring, ec1) - max(col - ring, ec0) + 1)
+        rows = max(0, min(row + ring - 1, er1) - max(row - ring + 1, er0) + 1)
+        n = 0
+        for r in set([row - ring, row + ring]):
+            if er0 <= r <= er1:
+                n += cols
+        for c in set([col - ring, col + ring]):
+            if ec0 <= c <= ec1:
+                n += rows
+        return n
@@ -0,0 +1,190 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.web.http_headers import Headers
+
+from txsimplegeo.shared import Client, Feature, FeatureCache
+from txsimplegeo.shared.test.test_client import EXAMPLE_POINT_BODY, FakeResponse, FakeSuccessResponse
+
+HANDLE = "SG_6sRJczWZHdzNj4qSeRzpzz_40.005274_-105.048054@1291669259"
+
+def make_feature():
+    return Feature(coordinates=(40.0, -105.0), simplegeohandle=HANDLE)
+
+class FeatureCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_get_put(self):
+        cache = FeatureCache(clock=self.clock)
+        f = make_feature()
+        self.failUnlessIdentical(cache.get(HANDLE), None)
+        cache.put(HANDLE, f)
+        self.failUnlessIdentical(cache.get(HANDLE), f)
+        self.failUnless(HANDLE in cache)
+        self.failUnlessEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        cache = FeatureCache(maxsize=2, clock=self.clock)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.failUnlessEqual(len(cache), 2)
+        self.failUnlessEqual(cache.get('b'), None)
+        self.failUnlessEqual(cache.get('a'), 1)
+        self.failUnlessEqual(cache.get('c'), 3)
+        self.failUnlessEqual(cache.evictions, 1)
+
+    def test_ttl(self):
+        cache = FeatureCache(ttl=10, clock=self.clock)
+        cache.put('a', 1)
+        self.clock.advance(9)
+        self.failUnlessEqual(cache.get('a'), 1)
+        self.clock.advance(1)
+        self.failUnlessEqual(cache.get('a'), None)
+        # The stale entry is still available, e.g. for revalidation.
+        self.failUnlessEqual(cache.get_entry('a').feature, 1)
+
+    def test_no_ttl(self):
+        cache = FeatureCache(ttl=None, clock=self.clock)
+        cache.put('a', 1)
+        self.clock.advance(10**9)
+        self.failUnlessEqual(cache.get('a'), 1)
+
+    def test_invalidate(self):
+        cache = FeatureCache(clock=self.clock)
+        cache.put('a', 1)
+        cache.invalidate('a')
+        cache.invalidate('never there')
+        self.failUnlessEqual(cache.get('a'), None)
+        self.failUnlessEqual(len(cache), 0)
+
+class CountingAgent(object):
+    def __init__(self, respfactory):
+        self.respfactory = respfactory
+        self.requests = []
+        self.headers = []
+
+    def request(self, method, endpoint, headers=None, bodyProducer=None):
+        d = defer.Deferred()
+        self.requests.append(d)
+        self.headers.append(headers)
+        return d
+
+    def respond_all(self):
+        requests, self.requests = self.requests, []
+        for d in requests:
+            d.callback(self.respfactory())
+
+def point_response():
+    return FakeSuccessResponse([EXAMPLE_POINT_BODY], Headers({'etag': ['"v1"'], 'last-modified': ['Mon, 06 Dec 2010 21:00:59 GMT']}))
+
+class NotModifiedResponse(FakeResponse):
+    def __init__(self, headers):
+        FakeResponse.__init__(self, [], headers, code=304)
+
+    def deliverBody(self, consumer):
+        raise AssertionError("A 304 response has no body to read.")
+
+class ClientCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = Client('key', 'secret', cache=FeatureCache(ttl=60, clock=self.clock))
+        self.agent = self.client.agent = CountingAgent(point_response)
+
+    def test_cache_hit_skips_request(self):
+        d = self.client.get_feature(HANDLE)
+        self.agent.respond_all()
+        def _again(f1):
+            d2 = self.client.get_feature(HANDLE)
+            self.failUnlessEqual(self.agent.requests, [])
+            d2.addCallback(self.failUnlessIdentical, f1)
+            return d2
+        d.addCallback(_again)
+        return d
+
+    def test_concurrent_callers_share_request(self):
+        ds = [self.client.get_feature(HANDLE) for i in range(100)]
+        self.failUnlessEqual(len(self.agent.requests), 1)
+        self.agent.respond_all()
+        d = defer.gatherResults(ds)
+        def _check(features):
+            for f in features:
+                self.failUnlessIdentical(f, features[0])
+        d.addCallback(_check)
+        return d
+
+    def test_concurrent_callers_share_failure(self):
+        self.agent.respfactory = lambda: FakeResponse('', Headers(), code=500)
+        ds = [self.client.get_feature(HANDLE) for i in range(3)]
+        self.agent.respond_all()
+        self.failUnlessEqual(len(self.client.cache), 0)
+        return defer.gatherResults([self.failUnlessFailure(d, FakeResponse) for d in ds])
+
+    def test_expired_entry_is_refetched(self):
+        d = self.client.get_feature(HANDLE)
+        self.agent.respond_all()
+        def _later(ign):
+            self.clock.advance(61)
+            self.client.get_feature(HANDLE)
+            self.failUnlessEqual(len(self.agent.requests), 1)
+        d.addCallback(_later)
+        return d
+
+    def test_invalidate(self):
+        d = self.client.get_feature(HANDLE)
+        self.agent.respond_all()
+        def _invalidate(ign):
+            self.client.invalidate(HANDLE)
+            self.client.get_feature(HANDLE)
+            self.failUnlessEqual(len(self.agent.requests), 1)
+        d.addCallback(_invalidate)
+        return d
+
+    def test_invalidate_while_in_flight(self):
+        d = self.client.get_feature(HANDLE)
+        self.client.invalidate(HANDLE)
+        self.agent.respond_all()
+        d.addCallback(lambda ign: self.failIf(HANDLE in self.client.cache))
+        return d
+
+    def test_stale_entry_is_revalidated(self):
+        d = self.client.get_feature(HANDLE)
+        self.failIf(self.agent.headers[0].hasHeader('If-None-Match'))
+        self.agent.respond_all()
+        def _later(f1):
+            self.clock.advance(61)
+            self.agent.respfactory = lambda: NotModifiedResponse(Headers())
+            d2 = self.client.get_feature(HANDLE)
+            headers = self.agent.headers[-1]
+            self.failUnlessEqual(headers.getRawHeaders('If-None-Match'), ['"v1"'])
+            self.failUnlessEqual(headers.getRawHeaders('If-Modified-Since'), ['Mon, 06 Dec 2010 21:00:59 GMT'])
+            self.agent.respond_all()
+            d2.addCallback(self.failUnlessIdentical, f1)
+            def _fresh_again(ign):
+                # The 304 restarted the entry's ttl.
+                self.client.get_feature(HANDLE)
+                self.failUnlessEqual(self.agent.requests, [])
+                self.failUnlessEqual(self.client.cache.get_entry(HANDLE).etag, '"v1"')
+            d2.addCallback(_fresh_again)
+            return d2
+        d.addCallback(_later)
+        return d
+
+    def test_changed_entry_is_replaced(self):
+        d = self.client.get_feature(HANDLE)
+        self.agent.respond_all()
+        def _later(f1):
+            self.clock.advance(61)
+            self.agent.respfactory = lambda: FakeSuccessResponse([EXAMPLE_POINT_BODY], Headers({'etag': ['"v2"']}))
+            d2 = self.client.get_feature(HANDLE)
+            self.agent.respond_all()
+            def _check(f2):
+                self.failIfIdentical(f2, f1)
+                entry = self.client.cache.get_entry(HANDLE)
+                self.failUnlessEqual(entry.etag, '"v2"')
+                self.failUnlessEqual(entry.last_modified, None)
+            d2.addCallback(_check)
+            return d2
+        d.addCallback(_later)
+        return d
@@ -0,0 +1,155 @@
+from twisted.trial import unittest
+from twisted.internet import defer, error, task
+
+from txsimplegeo.shared import CircuitBreaker, CircuitOpenError, Client, Feature, FeatureCache
+from txsimplegeo.shared.circuit import CLOSED, HALF_OPEN, OPEN
+from txsimplegeo.shared.test.test_client import EXAMPLE_BODY, FakeResponse, FakeSuccessResponse
+from txsimplegeo.shared.test.test_retry import ScriptedAgent
+
+HANDLE = "SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970"
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.breaker = CircuitBreaker(failure_rate=0.5, window=4, min_requests=4, reset_timeout=10, probes=2, clock=self.clock)
+
+    def _report(self, failures):
+        for failed in failures:
+            token = self.breaker.allow()
+            self.failUnless(token)
+            if failed:
+                self.breaker.record_failure(token)
+            else:
+                self.breaker.record_success(token)
+
+    def test_opens_at_failure_rate(self):
+        self._report([True, False, False])
+        self.failUnlessEqual(self.breaker.state, CLOSED)
+        self._report([True])
+        self.failUnlessEqual(self.breaker.state, OPEN)
+        self.failIf(self.breaker.allow())
+        self.failUnlessEqual(self.breaker.times_opened, 1)
+
+    def test_window_slides(self):
+        self._report([True, False, False, False, False, True])
+        self.failUnlessEqual(self.breaker.state, CLOSED)
+
+    def test_half_open_probes(self):
+        self._report([True] * 4)
+        self.clock.advance(9)
+        self.failIf(self.breaker.allow())
+        self.clock.advance(1)
+        first = self.breaker.allow()
+        self.failUnless(first)
+        self.failUnlessEqual(self.breaker.state, HALF_OPEN)
+        second = self.breaker.allow()
+        self.failUnless(second)
+        # Only two probes at once.
+        self.failIf(self.breaker.allow())
+        self.breaker.record_success(first)
+        self.failUnlessEqual(self.breaker.state, HALF_OPEN)
+        # A probe only counts once.
+        self.breaker.record_success(first)
+        self.failUnlessEqual(self.breaker.state, HALF_OPEN)
+        self.breaker.record_success(second)
+        self.failUnlessEqual(self.breaker.state, CLOSED)
+
+    def test_failed_probe_reopens(self):
+        self._report([True] * 4)
+        self.clock.advance(10)
+        self.breaker.record_failure(self.breaker.allow())
+        self.failUnlessEqual(self.breaker.state, OPEN)
+        self.failUnlessEqual(self.breaker.times_opened, 2)
+        self.clock.advance(5)
+        self.failIf(self.breaker.allow())
+
+    def test_ignored_probe_frees_slot(self):
+        self._report([True] * 4)
+        self.clock.advance(10)
+        probe = self.breaker.allow()
+        self.failUnless(probe)
+        self.failUnless(self.breaker.allow())
+        self.breaker.record_ignored(probe)
+        self.failUnless(self.breaker.allow())
+
+    def test_only_probes_count_when_half_open(self):
+        # Requests let through while the breaker was closed are
+        # answered after it has opened and become half-open.
+        late = [self.breaker.allow() for i in range(3)]
+        self._report([True] * 4)
+        self.failUnlessEqual(self.breaker.state, OPEN)
+        self.clock.advance(10)
+        probe = self.breaker.allow()
+        self.failUnlessEqual(self.breaker.state, HALF_OPEN)
+        self.breaker.record_success(late[0])
+        self.breaker.record_success(late[1])
+        self.failUnlessEqual(self.breaker.state, HALF_OPEN)
+        self.breaker.record_failure(late[2])
+        self.failUnlessEqual(self.breaker.state, HALF_OPEN)
+        self.breaker.record_failure(probe)
+        self.failUnlessEqual(self.breaker.state, OPEN)
+
+    def test_stale_probe_does_not_count(self):
+        self._report([True] * 4)
+        self.clock.advance(10)
+        stale = self.breaker.allow()
+        self.breaker.record_failure(self.breaker.allow())
+        self.failUnlessEqual(self.breaker.state, OPEN)
+        self.clock.advance(10)
+        probes = [self.breaker.allow(), self.breaker.allow()]
+        self.breaker.record_success(stale)
+        self.breaker.record_success(probes[0])
+        self.failUnlessEqual(self.breaker.state, HALF_OPEN)
+        self.breaker.record_success(probes[1])
+        self.failUnlessEqual(self.breaker.state, CLOSED)
+
+class ClientCircuitTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = Client('key', 'secret', circuit_breaker=lambda: CircuitBreaker(window=2, min_requests=2, clock=self.clock))
+
+    def test_circuit_states(self):
+        self.failUnlessEqual(self.client.circuit_states(), dict([(name, CLOSED) for name in Client.endpoints]))
+        self.failUnlessEqual(Client('key', 'secret').circuit_states(), {})
+
+    def test_fails_fast_when_open(self):
+        self.client.agent = ScriptedAgent([FakeResponse([], {}, 503), error.ConnectionRefusedError()])
+        d = defer.DeferredList([self.client.get_feature(HANDLE) for i in range(2)], consumeErrors=True)
+        def _opened(ign):
+            self.failUnlessEqual(self.client.circuit_states()['feature'], OPEN)
+            return self.failUnlessFailure(self.client.get_feature(HANDLE), CircuitOpenError)
+        d.addCallback(_opened)
+        def _check(e):
+            self.failUnlessEqual(e.name, 'feature')
+            self.failUnlessEqual(len(self.client.agent.requests), 2)
+        d.addCallback(_check)
+        return d
+
+    def test_not_found_is_not_a_failure(self):
+        self.client.agent = ScriptedAgent([FakeResponse([], {}, 404)] * 2)
+        d = defer.DeferredList([self.client.get_feature(HANDLE) for i in range(2)], consumeErrors=True)
+        d.addCallback(lambda ign: self.failUnlessEqual(self.client.circuit_states()['feature'], CLOSED))
+        return d
+
+    def test_serve_stale(self):
+        cache = FeatureCache(ttl=10, clock=self.clock)
+        client = Client('key', 'secret', cache=cache, circuit_breaker=lambda: CircuitBreaker(window=2, min_requests=2, clock=self.clock), serve_stale=True)
+        stale = Feature.from_json(EXAMPLE_BODY)
+        cache.put(HANDLE, stale)
+        self.clock.advance(11)
+        for i in range(2):
+            client.circuits['feature'].record_failure()
+        client.agent = ScriptedAgent([])
+        d = client.get_feature(HANDLE)
+        d.addCallback(self.failUnlessIdentical, stale)
+        return d
+
+    def test_probe_closes(self):
+        breaker = self.client.circuits['feature']
+        for i in range(2):
+            breaker.record_failure()
+        self.clock.advance(breaker.reset_timeout)
+        self.client.agent = ScriptedAgent([FakeSuccessResponse([EXAMPLE_BODY], {})])
+        d = self.client.get_feature(HANDLE)
+        d.addCallback(lambda f: self.failUnlessEqual(self.client.circuit_states()['feature'], CLOSED))
+        return d
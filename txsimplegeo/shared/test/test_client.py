@@ -1,10 +1,14 @@
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.web.client import Response, ResponseDone
 from twisted.web.http import PotentialDataLoss
+from twisted.python.failure import Failure
 
 from pyutil import jsonutil as json
-from txsimplegeo.shared import BodyCollector, Client, DecodeError, Feature, StringProducer, get_body
+from txsimplegeo.shared import APIError, BodyCollector, Client, DecodeError, Feature, FeatureCollector, FEATURES_URL_R, LazyFeature, StringProducer, get_body, get_feature_from_body, json_decode
+
+from txsimplegeo.shared import oauth
+from txsimplegeo.shared.geometry import CompactCoordinates
 
 from decimal import Decimal as D
 
@@ -29,6 +33,18 @@ class DecodeErrorTest(unittest.TestCase):
         self.failUnless("Could not decode JSON" in e.msg, repr(e.msg))
         self.failUnless('JSONDecodeError' in repr(e), repr(e))
 
+class JSONDecodeTest(unittest.TestCase):
+    def test_use_decimal(self):
+        self.failUnlessEqual(json_decode('[1.5, 2]'), [D('1.5'), 2])
+        self.failUnlessEqual(type(json_decode('[1.5, 2]')[0]), D)
+
+        res = json_decode('[1.5, 2]', use_decimal=False)
+        self.failUnlessEqual(res, [1.5, 2])
+        self.failUnlessEqual(type(res[0]), float)
+
+    def test_bad_json(self):
+        self.failUnlessRaises(DecodeError, json_decode, '[1.5', use_decimal=False)
+
 class FakeResponse(Response):
     def __init__(self, respchunks, headers, code):
         self.respchunks = respchunks
@@ -70,12 +86,70 @@ class MockAgent(object):
     def __init__(self, fakeresp):
         self.fakeresp = fakeresp
 
-    def request(self, method, endpoint, bodyProducer):
+    def request(self, method, endpoint, headers=None, bodyProducer=None):
         self.method = method
         self.endpoint = endpoint
+        self.headers = headers
         self.bodyProducer = bodyProducer
         return defer.succeed(self.fakeresp)
 
+def make_point_feature_dict(simplegeohandle):
+    return { 'geometry' : { 'type' : 'Point', 'coordinates' : [D('-105.048054'), D('40.005274')] }, 'id' : simplegeohandle, 'type' : 'Feature', 'properties' : { 'name' : simplegeohandle } }
+
+class MockFeaturesAgent(object):
+    """ Answers each request for the comma-separated features endpoint
+    with a FeatureCollection containing every requested feature
+    except those in self.missing. """
+    def __init__(self, missing=()):
+        self.missing = missing
+        self.endpoints = []
+
+    def request(self, method, endpoint, headers=None, bodyProducer=None):
+        self.endpoints.append(endpoint)
+        mo = FEATURES_URL_R.match(endpoint)
+        handles = [h for h in mo.group(2).split(',') if h not in self.missing]
+        body = json.dumps({ 'type': 'FeatureCollection', 'features': [make_point_feature_dict(h) for h in handles] })
+        return defer.succeed(FakeSuccessResponse([body], {'status': '200', 'content-type': 'application/json'}))
+
+class BodyConsumer(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, bytes):
+        self.writes.append(bytes)
+
+class MockAddAgent(object):
+    """ Reads each request body (a FeatureCollection) and answers
+    with a result for each feature: its simplegeohandle, made from its
+    record_id, or an error if its record_id is in self.rejected. """
+    def __init__(self, rejected=(), code=200):
+        self.rejected = rejected
+        self.code = code
+        self.endpoints = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def request(self, method, endpoint, headers=None, bodyProducer=None):
+        self.endpoints.append((method, endpoint))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        consumer = BodyConsumer()
+        d = bodyProducer.startProducing(consumer)
+        def _respond(ign):
+            self.in_flight -= 1
+            results = []
+            for feature in json.loads(''.join(consumer.writes))['features']:
+                record_id = feature['properties']['record_id']
+                if record_id in self.rejected:
+                    results.append({ 'code': 400, 'message': 'rejected' })
+                else:
+                    results.append({ 'id': 'SG_%022d' % (int(record_id),) })
+            if self.code != 200:
+                return FakeResponse([], {}, self.code)
+            return FakeSuccessResponse([json.dumps({ 'features': results })], {'content-type': 'application/json'})
+        d.addCallback(_respond)
+        return d
+
 class StringProducerTest(unittest.TestCase):
     def test_string_producer(self):
         sp = StringProducer('abc')
@@ -103,6 +177,14 @@ class BodyCollectorTest(unittest.TestCase):
         d.addCallback(_check)
         return d
 
+    def test_body_collector_accepts_failure(self):
+        bc = BodyCollector()
+        d = bc.start()
+        bc.dataReceived('a')
+        bc.connectionLost(Failure(ResponseDone()))
+        d.addCallback(lambda res: self.failUnlessEqual(res.bytes, 'a'))
+        return d
+
     def test_body_collector_errs_on_PotentialDataLoss(self):
         bc = BodyCollector()
         d = bc.start()
@@ -136,6 +218,32 @@ class BodyCollectorTest(unittest.TestCase):
         d2 = self.failUnlessFailure(d, Exception)
         return d2
 
+class FeatureCollectorTest(unittest.TestCase):
+    def test_collects_feature(self):
+        fc = FeatureCollector()
+        d = fc.start()
+        for i in range(0, len(EXAMPLE_BODY), 10):
+            fc.dataReceived(EXAMPLE_BODY[i:i+10])
+        fc.connectionLost(Failure(ResponseDone()))
+        def _check(res):
+            self.failUnless(isinstance(res, Feature), res)
+            self.failUnlessEqual(res.id, 'SG_4b10i9vCyPnKAYiYBLKZN7')
+            self.failUnlessEqual(res.coordinates[0][0], (D('33.4041157'), D('-86.3672637')))
+        d.addCallback(_check)
+        return d
+
+    def test_bad_json(self):
+        d = get_feature_from_body(FakeSuccessResponse([EXAMPLE_BODY, 'some crap'], {}))
+        return self.failUnlessFailure(d, DecodeError)
+
+    def test_truncated_json(self):
+        d = get_feature_from_body(FakeSuccessResponse([EXAMPLE_BODY[:-20]], {}))
+        return self.failUnlessFailure(d, DecodeError)
+
+    def test_errs_on_PDL(self):
+        d = get_feature_from_body(FakePotentialDataLossResponse([EXAMPLE_BODY], {}, 200))
+        return self.failUnlessFailure(d, PotentialDataLoss)
+
 class ClientTest(unittest.TestCase):
     def setUp(self):
         self.client = Client(MY_OAUTH_KEY, MY_OAUTH_SECRET, API_VERSION, API_HOST, API_PORT)
@@ -151,6 +259,7 @@ class ClientTest(unittest.TestCase):
     def test_get_point_feature(self):
         mockagent = MockAgent(FakeSuccessResponse([EXAMPLE_POINT_BODY], {'status': '200', 'content-type': 'application/json', 'thingie': "just to see if you're listening"}))
         self.client.agent = mockagent
+        self.client.debug = True
 
         d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970")
         def check_res(res):
@@ -177,9 +286,100 @@ class ClientTest(unittest.TestCase):
         d.addCallback(check_res)
         return d
 
+    def test_get_feature_streaming_decode(self):
+        self.client.streaming_decode = True
+        self.client.agent = MockAgent(FakeSuccessResponse(list(EXAMPLE_BODY), {'status': '200', 'content-type': 'application/json'}))
+
+        d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970")
+        def check_res(res):
+            self.failUnless(isinstance(res, Feature), (repr(res), type(res)))
+            self.failUnlessEqual(res.to_dict(), Feature.from_json(EXAMPLE_BODY).to_dict())
+        d.addCallback(check_res)
+        return d
+
+    def test_get_feature_floats(self):
+        self.client.use_decimal = False
+        self.client.agent = MockAgent(FakeSuccessResponse([EXAMPLE_BODY], {'status': '200', 'content-type': 'application/json'}))
+
+        d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970")
+        def check_res(res):
+            self.failUnlessEqual(res.coordinates[0][0], (33.4041157, -86.3672637))
+            self.failUnlessEqual(type(res.coordinates[0][0][0]), float)
+        d.addCallback(check_res)
+        return d
+
+    def test_get_feature_streaming_floats(self):
+        self.client.streaming_decode = True
+        self.client.agent = MockAgent(FakeSuccessResponse([EXAMPLE_BODY], {'status': '200', 'content-type': 'application/json'}))
+
+        d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970", use_decimal=False)
+        d.addCallback(lambda res: self.failUnlessEqual(type(res.coordinates[0][0][0]), float))
+        return d
+
+    def test_get_feature_compact(self):
+        self.client.compact_coordinates = True
+        self.client.agent = MockAgent(FakeSuccessResponse([EXAMPLE_BODY], {'status': '200', 'content-type': 'application/json'}))
+
+        d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970")
+        def check_res(res):
+            self.failUnless(isinstance(res.coordinates, CompactCoordinates), res.coordinates)
+            self.failUnlessEqual(res.coordinates[0][0], (33.4041157, -86.3672637))
+        d.addCallback(check_res)
+        return d
+
+    def test_get_feature_lazy(self):
+        self.client.lazy_geometry = True
+        self.client.streaming_decode = True
+        self.client.agent = MockAgent(FakeSuccessResponse([EXAMPLE_BODY], {'status': '200', 'content-type': 'application/json'}))
+
+        d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970")
+        def check_res(res):
+            self.failUnless(isinstance(res, LazyFeature), (repr(res), type(res)))
+            self.failIf(res.is_materialized())
+            self.failUnlessEqual(res.to_dict(), Feature.from_json(EXAMPLE_BODY).to_dict())
+        d.addCallback(check_res)
+        return d
+
+    def test_get_features_floats(self):
+        self.client.agent = MockFeaturesAgent()
+        handle = 'SG_%022d' % 1
+
+        d = self.client.get_features([handle], use_decimal=False)
+        d.addCallback(lambda res: self.failUnlessEqual(type(res[handle].coordinates[0]), float))
+        return d
+
     def test_type_check_request(self):
         self.failUnlessRaises(TypeError, self.client._request, 'whatever', 'POST', {'bogus': "non string"})
 
+    def _check_signed(self, headers, endpoint):
+        (auth_header,) = headers.getRawHeaders('Authorization')
+        self.failUnless(auth_header.startswith('OAuth realm="http://api.simplegeo.com", '), auth_header)
+        params = dict([p.split('=', 1) for p in auth_header[len('OAuth '):].split(', ')])
+        params = dict([(k, v.strip('"')) for (k, v) in params.items()])
+        self.failUnlessEqual(params['oauth_consumer_key'], MY_OAUTH_KEY)
+        self.failUnlessEqual(params['oauth_timestamp'], '1291669259')
+        signature = params.pop('oauth_signature')
+        del params['realm']
+        self.failUnlessEqual(signature, oauth.Signer(MY_OAUTH_KEY, MY_OAUTH_SECRET, 'r').signature('GET', oauth.normalize_url(endpoint)[0], params))
+        self.failUnlessEqual(headers.getRawHeaders('User-Agent'), [self.client.user_agent])
+
+    def test_request_is_signed(self):
+        clock = self.client.clock = task.Clock()
+        clock.advance(1291669259.5)
+        mockagent = self.client.agent = MockAgent(FakeSuccessResponse([EXAMPLE_POINT_BODY], {}))
+        d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970")
+        d.addCallback(lambda ign: self._check_signed(mockagent.headers, mockagent.endpoint))
+        return d
+
+    def test_sign_in_thread(self):
+        clock = self.client.clock = task.Clock()
+        clock.advance(1291669259)
+        self.client.sign_in_thread = True
+        mockagent = self.client.agent = MockAgent(FakeSuccessResponse([EXAMPLE_POINT_BODY], {}))
+        d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970")
+        d.addCallback(lambda ign: self._check_signed(mockagent.headers, mockagent.endpoint))
+        return d
+
     def test_get_feature_bad_json(self):
         mockagent = MockAgent(FakeSuccessResponse([EXAMPLE_BODY, 'some crap'], {'status': '200', 'content-type': 'application/json'}))
         self.client.agent = mockagent
@@ -241,6 +441,135 @@ class ClientTest(unittest.TestCase):
         d.addCallback(after_error)
         return d
 
+    def test_get_features_chunks_requests(self):
+        mockagent = MockFeaturesAgent()
+        self.client.agent = mockagent
+        handles = ['SG_%022d' % i for i in range(5)]
+
+        d = self.client.get_features(handles + [handles[0]], chunk_size=2)
+        def check_res(res):
+            self.failUnlessEqual(len(mockagent.endpoints), 3)
+            self.failUnlessEqual(mockagent.endpoints[0], 'http://api.simplegeo.com:80/%s/features/%s,%s.json' % (API_VERSION, handles[0], handles[1]))
+            self.failUnlessEqual(sorted(res.keys()), handles)
+            for h in handles:
+                self.failUnless(isinstance(res[h], Feature), (h, res[h]))
+                self.failUnlessEqual(res[h].id, h)
+                self.failUnlessEqual(res[h].properties['name'], h)
+        d.addCallback(check_res)
+        return d
+
+    def test_get_features_default_chunk_size(self):
+        mockagent = MockFeaturesAgent()
+        self.client.agent = mockagent
+        self.client.features_chunk_size = 3
+        handles = ['SG_%022d' % i for i in range(7)]
+
+        d = self.client.get_features(handles)
+        def check_res(res):
+            self.failUnlessEqual(len(mockagent.endpoints), 3)
+            self.failUnlessEqual(len(res), 7)
+        d.addCallback(check_res)
+        return d
+
+    def test_get_features_matches_long_handles(self):
+        self.client.agent = MockFeaturesAgent()
+        handle = "SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970"
+        mo = FEATURES_URL_R.match('http://api.simplegeo.com:80/1.0/features/%s.json' % (handle,))
+        self.failUnlessEqual(mo.group(2), handle)
+
+        d = self.client.get_features([handle])
+        d.addCallback(lambda res: self.failUnlessEqual(res[handle].id, handle))
+        return d
+
+    def test_get_features_missing_handle(self):
+        handles = ['SG_%022d' % i for i in range(3)]
+        self.client.agent = MockFeaturesAgent(missing=[handles[1]])
+
+        d = self.client.get_features(handles)
+        def check_res(res):
+            self.failUnless(isinstance(res[handles[0]], Feature))
+            self.failUnless(isinstance(res[handles[2]], Feature))
+            self.failUnless(res[handles[1]].check(APIError))
+            self.failUnlessEqual(res[handles[1]].value.code, 404)
+        d.addCallback(check_res)
+        return d
+
+    def test_get_features_error(self):
+        fakeresp = FakeResponse('{"message": "help my web server is confuzzled"}', {'status': '500', 'content-type': 'application/json'}, code=500)
+        self.client.agent = MockAgent(fakeresp)
+        handles = ['SG_%022d' % i for i in range(3)]
+
+        d = self.client.get_features(handles)
+        def check_res(res):
+            self.failUnlessEqual(sorted(res.keys()), handles)
+            for h in handles:
+                self.failUnless(res[h].check(FakeResponse))
+                self.failUnlessEqual(res[h].value.code, 500)
+        d.addCallback(check_res)
+        return d
+
+class AddFeaturesTest(unittest.TestCase):
+    def setUp(self):
+        self.client = Client(MY_OAUTH_KEY, MY_OAUTH_SECRET, API_VERSION, API_HOST, API_PORT)
+        self.pulled = 0
+
+    def _features(self, n):
+        for i in range(n):
+            self.pulled += 1
+            yield Feature((D('40.0'), D('-105.0')), properties={'record_id': str(i)})
+
+    def test_add_features(self):
+        agent = self.client.agent = MockAddAgent(rejected=('3',))
+        results = {}
+        def on_result(feature, result):
+            results[feature.properties['record_id']] = result
+
+        d = self.client.add_features(self._features(25), on_result, batch_size=10, max_batches_in_flight=2)
+        # Only the first two batches have been taken from the iterator.
+        self.failUnlessEqual(self.pulled, 20)
+        def check_res(counts):
+            self.failUnlessEqual(counts, { 'added': 24, 'failed': 1 })
+            self.failUnlessEqual(len(agent.endpoints), 3)
+            self.failUnlessEqual(agent.endpoints[0], ('POST', 'http://api.simplegeo.com:80/%s/places.json' % (API_VERSION,)))
+            self.failUnlessEqual(agent.max_in_flight, 2)
+            self.failUnlessEqual(results['7'], 'SG_%022d' % 7)
+            self.failUnless(results['3'].check(APIError))
+            self.failUnlessEqual(results['3'].value.code, 400)
+        d.addCallback(check_res)
+        return d
+
+    def test_add_features_empty(self):
+        d = self.client.add_features([])
+        d.addCallback(self.failUnlessEqual, { 'added': 0, 'failed': 0 })
+        return d
+
+    def test_add_features_error(self):
+        self.client.agent = MockAddAgent(code=500)
+        results = []
+        d = self.client.add_features(self._features(3), lambda feature, result: results.append(result))
+        def check_res(counts):
+            self.failUnlessEqual(counts, { 'added': 0, 'failed': 3 })
+            self.failUnless(results[0].check(FakeResponse))
+        d.addCallback(check_res)
+        return d
+
+    def test_add_features_on_result_raises(self):
+        self.client.agent = MockAddAgent()
+        def on_result(feature, result):
+            raise SomeException()
+        d = self.client.add_features(self._features(30), on_result, batch_size=10, max_batches_in_flight=1)
+        def check_res(ign):
+            self.failUnlessEqual(self.pulled, 10)
+        d = self.failUnlessFailure(d, SomeException)
+        d.addCallback(check_res)
+        return d
+
+    def test_match_added_mismatch(self):
+        self.client.agent = MockAgent(FakeSuccessResponse([json.dumps({ 'features': [] })], {}))
+        d = self.client.add_features(self._features(2))
+        d.addCallback(self.failUnlessEqual, { 'added': 0, 'failed': 2 })
+        return d
+
 EXAMPLE_POINT_BODY="""
 {"geometry":{"type":"Point","coordinates":[-105.048054,40.005274]},"type":"Feature","id":"SG_6sRJczWZHdzNj4qSeRzpzz_40.005274_-105.048054@1291669259","properties":{"province":"CO","city":"Erie","name":"CMD Colorado Inc","tags":["sandwich"],"country":"US","phone":"+1 303 664 9448","address":"305 Baron Ct","owner":"simplegeo","classifiers":[{"category":"Restaurants","type":"Food & Drink","subcategory":""}],"postcode":"80516"}}
 """
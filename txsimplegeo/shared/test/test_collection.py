@@ -0,0 +1,100 @@
+import unittest
+
+from pyutil import jsonutil as json
+
+from txsimplegeo.shared import DecodeError, Feature, FeatureCollection, SlimFeature, iter_feature_collection_json
+from txsimplegeo.shared.geometry import CompactCoordinates
+
+HANDLE1 = 'SG_4bgzicKFmP89tQFGLGZYy0_37.759300_-122.418800'
+HANDLE2 = 'SG_2M3ewUyVWRvJhTKmRzV5sq_37.780000_-122.400000'
+
+POLYGON = [[(0.0, 100.0), (0.0, 101.0), (1.0, 101.0), (1.0, 100.0), (0.0, 100.0)], [(0.2, 100.2), (0.2, 100.8), (0.8, 100.8), (0.8, 100.2), (0.2, 100.2)]]
+
+def make_features():
+    return [
+        Feature((37.7593, -122.4188), simplegeohandle=HANDLE1, properties={'name': 'a', 'category': 'Food', 'rank': 1, 'open': True}),
+        Feature(POLYGON, geomtype='Polygon', simplegeohandle=HANDLE2, properties={'name': 'b', 'category': 'Food', 'rank': 2, 'tags': ['x']}),
+        Feature([(1.0, 2.0), (3.0, 4.0)], geomtype='LineString'),
+        ]
+
+class SlimFeatureTest(unittest.TestCase):
+    def test_is_a_feature(self):
+        props = {'name': 'a'}
+        f = SlimFeature((37.7593, -122.4188), simplegeohandle=HANDLE1, properties=props)
+        self.failUnless(isinstance(f, Feature))
+        self.failUnless(f.properties is props)
+        self.failUnlessEqual(f.bbox, (37.7593, -122.4188, 37.7593, -122.4188))
+        self.failUnlessEqual(f.to_dict(), Feature((37.7593, -122.4188), simplegeohandle=HANDLE1, properties=props).to_dict())
+        f.coordinates = (1.0, 2.0)
+        self.failUnlessEqual(f.centroid, (1.0, 2.0))
+
+    def test_no_properties(self):
+        self.failUnlessEqual(SlimFeature((1.0, 2.0)).properties, {})
+
+    def test_feature_copies_properties(self):
+        props = {'name': 'a'}
+        self.failIf(Feature((1.0, 2.0), properties=props).properties is props)
+
+class FeatureCollectionTest(unittest.TestCase):
+    def test_round_trip(self):
+        features = make_features()
+        fc = FeatureCollection(features)
+        self.failUnlessEqual(len(fc), 3)
+        for (f, g) in zip(features, fc):
+            self.failUnless(isinstance(g, SlimFeature))
+            self.failUnless(isinstance(g.coordinates, CompactCoordinates))
+            self.failUnlessEqual(g.to_dict(), f.to_dict())
+        self.failUnlessEqual(fc[-1].to_dict(), features[-1].to_dict())
+        self.failUnlessRaises(IndexError, fc.__getitem__, 3)
+
+    def test_columns(self):
+        fc = FeatureCollection(make_features())
+        self.failUnlessEqual(list(fc.ids()), [HANDLE1, HANDLE2, None])
+        self.failUnlessEqual(fc.bbox(1), (0.0, 100.0, 1.0, 101.0))
+        self.failUnlessEqual(fc[1].num_vertices, 10)
+        self.failUnlessEqual(fc[1].geomtype, 'Polygon')
+
+    def test_shares_properties(self):
+        fc = FeatureCollection()
+        for i in range(3):
+            fc.append(Feature((1.0, 2.0), properties={'category': u'Food', 'open': True}))
+        fc.append(Feature((1.0, 2.0), properties={'category': 'Food', 'open': 1}))
+        self.failUnlessEqual(len(fc._key_tuples), 1)
+        self.failUnless(fc._values[0] is fc._values[2])
+        # Equal but of different types, so not shared.
+        self.failUnlessEqual(fc[3].properties, {'category': 'Food', 'open': 1})
+        self.failUnless(fc[0].properties['open'] is True)
+        self.failUnless(type(fc[0].properties['category']) is unicode)
+        self.failUnless(type(fc[3].properties['category']) is str)
+
+    def test_changing_a_feature_leaves_the_collection(self):
+        fc = FeatureCollection(make_features())
+        f = fc[0]
+        f.properties['name'] = 'changed'
+        f.coordinates = (5.0, 6.0)
+        self.failUnlessEqual(fc[0].properties['name'], 'a')
+        self.failUnlessEqual(fc[0].coordinates, (37.7593, -122.4188))
+
+    def test_nested_properties_are_copied(self):
+        n = {'x': [1]}
+        fc = FeatureCollection([Feature((1.0, 2.0), properties={'n': n})])
+        n['x'].append(2)
+        fc[0].properties['n']['x'].append(3)
+        self.failUnlessEqual(fc[0].properties, {'n': {'x': [1]}})
+        fc = FeatureCollection(make_features())
+        fc[1].properties['tags'].append('y')
+        self.failUnlessEqual(fc[1].properties['tags'], ['x'])
+
+    def test_from_json(self):
+        features = make_features()
+        text = ''.join(iter_feature_collection_json(features))
+        fc = FeatureCollection.from_json(text)
+        self.failUnlessEqual([g.to_dict() for g in fc], [f.to_dict() for f in features])
+        self.failUnlessEqual(json.loads(fc.to_json()), json.loads(text))
+
+    def test_from_json_errors(self):
+        self.failUnlessRaises(DecodeError, FeatureCollection.from_json, '{"features": [')
+        self.failUnlessRaises(DecodeError, FeatureCollection.from_json, '{"type": "FeatureCollection"}')
+        bad = '{"features": [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [200.0, 1.0]}, "properties": {}}]}'
+        self.failUnlessRaises(AssertionError, FeatureCollection.from_json, bad)
+        self.failUnlessEqual(FeatureCollection.from_json(bad, validate=False)[0].coordinates, (1.0, 200.0))
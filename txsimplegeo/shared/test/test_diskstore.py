@@ -0,0 +1,370 @@
+import os
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from txsimplegeo.shared import DiskFeatureStore, Feature, FeatureCache, LazyFeature
+from txsimplegeo.shared import diskstore
+from txsimplegeo.shared.diskstore import HEADER_SIZE, MAGIC
+
+HANDLE = "SG_6sRJczWZHdzNj4qSeRzpzz_40.005274_-105.048054@1291669259"
+
+def make_handle(i):
+    return 'SG_%022d' % (i,)
+
+def make_feature(i=0, name='a'):
+    return Feature(coordinates=[(40.0, -105.0 + i * 0.001), (41.0, -104.0)], geomtype='LineString', simplegeohandle=make_handle(i), properties={'name': name})
+
+class SyncOffloader(object):
+    def run(self, f, *args):
+        return defer.maybeDeferred(f, *args)
+
+class HeldOffloader(object):
+    """ Does the work at once, but holds back each result until
+    finish() is called. """
+    def __init__(self):
+        self.calls = []
+
+    def run(self, f, *args):
+        d = defer.Deferred()
+        self.calls.append((d, defer.maybeDeferred(f, *args)))
+        return d
+
+    def finish(self):
+        (d, result) = self.calls.pop(0)
+        result.chainDeferred(d)
+
+class DiskFeatureStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.path = self.mktemp()
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+
+    def _open(self, **kwargs):
+        store = DiskFeatureStore(self.path, clock=self.clock, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def test_put_get(self):
+        store = self._open()
+        f = make_feature()
+        self.clock.advance(5)
+        store.put(f.id, f, '"v1"', 'Wed, 01 Jun 2011 00:00:00 GMT')
+        self.failUnlessEqual(store.get(f.id).to_json(), f.to_json())
+        self.failUnlessEqual(str(store.get_json(f.id)), f.to_json())
+        stored = store.lookup(f.id)
+        self.failUnlessEqual((stored.stored_at, stored.etag, stored.last_modified), (5, '"v1"', 'Wed, 01 Jun 2011 00:00:00 GMT'))
+        self.failUnless(f.id in store)
+        self.failUnlessEqual(store.get(make_handle(1)), None)
+        self.failUnlessEqual(store.get_json(make_handle(1)), None)
+
+    def test_replace_and_delete(self):
+        store = self._open()
+        store.put(make_handle(0), make_feature(0, 'a'))
+        store.put(make_handle(0), make_feature(0, 'b'))
+        self.failUnlessEqual(store.get(make_handle(0)).properties['name'], 'b')
+        self.failUnlessEqual(len(store), 1)
+        store.delete(make_handle(0))
+        store.delete(make_handle(1))
+        self.failUnlessEqual(store.get(make_handle(0)), None)
+        self.failUnlessEqual(len(store), 0)
+
+    def test_persists(self):
+        store = self._open(compact=True)
+        for i in range(3):
+            store.put(make_handle(i), make_feature(i))
+        store.delete(make_handle(1))
+        store.close()
+        self.stores.remove(store)
+        store = self._open(compact=True)
+        self.failUnlessEqual(len(store), 2)
+        self.failUnlessEqual(store.get(make_handle(2)).to_json(), make_feature(2).to_json())
+        self.failUnlessEqual(store.get(make_handle(1)), None)
+
+    def test_torn_record_is_ignored(self):
+        store = self._open()
+        store.put(make_handle(0), make_feature(0))
+        store.put(make_handle(1), make_feature(1))
+        size = store.size
+        store.close()
+        self.stores.remove(store)
+        f = open(self.path, 'r+b')
+        f.truncate(size - 10)
+        f.close()
+        store = self._open()
+        self.failUnlessEqual(len(store), 1)
+        self.failUnless(make_handle(0) in store)
+        # The torn record is dropped, so new ones can be found.
+        store.put(make_handle(2), make_feature(2))
+        store.close()
+        self.stores.remove(store)
+        store = self._open()
+        self.failUnlessEqual(len(store), 2)
+        self.failUnless(make_handle(2) in store)
+
+    def test_not_a_store(self):
+        open(self.path, 'wb').write('something else')
+        self.failUnlessRaises(ValueError, DiskFeatureStore, self.path, readonly=True)
+
+    def test_one_writer(self):
+        self._open()
+        opened = []
+        realopen = open
+        def _open(*args):
+            f = realopen(*args)
+            opened.append(f)
+            return f
+        diskstore.open = _open
+        try:
+            self.failUnlessRaises(IOError, DiskFeatureStore, self.path)
+        finally:
+            del diskstore.open
+        # The second store's lock file was closed.
+        self.failUnlessEqual([f.closed for f in opened], [True])
+
+    def test_readers_see_writes(self):
+        writer = self._open()
+        writer.put(make_handle(0), make_feature(0))
+        writer.flush()
+        reader = self._open(readonly=True)
+        self.failUnless(make_handle(0) in reader)
+        writer.put(make_handle(1), make_feature(1))
+        # Other processes see records once they have been written.
+        self.failIf(make_handle(1) in reader)
+        self.clock.advance(writer.flush_delay)
+        # A miss looks for new records.
+        self.failUnlessEqual(reader.get(make_handle(1)).to_json(), make_feature(1).to_json())
+        writer.delete(make_handle(0))
+        writer.flush()
+        reader.refresh()
+        self.failIf(make_handle(0) in reader)
+        self.failUnlessRaises(AssertionError, reader.put, make_handle(2), make_feature(2))
+
+    def test_readers_see_changes(self):
+        writer = self._open()
+        writer.put(make_handle(0), make_feature(0, 'a'))
+        writer.put(make_handle(1), make_feature(1))
+        writer.put(make_handle(2), make_feature(2))
+        writer.flush()
+        reader = self._open(readonly=True)
+        for i in range(3):
+            self.failUnless(make_handle(i) in reader)
+        writer.put(make_handle(0), make_feature(0, 'b'))
+        writer.delete(make_handle(1))
+        self.clock.advance(5)
+        writer.touch(make_handle(2), '"v2"')
+        writer.flush()
+        # Handles the reader already knew are looked up afresh.
+        self.failUnlessEqual(reader.get(make_handle(0)).properties['name'], 'b')
+        self.failUnlessEqual(reader.get(make_handle(1)), None)
+        self.failUnlessEqual((reader.lookup(make_handle(2)).stored_at, reader.lookup(make_handle(2)).etag), (5, '"v2"'))
+
+    def test_compaction(self):
+        one = len(make_feature(0).to_json()) + 100
+        store = self._open(max_bytes=len(MAGIC) + 10 * one, offloader=SyncOffloader())
+        reader = self._open(readonly=True)
+        buf = None
+        for i in range(30):
+            store.put(make_handle(i), make_feature(i))
+            if i == 0:
+                buf = store.get_json(make_handle(0))
+        self.failUnless(store.compactions > 0)
+        self.failUnless(store.size <= store.max_bytes)
+        # The newest features are kept and the oldest dropped.
+        self.failUnless(make_handle(29) in store)
+        self.failIf(make_handle(0) in store)
+        self.failUnlessEqual(store.get(make_handle(29)).to_json(), make_feature(29).to_json())
+        # Buffers from before the compaction still work.
+        self.failUnlessEqual(str(buf), make_feature(0).to_json())
+        # A reader reopens the compacted file.
+        reader.refresh()
+        self.failUnlessEqual(len(reader), len(store))
+        self.failUnlessEqual(reader.get(make_handle(29)).to_json(), make_feature(29).to_json())
+
+    def test_compaction_drops_dead_records(self):
+        store = self._open()
+        for i in range(5):
+            store.put(make_handle(0), make_feature(0))
+        # In a thread.
+        d = store.compact_file()
+        self.failUnlessEqual(store.compactions, 0)
+        def _compacted(res):
+            self.failUnlessEqual(store.compactions, 1)
+            self.failUnlessEqual(len(store), 1)
+            self.failUnlessEqual(store.size, len(MAGIC) + HEADER_SIZE + len(make_handle(0)) + len('[null, null]\n') + len(make_feature(0).to_json()))
+            self.failIf(os.path.exists(self.path + '.compacting'))
+        d.addCallback(_compacted)
+        return d
+
+    def test_writes_during_compaction(self):
+        offloader = HeldOffloader()
+        store = self._open(offloader=offloader)
+        for i in range(5):
+            store.put(make_handle(i), make_feature(i))
+        d = store.compact_file()
+        # Only one compaction at a time.
+        d2 = store.compact_file()
+        self.failUnlessEqual(len(offloader.calls), 1)
+        # Meanwhile the store is used as usual.
+        store.put(make_handle(5), make_feature(5))
+        store.put(make_handle(1), make_feature(1, name='b'))
+        store.delete(make_handle(2))
+        self.clock.advance(5)
+        store.touch(make_handle(3), '"v2"')
+        self.failUnlessEqual(store.compactions, 0)
+        # The records written since are carried over to the new file.
+        offloader.finish()
+        self.failUnless(d2.called)
+        def _compacted(res):
+            self.failUnlessEqual(store.compactions, 1)
+            def check(store, expected):
+                self.failUnlessEqual(sorted(store._index), [make_handle(i) for i in expected])
+                self.failUnlessEqual(store.get(make_handle(1)).properties['name'], 'b')
+                self.failUnlessEqual(store.get(make_handle(5)).to_json(), make_feature(5).to_json())
+                self.failUnlessEqual((store.lookup(make_handle(3)).stored_at, store.lookup(make_handle(3)).etag), (5, '"v2"'))
+            check(store, (0, 1, 3, 4, 5))
+            store.put(make_handle(6), make_feature(6))
+            store.close()
+            store2 = self._open()
+            check(store2, (0, 1, 3, 4, 5, 6))
+            self.failUnlessEqual(store2.get(make_handle(6)).to_json(), make_feature(6).to_json())
+        d.addCallback(_compacted)
+        return d
+
+    def test_closed_during_compaction(self):
+        offloader = HeldOffloader()
+        store = self._open(offloader=offloader)
+        store.put(make_handle(0), make_feature(0))
+        d = store.compact_file()
+        store.close()
+        offloader.finish()
+        self.failUnless(d.called)
+        self.failIf(os.path.exists(self.path + '.compacting'))
+        self.failUnlessEqual(store.compactions, 0)
+
+    def test_batched_writes(self):
+        store = self._open()
+        store.put(make_handle(0), make_feature(0))
+        size = os.path.getsize(self.path)
+        for i in range(1, 5):
+            store.put(make_handle(i), make_feature(i))
+        store.delete(make_handle(1))
+        store.touch(make_handle(2), '"v2"')
+        # Nothing has been written yet, but it can all be read.
+        self.failUnlessEqual(os.path.getsize(self.path), size)
+        self.failUnlessEqual(len(store), 4)
+        self.failUnlessEqual(store.lookup(make_handle(2)).etag, '"v2"')
+        self.failUnlessEqual(str(store.get_json(make_handle(3))), make_feature(3).to_json())
+        # Reading a record not yet written wrote them all, growing the
+        # file by more than they need, so that the next ones fit.
+        self.failUnless(os.path.getsize(self.path) >= size + diskstore.MIN_GROWTH > store.size)
+        mapped = store._map
+        store.put(make_handle(5), make_feature(5))
+        self.clock.advance(store.flush_delay)
+        self.failUnlessIdentical(store._map, mapped)
+        store.close()
+        self.stores.remove(store)
+
+        store = self._open()
+        self.failUnlessEqual(sorted(store._index), [make_handle(i) for i in (0, 2, 3, 4, 5)])
+        self.failUnlessEqual(store.lookup(make_handle(2)).etag, '"v2"')
+        self.failUnlessEqual(store.get(make_handle(5)).to_json(), make_feature(5).to_json())
+
+    def test_touch(self):
+        store = self._open(offloader=SyncOffloader())
+        self.failIf(store.touch(make_handle(0), '"v2"'))
+        self.failUnlessEqual(store.size, len(MAGIC))
+        store.put(make_handle(0), make_feature(0), '"v1"')
+        size = store.size
+        self.clock.advance(5)
+        self.failUnless(store.touch(make_handle(0), '"v2"', 'Tue, 15 Nov 1994 08:12:31 GMT'))
+        # Only the validators are written again, not the feature.
+        self.failUnlessEqual(store.size, size + HEADER_SIZE + len(make_handle(0)) + len('["\\"v2\\"", "Tue, 15 Nov 1994 08:12:31 GMT"]'))
+        stored = store.lookup(make_handle(0))
+        self.failUnlessEqual((stored.stored_at, stored.etag, stored.last_modified), (5, '"v2"', 'Tue, 15 Nov 1994 08:12:31 GMT'))
+        self.failUnlessEqual(store.get(make_handle(0)).to_json(), make_feature(0).to_json())
+        store.close()
+
+        store = self._open(offloader=SyncOffloader())
+        stored = store.lookup(make_handle(0))
+        self.failUnlessEqual((stored.stored_at, stored.etag), (5, '"v2"'))
+        # Compaction keeps what the touch changed.
+        store.compact_file()
+        stored = store.lookup(make_handle(0))
+        self.failUnlessEqual((stored.stored_at, stored.etag, stored.last_modified), (5, '"v2"', 'Tue, 15 Nov 1994 08:12:31 GMT'))
+        self.failUnlessEqual(store.get(make_handle(0)).to_json(), make_feature(0).to_json())
+
+class TwoTierCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.path = self.mktemp()
+
+    def _cache(self, **kwargs):
+        store = DiskFeatureStore(self.path, clock=self.clock)
+        self.addCleanup(store.close)
+        return FeatureCache(clock=self.clock, store=store, **kwargs)
+
+    def test_survives_restart(self):
+        cache = self._cache(ttl=10)
+        cache.put(HANDLE, Feature((40.0, -105.0), simplegeohandle=HANDLE), '"v1"')
+        cache.store.close()
+
+        cache = self._cache(ttl=10)
+        self.clock.advance(5)
+        f = cache.get(HANDLE)
+        self.failUnlessEqual(f.coordinates, (40.0, -105.0))
+        self.failUnlessEqual((cache.hits, cache.disk_hits), (1, 1))
+        # Now it is in memory.
+        self.failUnless(cache.get(HANDLE) is f)
+        self.failUnlessEqual(cache.disk_hits, 1)
+
+    def test_stale_from_disk(self):
+        cache = self._cache(ttl=10)
+        cache.put(HANDLE, Feature((40.0, -105.0), simplegeohandle=HANDLE), '"v1"')
+        cache.store.close()
+
+        cache = self._cache(ttl=10)
+        self.clock.advance(10)
+        self.failUnlessEqual(cache.get(HANDLE), None)
+        # Kept for revalidation, with its validators.
+        self.failUnlessEqual(cache.get_entry(HANDLE).etag, '"v1"')
+
+    def test_revalidated_is_touched(self):
+        cache = self._cache(ttl=10)
+        f = Feature((40.0, -105.0), simplegeohandle=HANDLE)
+        cache.put(HANDLE, f, '"v1"')
+        size = cache.store.size
+        self.clock.advance(10)
+        # As after a 304 Not Modified.
+        cache.put(HANDLE, f, '"v1"')
+        self.failUnless(cache.store.size - size < len(f.to_json()))
+        self.failUnlessEqual(cache.store.lookup(HANDLE).stored_at, 10)
+        # A new Feature is written in full.
+        cache.put(HANDLE, Feature((41.0, -105.0), simplegeohandle=HANDLE), '"v2"')
+        self.failUnlessEqual(cache.store.get(HANDLE).coordinates, (41.0, -105.0))
+
+    def test_lazy_feature_stays_lazy(self):
+        cache = self._cache()
+        f = LazyFeature.from_json(make_feature(0).to_json())
+        cache.put(f.id, f)
+        self.failIf(f.is_materialized())
+        self.failUnlessEqual(cache.store.get(f.id).coordinates, make_feature(0).coordinates)
+
+    def test_evicted_from_memory_only(self):
+        cache = self._cache(maxsize=1)
+        cache.put('SG_%022d' % 1, make_feature(1))
+        cache.put('SG_%022d' % 2, make_feature(2))
+        self.failUnlessEqual(cache.evictions, 1)
+        self.failUnlessEqual(cache.get('SG_%022d' % 1).to_json(), make_feature(1).to_json())
+        self.failUnlessEqual(cache.disk_hits, 1)
+
+    def test_invalidate(self):
+        cache = self._cache()
+        cache.put(HANDLE, Feature((40.0, -105.0), simplegeohandle=HANDLE))
+        cache.invalidate(HANDLE)
+        self.failIf(HANDLE in cache.store)
+        self.failUnlessEqual(cache.get(HANDLE), None)
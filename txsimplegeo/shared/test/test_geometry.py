@@ -0,0 +1,179 @@
+import unittest
+from array import array
+
+from decimal import Decimal as D
+
+from txsimplegeo.shared import Feature, geometry
+from pyutil import jsonutil as json
+
+from txsimplegeo.shared.geometry import CompactCoordinates, bounding_box, deep_swap, extent, validated_extent, vertex_centroid, deep_validate_lat_lon, iter_geojson_coordinates, swap_pairs, validate_pairs
+
+MULTIPOLYGON = [
+    [[[102.0, 2.0], [103.0, 2.0], [103.0, 3.0], [102.0, 3.0], [102.0, 2.0]]],
+    [[[100.0, 0.0], [101.0, 0.0], [101.0, 1.0], [100.0, 1.0], [100.0, 0.0]],
+     [[100.2, 0.2], [100.8, 0.2], [100.8, 0.8], [100.2, 0.8], [100.2, 0.2]]]
+    ]
+
+def swapped(struc):
+    if isinstance(struc[0], (int, float)):
+        return (struc[1], struc[0])
+    return [swapped(sub) for sub in struc]
+
+class CompactCoordinatesTest(unittest.TestCase):
+    def test_point(self):
+        cc = CompactCoordinates.from_nested([-122.5, 37.75], swap=True)
+        self.failUnlessEqual(cc.depth, 0)
+        self.failUnlessEqual(len(cc), 2)
+        self.failUnlessEqual(cc[0], 37.75)
+        self.failUnlessEqual(cc[1], -122.5)
+        self.failUnlessEqual(cc.to_list(), (37.75, -122.5))
+        self.failUnlessEqual(cc.to_geojson(), (-122.5, 37.75))
+
+    def test_linestring(self):
+        cc = CompactCoordinates.from_nested([(1, 2), (3, 4), (5, 6)])
+        self.failUnlessEqual(cc.depth, 1)
+        self.failUnlessEqual(len(cc), 3)
+        self.failUnlessEqual(cc[1], (3.0, 4.0))
+        self.failUnlessEqual(cc[-1], (5.0, 6.0))
+        self.failUnlessEqual(cc[:2], [(1.0, 2.0), (3.0, 4.0)])
+        self.failUnlessEqual(list(cc), [(1.0, 2.0), (3.0, 4.0), (5.0, 6.0)])
+        self.failUnlessRaises(IndexError, cc.__getitem__, 3)
+
+    def test_multipolygon(self):
+        cc = CompactCoordinates.from_nested(MULTIPOLYGON, swap=True)
+        self.failUnlessEqual(cc.depth, 3)
+        self.failUnlessEqual(cc.num_vertices(), 15)
+        self.failUnless(isinstance(cc.flat, array))
+        self.failUnlessEqual(len(cc.flat), 30)
+        self.failUnlessEqual(len(cc), 2)
+        self.failUnlessEqual(len(cc[1]), 2)
+        self.failUnlessEqual(len(cc[1][1]), 5)
+        self.failUnlessEqual(cc[1][1][2], (0.8, 100.8))
+        self.failUnlessEqual(cc, swapped(MULTIPOLYGON))
+        self.failUnlessEqual(cc.to_geojson(), swapped(swapped(MULTIPOLYGON)))
+        self.failUnlessEqual(cc[1], CompactCoordinates.from_nested(MULTIPOLYGON[1], swap=True))
+
+    def test_empty(self):
+        cc = CompactCoordinates.from_nested([[]])
+        self.failUnlessEqual(len(cc), 1)
+        self.failUnlessEqual(len(cc[0]), 0)
+        self.failUnless(cc.is_valid_lat_lon())
+
+    def test_is_valid_lat_lon(self):
+        self.failUnless(CompactCoordinates.from_nested([(90, 180), (-90, -180)]).is_valid_lat_lon())
+        self.failIf(CompactCoordinates.from_nested([(90.1, 0)]).is_valid_lat_lon())
+        self.failIf(CompactCoordinates.from_nested([(0, -180.1)]).is_valid_lat_lon())
+
+    def test_is_valid_lat_lon_without_numpy(self):
+        realnumpy = geometry.numpy
+        geometry.numpy = None
+        try:
+            self.test_is_valid_lat_lon()
+        finally:
+            geometry.numpy = realnumpy
+
+    def test_swapped(self):
+        cc = CompactCoordinates.from_nested(MULTIPOLYGON)
+        self.failUnlessEqual(cc.swapped(), swapped(MULTIPOLYGON))
+        self.failUnlessEqual(cc.swapped().swapped(), cc)
+
+    def test_bad_pairs(self):
+        self.failUnlessRaises(ValueError, CompactCoordinates.from_nested, [(1, 2, 3)])
+        self.failUnlessRaises(TypeError, CompactCoordinates.from_nested, [('a', 'b')])
+
+class PairsTest(unittest.TestCase):
+    def test_swap_pairs(self):
+        self.failUnlessEqual(swap_pairs([(1, 2), [3, 4]]), [(2, 1), (4, 3)])
+        # Malformed elements anywhere raise AssertionError, as
+        # validation does, even when nothing was validated.
+        self.failUnlessRaises(AssertionError, swap_pairs, [(1, 2, 3)])
+        self.failUnlessRaises(AssertionError, swap_pairs, [(1, 2), (3, 4, 5)])
+        self.failUnlessRaises(AssertionError, swap_pairs, [(1, 2), 3])
+        self.failUnlessRaises(AssertionError, deep_swap, [[(1, 2), (3, 4)], [(1, 2), 3]])
+        self.failUnlessRaises(AssertionError, lambda: list(iter_geojson_coordinates([(1.0, 2.0), (3.0,)])))
+        self.failUnlessRaises(AssertionError, lambda: list(iter_geojson_coordinates([(1, 2), 3])))
+        self.failUnlessRaises(AssertionError, Feature([(1, 2), (3, 4, 5)], geomtype='LineString', validate=False).to_json)
+
+    def test_validate_pairs(self):
+        self.failUnless(validate_pairs([(90, 180), [-90, D('-180')], (0.5, 1L)]))
+        self.failIf(validate_pairs([(0, 0), (90.1, 0)]))
+        self.failIf(validate_pairs([(0, 0), (0, -180.1)]))
+        self.failIf(validate_pairs([(0, 0), (0, 0, 0)]))
+        self.failIf(validate_pairs([(0, 0), (0, '1')]))
+        self.failIf(validate_pairs([(0, 0), (0, [1, 2])]))
+        self.failIf(validate_pairs([(0, 0), 3]))
+
+    def test_nan_is_invalid(self):
+        nan = float('nan')
+        for pairs in ([(1.0, 2.0), (nan, 2.0)], [(1.0, 2.0), (1.0, nan)], [(nan, 2.0), (1.0, 2.0)], [(1.0, 2.0), (D('NaN'), 2.0)]):
+            self.failIf(validate_pairs(pairs), pairs)
+            self.failUnlessRaises(AssertionError, deep_validate_lat_lon, pairs)
+            self.failUnlessRaises(AssertionError, Feature, pairs, 'LineString')
+        for (lat, lon) in ((nan, 2.0), (1.0, nan)):
+            cc = CompactCoordinates.from_nested([(1.0, 2.0), (lat, lon)])
+            self.failIf(cc.is_valid_lat_lon())
+            self.failUnlessRaises(AssertionError, deep_validate_lat_lon, cc)
+
+    def test_nan_is_invalid_without_numpy(self):
+        realnumpy = geometry.numpy
+        geometry.numpy = None
+        try:
+            self.test_nan_is_invalid()
+        finally:
+            geometry.numpy = realnumpy
+
+    def test_deep_functions_use_whole_rings(self):
+        self.failUnlessEqual(deep_swap(MULTIPOLYGON), swapped(MULTIPOLYGON))
+        self.failUnless(deep_validate_lat_lon(swapped(MULTIPOLYGON)))
+        self.failUnlessRaises(AssertionError, deep_validate_lat_lon, MULTIPOLYGON)
+        self.failUnlessRaises(AssertionError, deep_validate_lat_lon, [[(1, 2), (3, 'x')]])
+        self.failUnlessRaises(AssertionError, deep_validate_lat_lon, [[1, 2], 3])
+        self.failUnlessRaises(AssertionError, Feature, [[1, 2], 3], 'LineString')
+
+class GeoJSONCoordinatesTest(unittest.TestCase):
+    def _check(self, struc):
+        text = ''.join(iter_geojson_coordinates(struc))
+        self.failUnlessEqual(json.loads(text), json.loads(json.dumps(deep_swap(struc))))
+        return text
+
+    def test_nested(self):
+        self.failUnlessEqual(self._check((37.75, -122.5)), '[-122.5,37.75]')
+        self.failUnlessEqual(self._check([(1, 2L), (D('3.25'), 4.5)]), '[[2,1],[4.5,3.25]]')
+        self._check(swapped(MULTIPOLYGON))
+        self.failUnlessEqual(''.join(iter_geojson_coordinates([[]])), '[[]]')
+
+    def test_compact(self):
+        self._check(CompactCoordinates.from_nested((37.75, -122.5)))
+        self._check(CompactCoordinates.from_nested(MULTIPOLYGON, swap=True))
+
+    def test_chunks_long_rings(self):
+        ring = [(float(i % 90), float(i % 180)) for i in range(3000)]
+        self.failUnless(len(list(iter_geojson_coordinates(ring))) > 3)
+        self._check([ring])
+        self._check(CompactCoordinates.from_nested([ring]))
+
+class BoundingBoxTest(unittest.TestCase):
+    def test_bounding_box(self):
+        struc = swapped(MULTIPOLYGON)
+        self.failUnlessEqual(bounding_box(struc), (0.0, 100.0, 3.0, 103.0))
+        self.failUnlessEqual(bounding_box(CompactCoordinates.from_nested(struc)), (0.0, 100.0, 3.0, 103.0))
+        self.failUnlessEqual(bounding_box((D('37.75'), D('-122.5'))), (D('37.75'), D('-122.5'), D('37.75'), D('-122.5')))
+        self.failUnlessEqual(bounding_box(CompactCoordinates.from_nested([37.75, -122.5])), (37.75, -122.5, 37.75, -122.5))
+        self.failUnlessEqual(bounding_box([]), None)
+        self.failUnlessEqual(bounding_box(CompactCoordinates.from_nested([])), None)
+
+    def test_extent(self):
+        struc = swapped(MULTIPOLYGON)
+        self.failUnlessEqual(extent(struc), ((0.0, 100.0, 3.0, 103.0), 15))
+        self.failUnlessEqual(validated_extent(struc), extent(struc))
+        self.failUnlessEqual(extent(CompactCoordinates.from_nested(struc)), extent(struc))
+        self.failUnlessEqual(validated_extent((37.75, -122.5)), ((37.75, -122.5, 37.75, -122.5), 1))
+        self.failUnlessEqual(extent([]), (None, 0))
+        self.failUnlessRaises(AssertionError, validated_extent, [[(91.0, 0.0), (0.0, 0.0)]])
+
+    def test_vertex_centroid(self):
+        struc = [[(0.0, 10.0), (0.0, 12.0), (3.0, 11.0)]]
+        self.failUnlessEqual(vertex_centroid(struc), (1.0, 11.0))
+        self.failUnlessEqual(vertex_centroid(CompactCoordinates.from_nested(struc)), (1.0, 11.0))
+        self.failUnlessEqual(vertex_centroid((D('1.5'), 2)), (1.5, 2.0))
+        self.failUnlessEqual(vertex_centroid([]), None)
@@ -0,0 +1,106 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from txsimplegeo.shared import Client, HistogramInstrumentation
+from txsimplegeo.shared.instrument import Histogram, RequestTiming
+from txsimplegeo.shared.test.test_client import EXAMPLE_BODY, FakeSuccessResponse, MockAgent
+
+class HistogramTest(unittest.TestCase):
+    def test_empty(self):
+        h = Histogram((1, 2, 4))
+        self.failUnlessEqual(h.count, 0)
+        self.failUnlessEqual(h.mean(), None)
+        self.failUnlessEqual(h.percentile(50), None)
+
+    def test_add(self):
+        h = Histogram((1, 2, 4))
+        for v in (0.5, 1, 1.5, 3, 10):
+            h.add(v)
+        self.failUnlessEqual(h.counts, [2, 1, 1, 1])
+        self.failUnlessEqual(h.count, 5)
+        self.failUnlessEqual(h.min, 0.5)
+        self.failUnlessEqual(h.max, 10)
+        self.failUnlessEqual(h.mean(), 16 / 5.0)
+
+    def test_percentile(self):
+        h = Histogram((1, 2, 4))
+        for v in [0.5] * 90 + [3] * 9 + [3.5]:
+            h.add(v)
+        self.failUnlessEqual(h.percentile(50), 1)
+        self.failUnlessEqual(h.percentile(90), 1)
+        # Never more than the largest value seen.
+        self.failUnlessEqual(h.percentile(95), 3.5)
+        self.failUnlessEqual(h.percentile(100), 3.5)
+        self.failUnlessRaises(AssertionError, h.percentile, 0)
+
+class HistogramInstrumentationTest(unittest.TestCase):
+    def test_request_finished(self):
+        inst = HistogramInstrumentation()
+        t = RequestTiming('feature', 'GET', 'http://thing', 10.0)
+        t.sent_at = 10.5
+        t.response_at = 11.0
+        t.body_done_at = 11.25
+        t.decode = 0.01
+        t.bytes_received = 2000
+        t.code = 200
+        inst.request_finished(t)
+        inst.request_finished(RequestTiming('features', 'GET', 'http://thing', 12.0))
+
+        self.failUnlessEqual(inst.phases['queue_wait'].count, 1)
+        self.failUnlessEqual(inst.phases['ttfb'].total, 0.5)
+        self.failUnlessEqual(inst.phases['body'].total, 0.25)
+        self.failUnlessEqual(inst.phases['connect'].count, 0)
+        self.failUnlessEqual(inst.by_name['feature']['decode'].count, 1)
+        self.failUnlessEqual(inst.by_name['features']['decode'].count, 0)
+        self.failUnlessEqual(inst.bytes_received.total, 2000)
+        self.failUnlessEqual(inst.codes, {200: 1, None: 1})
+        self.failUnlessEqual(inst.summary()['ttfb']['p50'], 0.5)
+
+class RecordingInstrumentation(object):
+    def __init__(self):
+        self.timings = []
+
+    def request_finished(self, timing):
+        self.timings.append(timing)
+
+class ClientInstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        self.inst = RecordingInstrumentation()
+        self.client = Client('key', 'secret', instrumentation=self.inst)
+        self.client.clock = task.Clock()
+
+    def test_get_feature(self):
+        headers = {'content-type': 'application/json'}
+        self.client.agent = MockAgent(FakeSuccessResponse([EXAMPLE_BODY], headers))
+        d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970")
+        def _check(f):
+            self.failUnlessEqual(len(self.inst.timings), 1)
+            t = self.inst.timings[0]
+            self.failUnlessEqual(t.name, 'feature')
+            self.failUnlessEqual(t.method, 'GET')
+            self.failUnlessEqual(t.code, 200)
+            self.failUnlessEqual(t.bytes_received, len(EXAMPLE_BODY))
+            self.failUnlessEqual(t.queue_wait, 0)
+            self.failUnlessEqual(t.ttfb, 0)
+            self.failUnlessEqual(t.body, 0)
+            self.failIfEqual(t.decode, None)
+            self.failIfEqual(t.construct, None)
+            self.failUnlessEqual(self.client.get_most_recent_http_headers(), headers)
+        d.addCallback(_check)
+        return d
+
+    def test_streaming_decode(self):
+        self.client.streaming_decode = True
+        self.client.agent = MockAgent(FakeSuccessResponse([EXAMPLE_BODY[:100], EXAMPLE_BODY[100:]], {}))
+        d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970")
+        d.addCallback(lambda f: self.failUnlessEqual(self.inst.timings[0].bytes_received, len(EXAMPLE_BODY)))
+        return d
+
+    def test_instrumentation_failure_is_logged(self):
+        def request_finished(timing):
+            raise ValueError("oops")
+        self.inst.request_finished = request_finished
+        self.client.agent = MockAgent(FakeSuccessResponse([EXAMPLE_BODY], {}))
+        d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970")
+        d.addCallback(lambda f: self.failUnlessEqual(len(self.flushLoggedErrors(ValueError)), 1))
+        return d
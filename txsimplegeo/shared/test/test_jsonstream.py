@@ -0,0 +1,115 @@
+import unittest
+
+from pyutil import jsonutil as json
+
+from txsimplegeo.shared.jsonstream import IncrementalJSONDecoder, decode_object_deferring, iter_array_member
+from txsimplegeo.shared.test.test_client import EXAMPLE_BODY, EXAMPLE_POINT_BODY
+
+from decimal import Decimal as D
+
+def decode_in_pieces(text, piecesize):
+    decoder = IncrementalJSONDecoder()
+    for i in range(0, len(text), piecesize):
+        decoder.feed(text[i:i+piecesize])
+    return decoder.close()
+
+class IncrementalJSONDecoderTest(unittest.TestCase):
+    def test_matches_json_loads(self):
+        for text in [EXAMPLE_BODY, EXAMPLE_POINT_BODY, '[1, -2.5e3, 0.5, true, false, null, "a\\"b\\u00e9", {}, [], {"a": {"b": [[]]}}]', '12', ' "x" ']:
+            expected = json.loads(text)
+            for piecesize in [1, 2, 3, 7, 100, len(text)]:
+                self.failUnlessEqual(decode_in_pieces(text, piecesize), expected, (text, piecesize))
+
+    def test_number_types(self):
+        res = decode_in_pieces('[1, 1.5, -2e3, 12345678901234567890]', 1)
+        self.failUnlessEqual([type(x) for x in res], [int, D, D, long])
+
+    def test_parse_float(self):
+        decoder = IncrementalJSONDecoder(parse_float=float)
+        decoder.feed('[1.5, 2]')
+        res = decoder.close()
+        self.failUnlessEqual(res, [1.5, 2])
+        self.failUnlessEqual(type(res[0]), float)
+
+    def test_keeps_only_unparsed_tail(self):
+        decoder = IncrementalJSONDecoder()
+        decoder.feed('{"coordinates": [[1.25, 2.5], [3.7')
+        self.failUnlessEqual(decoder.unparsed(), '3.7')
+        decoder.feed('5, 4]], "name": "ab')
+        self.failUnlessEqual(decoder.unparsed(), ' "ab')
+        decoder.feed('c"}')
+        self.failUnlessEqual(decoder.close(), {'coordinates': [[D('1.25'), D('2.5')], [D('3.75'), 4]], 'name': 'abc'})
+
+    def test_errors(self):
+        for text in ['[1,]', '{"a" 1}', '[1 2]', '{1: 2}', '[tru]', '[1.]', '[', '', '{}{}', '[1]]', '"abc', '01', '[1] x', '["a\\x"]']:
+            decoder = IncrementalJSONDecoder()
+            def _decode():
+                for c in text:
+                    decoder.feed(c)
+                return decoder.close()
+            self.failUnlessRaises(ValueError, _decode)
+
+    def test_long_string_scanned_once(self):
+        text = '{"name": "%s"}' % ('ab\\"\\\\\\u00e9' * 500,)
+        calls = []
+        scanstring = json.decoder.scanstring
+        def counting_scanstring(*args):
+            calls.append(args[1])
+            return scanstring(*args)
+        json.decoder.scanstring = counting_scanstring
+        try:
+            for piecesize in [1, 3, 8]:
+                del calls[:]
+                self.failUnlessEqual(decode_in_pieces(text, piecesize), json.loads(text), piecesize)
+                # Once for the key and once for the value, however many
+                # pieces the value came in.
+                self.failUnlessEqual(len(calls), 2, piecesize)
+        finally:
+            json.decoder.scanstring = scanstring
+
+class DecodeObjectDeferringTest(unittest.TestCase):
+    def test_defers_geometry(self):
+        (data, raw) = decode_object_deferring(EXAMPLE_BODY, 'geometry')
+        full = json.loads(EXAMPLE_BODY)
+        self.failIf('geometry' in data)
+        self.failUnlessEqual(data, dict([(k, v) for (k, v) in full.items() if k != 'geometry']))
+        self.failUnlessEqual(json.loads(raw), full['geometry'])
+
+    def test_braces_in_strings(self):
+        text = ' { "geometry" : {"type": "}{\\"", "x": {}} , "b": [1.5, "}"] } '
+        (data, raw) = decode_object_deferring(text, 'geometry')
+        self.failUnlessEqual(data, {'b': [D('1.5'), '}']})
+        self.failUnlessEqual(raw, '{"type": "}{\\"", "x": {}}')
+
+    def test_parse_float(self):
+        (data, raw) = decode_object_deferring('{"a": 1.5}', 'geometry', parse_float=float)
+        self.failUnlessEqual(type(data['a']), float)
+        self.failUnlessEqual(raw, None)
+
+    def test_non_object_value_is_decoded(self):
+        self.failUnlessEqual(decode_object_deferring('{"geometry": null}', 'geometry'), ({'geometry': None}, None))
+        self.failUnlessEqual(decode_object_deferring('{}', 'geometry'), ({}, None))
+
+    def test_errors(self):
+        for text in ['', '[]', '{"a" 1}', '{"a": 1,}', '{"a": 1} x', '{"geometry": {"type": "Point"}', '{"a": 1']:
+            self.failUnlessRaises(ValueError, decode_object_deferring, text, 'geometry')
+
+class IterArrayMemberTest(unittest.TestCase):
+    def test_yields_elements(self):
+        text = ' {"type": "FeatureCollection", "features" : [ {"a": 1.5}, [2], "x" ] , "z": {"b": 2} } '
+        self.failUnlessEqual(list(iter_array_member(text, 'features')), [{'a': D('1.5')}, [2], 'x'])
+        self.failUnlessEqual(list(iter_array_member('{"features": []}', 'features')), [])
+
+    def test_lazy(self):
+        # Elements before a malformed one come out before the error.
+        elements = iter_array_member('{"features": [1, 2, }', 'features')
+        self.failUnlessEqual(elements.next(), 1)
+        self.failUnlessEqual(elements.next(), 2)
+        self.failUnlessRaises(ValueError, elements.next)
+
+    def test_parse_float(self):
+        self.failUnlessEqual(type(list(iter_array_member('{"f": [1.5]}', 'f', float))[0]), float)
+
+    def test_errors(self):
+        for text in ['', '[]', '{}', '{"features": {}}', '{"features": [1,]}', '{"features": [1] x', '{"features": [1]} x']:
+            self.failUnlessRaises(ValueError, list, iter_array_member(text, 'features'))
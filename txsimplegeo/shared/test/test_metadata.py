@@ -0,0 +1,76 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.web.http_headers import Headers
+
+from pyutil import jsonutil as json
+
+from txsimplegeo.shared import Client, ResponseMetadata
+from txsimplegeo.shared.instrument import RequestTiming
+from txsimplegeo.shared.test.test_client import EXAMPLE_POINT_BODY, FakeSuccessResponse, MockAgent, make_point_feature_dict
+
+HANDLE = 'SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970'
+HANDLE2 = 'SG_2M3ewUyVWRvJhTKmRzV5sq_37.780000_-122.400000'
+
+def make_headers():
+    return Headers({'content-type': ['application/json'], 'etag': ['"v1"'], 'x-other': ['ignored']})
+
+class ResponseMetadataTest(unittest.TestCase):
+    def test_from_response(self):
+        resp = FakeSuccessResponse([], make_headers())
+        timing = RequestTiming('feature', 'GET', 'http://example.com/', 1.0)
+        (timing.sent_at, timing.response_at, timing.body_done_at) = (2.0, 2.5, 3.0)
+        md = ResponseMetadata.from_response(resp, timing)
+        self.failUnlessEqual((md.code, md.received_at, md.ttfb, md.body), (200, 2.5, 0.5, 0.5))
+        self.failUnlessEqual(md.headers, (('Content-Type', 'application/json'), ('ETag', '"v1"')))
+        self.failUnlessEqual(md.header('etag'), '"v1"')
+        self.failUnlessEqual(md.header('X-Other'), None)
+        self.failIf(hasattr(md, '__dict__'))
+
+    def test_without_timing(self):
+        md = ResponseMetadata.from_response(FakeSuccessResponse([], make_headers()), header_names=('X-Other',))
+        self.failUnlessEqual((md.code, md.ttfb, md.headers), (200, None, (('X-Other', 'ignored'),)))
+
+class FeatureMetadataTest(unittest.TestCase):
+    def _get(self, **kwargs):
+        client = Client('key', 'secret', **kwargs)
+        client.clock = task.Clock()
+        client.agent = MockAgent(FakeSuccessResponse([EXAMPLE_POINT_BODY], make_headers()))
+        return client.get_feature(HANDLE)
+
+    def test_nothing_kept_by_default(self):
+        d = self._get()
+        def _check(f):
+            self.failUnlessEqual(f.response_metadata, None)
+            self.failIf(hasattr(f, '_http_response'))
+        d.addCallback(_check)
+        return d
+
+    def test_response_metadata(self):
+        d = self._get(response_metadata=True)
+        def _check(f):
+            self.failUnlessEqual(f.response_metadata.code, 200)
+            self.failUnlessEqual(f.response_metadata.header('ETag'), '"v1"')
+            self.failIf(hasattr(f, '_http_response'))
+        d.addCallback(_check)
+        return d
+
+    def test_debug_keeps_response(self):
+        d = self._get(debug=True)
+        def _check(f):
+            self.failUnlessEqual(f._http_response.headers.getRawHeaders('x-other'), ['ignored'])
+        d.addCallback(_check)
+        return d
+
+    def test_get_features_share_metadata(self):
+        body = json.dumps({ 'type': 'FeatureCollection', 'features': [make_point_feature_dict(h) for h in (HANDLE, HANDLE2)] })
+        class Agent(object):
+            def request(self, method, endpoint, headers=None, bodyProducer=None):
+                return defer.succeed(FakeSuccessResponse([body], make_headers()))
+        client = Client('key', 'secret', response_metadata=True)
+        client.agent = Agent()
+        d = client.get_features([HANDLE, HANDLE2])
+        def _check(res):
+            self.failUnless(res[HANDLE].response_metadata is res[HANDLE2].response_metadata)
+            self.failUnlessEqual(res[HANDLE].response_metadata.code, 200)
+        d.addCallback(_check)
+        return d
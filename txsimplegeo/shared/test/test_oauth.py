@@ -1,6 +1,7 @@
-import unittest
+import hashlib, hmac, unittest
 
-from txsimplegeo.shared.oauth import escape, normalize_parameters, signing_base, sign_request, to_unicode
+from txsimplegeo.shared import oauth
+from txsimplegeo.shared.oauth import NoncePool, Signer, escape, normalize_parameters, normalize_url, signing_base, sign_request, to_unicode
 
 class ReallyEqualMixin:
     def failUnlessReallyEqual(self, a, b, msg=None):
@@ -46,3 +47,55 @@ class OauthTest(unittest.TestCase, ReallyEqualMixin):
 
         authheader = sign_request('abcde', 'fghijk', 'GET', 'http://example.com/api', {'a': ['e', 'b'], 'c': 'd'}, 'example')
         self.failUnlessReallyEqual(authheader, 'OAuth realm="example", oauth_signature="769eeb73ed355ad177cf113bc28a85a54c8c8ff6", oauth_signature_method="HMAC-SHA1", oauth_consumer_key="abcde"')
+
+class SignerTest(unittest.TestCase, ReallyEqualMixin):
+    def test_same_as_sign_request(self):
+        signer = Signer('abcde', 'fghijk', 'example')
+        for i in range(3):
+            params = {'a': ['e', 'b'], 'c': 'd', 'oauth_nonce': str(i)}
+            self.failUnlessReallyEqual(signer.sign_request('GET', 'http://example.com/api', dict(params)), sign_request('abcde', 'fghijk', 'GET', 'http://example.com/api', dict(params), 'example'))
+        authheader = signer.sign_request('GET', 'http://example.com/api', {})
+        self.failUnlessReallyEqual(authheader, 'OAuth realm="example", oauth_signature="8b1d544bfc74ae64784dd95b0fffaf2c48a027a4", oauth_consumer_key="abcde", oauth_signature_method="HMAC-SHA1"')
+
+    def test_constant_parameters(self):
+        # The consumer key, signature method and version are escaped
+        # when the Signer is made; other values are escaped as usual.
+        signer = Signer('ab cd', 'fghijk', 'example')
+        for version in ('1.0', '1.0 a'):
+            params = {'oauth_version': version, 'oauth_nonce': 'x y'}
+            authheader = signer.sign_request('GET', 'http://example.com/api', params)
+            self.failUnless('oauth_consumer_key="ab%20cd"' in authheader, authheader)
+            self.failUnless('oauth_signature_method="HMAC-SHA1"' in authheader, authheader)
+            self.failUnless('oauth_version="%s"' % (escape(version),) in authheader, authheader)
+            self.failUnless('oauth_nonce="x%20y"' in authheader, authheader)
+
+    def test_signature(self):
+        signer = Signer('abcde', 'fghijk', 'example')
+        params = {'oauth_consumer_key': 'abcde', 'oauth_signature_method': 'HMAC-SHA1'}
+        (key, raw) = signing_base('GET', 'http://example.com/api', params, 'fghijk')
+        self.failUnlessReallyEqual(signer.signature('GET', 'http://example.com/api', params), hmac.new(key, raw, hashlib.sha1).hexdigest())
+
+class NormalizeURLTest(unittest.TestCase):
+    def test_normalize_url(self):
+        self.failUnlessEqual(normalize_url('http://api.simplegeo.com:80/1.0/features/a.json'), ('http://api.simplegeo.com/1.0/features/a.json', {}))
+        self.failUnlessEqual(normalize_url('HTTPS://Example.com:443/x?b=1&a=2&a=&c'), ('https://example.com/x', {'a': ['2', ''], 'b': ['1'], 'c': ['']}))
+        self.failUnlessEqual(normalize_url('http://example.com:8080/x#frag'), ('http://example.com:8080/x', {}))
+
+class NoncePoolTest(unittest.TestCase):
+    def test_nonces(self):
+        calls = []
+        real_urandom = oauth.os.urandom
+        def urandom(n):
+            calls.append(n)
+            return real_urandom(n)
+        oauth.os.urandom = urandom
+        try:
+            pool = NoncePool(batch_size=10)
+            nonces = [pool.next() for i in range(25)]
+        finally:
+            oauth.os.urandom = real_urandom
+        self.failUnlessEqual(calls, [10 * oauth.NONCE_BYTES] * 3)
+        self.failUnlessEqual(len(set(nonces)), 25)
+        for nonce in nonces:
+            self.failUnlessEqual(len(nonce), 2 * oauth.NONCE_BYTES)
+            self.failUnlessEqual(escape(nonce), nonce)
@@ -0,0 +1,138 @@
+import cPickle, os, threading
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from txsimplegeo.shared import _decode_feature, Client, DecodeError, Feature, ProcessOffloader, ThreadOffloader, json_decode
+from txsimplegeo.shared.offload import OffloadError
+from txsimplegeo.shared.test.test_client import EXAMPLE_BODY, FakeSuccessResponse, MockAgent, MockFeaturesAgent
+
+def unpicklable_error():
+    class LocalError(Exception):
+        pass
+    raise LocalError("can't pickle me")
+
+def unpicklable_result():
+    return threading.Lock()
+
+def identity(x):
+    return x
+
+def die():
+    os._exit(1)
+
+class ThreadOffloaderTest(unittest.TestCase):
+    def test_run(self):
+        offloader = ThreadOffloader()
+        d = offloader.run(Feature.from_json, EXAMPLE_BODY)
+        self.failUnlessEqual(offloader.pending, 1)
+        def _check(f):
+            self.failUnlessEqual(f.to_dict(), Feature.from_json(EXAMPLE_BODY).to_dict())
+            self.failUnlessEqual(offloader.pending, 0)
+            self.failUnlessEqual(offloader.num_started, 1)
+            self.failUnless(offloader.max_wait >= offloader.last_wait >= 0)
+        d.addCallback(_check)
+        return d
+
+    def test_failure(self):
+        offloader = ThreadOffloader()
+        d = offloader.run(json_decode, '[1')
+        d = self.failUnlessFailure(d, DecodeError)
+        d.addCallback(lambda ign: self.failUnlessEqual(offloader.pending, 0))
+        return d
+
+class ProcessOffloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.offloader = ProcessOffloader(1)
+
+    def tearDown(self):
+        self.offloader.close()
+
+    def test_run(self):
+        d = self.offloader.run(_decode_feature, EXAMPLE_BODY, True, True, True)
+        def _check(f):
+            self.failUnlessEqual(f.to_dict(), Feature.from_json(EXAMPLE_BODY, compact=True).to_dict())
+            self.failUnlessEqual(self.offloader.num_started, 1)
+            self.failUnlessEqual(self.offloader.pending, 0)
+        d.addCallback(_check)
+        return d
+
+    def test_failure(self):
+        d = self.offloader.run(json_decode, '[1')
+        d = self.failUnlessFailure(d, DecodeError)
+        d.addCallback(lambda e: self.failUnlessEqual(e.body, '[1'))
+        return d
+
+    def test_unpicklable_failure(self):
+        return self.failUnlessFailure(self.offloader.run(unpicklable_error), OffloadError)
+
+    def test_unpicklable_function(self):
+        return self.failUnlessFailure(self.offloader.run(Feature.from_json, EXAMPLE_BODY), TypeError)
+
+    def _failed(self, d, *errors):
+        d = self.failUnlessFailure(d, *errors)
+        d.addCallback(lambda ign: self.failUnlessEqual(self.offloader.pending, 0))
+        return d
+
+    def test_unpicklable_argument(self):
+        return self._failed(self.offloader.run(identity, threading.Lock()), TypeError, cPickle.PicklingError)
+
+    def test_unpicklable_result(self):
+        d = self._failed(self.offloader.run(unpicklable_result), TypeError, cPickle.PicklingError)
+        # The worker is still usable.
+        d.addCallback(lambda ign: self.offloader.run(identity, 1))
+        d.addCallback(self.failUnlessEqual, 1)
+        return d
+
+    def test_worker_dies(self):
+        self.offloader.close()
+        self.offloader = ProcessOffloader(1, timeout=1)
+        return self._failed(self.offloader.run(die), OffloadError)
+
+class DecodeErrorPickleTest(unittest.TestCase):
+    def test_pickle(self):
+        try:
+            json_decode('[1')
+        except DecodeError, e:
+            e2 = cPickle.loads(cPickle.dumps(e, 2))
+            self.failUnlessEqual(repr(e2), repr(e))
+
+class RecordingOffloader(object):
+    def __init__(self):
+        self.calls = []
+
+    def run(self, f, *args):
+        self.calls.append(f)
+        return defer.maybeDeferred(f, *args)
+
+class ClientOffloadTest(unittest.TestCase):
+    def setUp(self):
+        self.offloader = RecordingOffloader()
+        self.client = Client('key', 'secret', offloader=self.offloader, offload_threshold=1000)
+
+    def test_large_body_is_offloaded(self):
+        self.client.agent = MockAgent(FakeSuccessResponse([EXAMPLE_BODY], {}))
+        d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970")
+        def _check(f):
+            self.failUnlessEqual(len(self.offloader.calls), 1)
+            self.failUnless(isinstance(f, Feature))
+        d.addCallback(_check)
+        return d
+
+    def test_small_body_is_inline(self):
+        self.client.offload_threshold = len(EXAMPLE_BODY) + 1
+        self.client.agent = MockAgent(FakeSuccessResponse([EXAMPLE_BODY], {}))
+        d = self.client.get_feature("SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970")
+        d.addCallback(lambda f: self.failUnlessEqual(self.offloader.calls, []))
+        return d
+
+    def test_get_features(self):
+        self.client.offload_threshold = 1
+        self.client.agent = MockFeaturesAgent()
+        handle = 'SG_%022d' % 1
+        d = self.client.get_features([handle])
+        def _check(res):
+            self.failUnlessEqual(self.offloader.calls, [json_decode])
+            self.failUnless(isinstance(res[handle], Feature))
+        d.addCallback(_check)
+        return d
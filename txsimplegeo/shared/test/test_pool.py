@@ -0,0 +1,137 @@
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.web import resource, server
+
+from txsimplegeo.shared import Client
+from txsimplegeo.shared.pool import CountingHTTPConnectionPool
+
+class FakeTransport(object):
+    def __init__(self):
+        self.lost = False
+
+    def loseConnection(self):
+        self.lost = True
+
+class FakeConnection(object):
+    state = 'QUIESCENT'
+
+    def __init__(self):
+        self.aborted = False
+        self.transport = FakeTransport()
+
+    def abort(self):
+        self.aborted = True
+        return defer.succeed(None)
+
+class FakeEndpoint(object):
+    def __init__(self):
+        self.connects = 0
+
+    def connect(self, factory):
+        self.connects += 1
+        return defer.succeed(FakeConnection())
+
+KEY = ('http', 'api.simplegeo.com', 80)
+
+HANDLE = "SG_6sRJczWZHdzNj4qSeRzpzz_40.005274_-105.048054@1291669259"
+
+class NotFound(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setResponseCode(404)
+        return 'No such feature.'
+
+class CountingHTTPConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = CountingHTTPConnectionPool(self.clock)
+        self.pool.retryAutomatically = False
+
+    def test_miss_opens_new_connection(self):
+        endpoint = FakeEndpoint()
+        self.pool.getConnection(KEY, endpoint)
+        self.failUnlessEqual(endpoint.connects, 1)
+        self.failUnlessEqual(self.pool.misses, 1)
+        self.failUnlessEqual(self.pool.hits, 0)
+
+    def test_hit_reuses_cached_connection(self):
+        endpoint = FakeEndpoint()
+        conn = FakeConnection()
+        self.pool._putConnection(KEY, conn)
+        self.failUnlessEqual(self.pool.num_cached_connections(), 1)
+
+        d = self.pool.getConnection(KEY, endpoint)
+        d.addCallback(self.failUnlessIdentical, conn)
+        self.failUnlessEqual(endpoint.connects, 0)
+        self.failUnlessEqual(self.pool.hits, 1)
+        self.failUnlessEqual(self.pool.misses, 0)
+        self.failUnlessEqual(self.pool.num_cached_connections(), 0)
+        return d
+
+    def test_connection_observer(self):
+        observed = []
+        def _observe(conn):
+            observed.append(conn)
+            return conn
+        self.pool.connection_observer = _observe
+        d = self.pool.getConnection(KEY, FakeEndpoint())
+        self.failUnlessEqual(self.pool.connection_observer, None)
+        d.addCallback(lambda conn: self.failUnlessEqual(observed, [conn]))
+        # Only the next connection is observed.
+        self.pool.getConnection(KEY, FakeEndpoint())
+        self.failUnlessEqual(len(observed), 1)
+        return d
+
+    def test_idle_connection_times_out(self):
+        self.pool.cachedConnectionTimeout = 5
+        conn = FakeConnection()
+        self.pool._putConnection(KEY, conn)
+        self.clock.advance(6)
+        self.failUnless(conn.transport.lost)
+        self.failUnlessEqual(self.pool.num_cached_connections(), 0)
+
+class ClientPoolTest(unittest.TestCase):
+    def test_client_configures_pool(self):
+        client = Client('key', 'secret', max_connections_per_host=3, idle_timeout=7)
+        self.failUnless(isinstance(client.pool, CountingHTTPConnectionPool))
+        self.failUnlessEqual(client.pool.maxPersistentPerHost, 3)
+        self.failUnlessEqual(client.pool.cachedConnectionTimeout, 7)
+        self.failUnlessEqual(client.pool_hits, 0)
+        self.failUnlessEqual(client.pool_misses, 0)
+
+    def test_clients_share_pool(self):
+        pool = CountingHTTPConnectionPool(task.Clock())
+        c1 = Client('key', 'secret', pool=pool)
+        c2 = Client('key', 'secret', pool=pool)
+        self.failUnlessIdentical(c1.pool, c2.pool)
+
+    def test_close_drains_pool(self):
+        client = Client('key', 'secret', pool=CountingHTTPConnectionPool(task.Clock()))
+        conn = FakeConnection()
+        client.pool._putConnection(KEY, conn)
+        d = client.close()
+        def _check(ign):
+            self.failUnless(conn.aborted)
+            self.failUnlessEqual(client.pool.num_cached_connections(), 0)
+        d.addCallback(_check)
+        return d
+
+    def test_error_response_connection_is_reused(self):
+        site = server.Site(NotFound())
+        site.timeOut = None
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        client = Client('key', 'secret', host='127.0.0.1', port=port.getHost().port)
+        self.addCleanup(client.close)
+        def _get(ign):
+            d = client.get_feature(HANDLE)
+            d.addCallbacks(lambda res: self.fail("expected a 404, got %r" % (res,)), lambda f: self.failUnlessEqual(f.value.code, 404))
+            return d
+        d = _get(None)
+        d.addCallback(_get)
+        def _check(ign):
+            # The second request went over the first one's connection.
+            self.failUnlessEqual((client.pool_misses, client.pool_hits), (1, 1))
+        d.addCallback(_check)
+        return d
@@ -0,0 +1,122 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from pyutil import jsonutil as json
+
+from txsimplegeo.shared import ChunkedProducer, Client, Feature, iter_feature_collection_json
+from txsimplegeo.shared.producer import rechunk
+from txsimplegeo.shared.test.test_scheduler import HoldingAgent
+
+class RechunkTest(unittest.TestCase):
+    def test_rechunk(self):
+        pieces = ['a', 'bc', '', 'defghij', 'k']
+        self.failUnlessEqual(list(rechunk(pieces, 3)), ['abc', 'def', 'ghi', 'jk'])
+        self.failUnlessEqual(list(rechunk(pieces, 100)), ['abcdefghijk'])
+        self.failUnlessEqual(list(rechunk([], 3)), [])
+
+class ListConsumer(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, bytes):
+        self.writes.append(bytes)
+
+class ChunkedProducerTest(unittest.TestCase):
+    def setUp(self):
+        # A cooperator which does one iteration of its tasks each time
+        # self._step() is called.
+        self._scheduled = []
+        self.cooperator = task.Cooperator(lambda: lambda: True, self._scheduled.append)
+        self.pulled = []
+
+    def _step(self):
+        self._scheduled.pop(0)()
+
+    def _pieces(self, n):
+        for i in range(n):
+            self.pulled.append(i)
+            yield 'x' * 10
+
+    def test_writes_bounded_chunks(self):
+        producer = ChunkedProducer(self._pieces(10), chunk_size=25, cooperator=self.cooperator)
+        self.failUnlessEqual(producer.length, UNKNOWN_LENGTH)
+        consumer = ListConsumer()
+        d = producer.startProducing(consumer)
+        results = []
+        d.addCallback(results.append)
+
+        self._step()
+        self.failUnlessEqual(consumer.writes, ['x' * 25])
+        # Only as many pieces as needed for the first chunk have been
+        # pulled from the source.
+        self.failUnlessEqual(len(self.pulled), 3)
+        while self._scheduled:
+            self._step()
+        self.failUnlessEqual(map(len, consumer.writes), [25, 25, 25, 25])
+        self.failUnlessEqual(producer.bytes_written, 100)
+        self.failUnlessEqual(results, [None])
+
+    def test_pause_resume(self):
+        producer = ChunkedProducer(self._pieces(10), chunk_size=10, cooperator=self.cooperator)
+        consumer = ListConsumer()
+        producer.startProducing(consumer)
+        self._step()
+        producer.pauseProducing()
+        while self._scheduled:
+            self._step()
+        self.failUnlessEqual(len(consumer.writes), 1)
+        producer.resumeProducing()
+        self._step()
+        self.failUnlessEqual(len(consumer.writes), 2)
+
+    def test_stop(self):
+        producer = ChunkedProducer(self._pieces(10), chunk_size=10, cooperator=self.cooperator)
+        consumer = ListConsumer()
+        d = producer.startProducing(consumer)
+        results = []
+        d.addBoth(results.append)
+        self._step()
+        producer.stopProducing()
+        while self._scheduled:
+            self._step()
+        self.failUnlessEqual(len(consumer.writes), 1)
+        self.failUnlessEqual(results, [])
+
+    def test_stop_after_done(self):
+        producer = ChunkedProducer(['abc'], cooperator=self.cooperator)
+        producer.startProducing(ListConsumer())
+        while self._scheduled:
+            self._step()
+        producer.stopProducing()
+
+    def test_cancel(self):
+        producer = ChunkedProducer(self._pieces(10), chunk_size=10, cooperator=self.cooperator)
+        consumer = ListConsumer()
+        d = producer.startProducing(consumer)
+        d.cancel()
+        while self._scheduled:
+            self._step()
+        self.failUnlessEqual(consumer.writes, [])
+
+class FeatureCollectionJSONTest(unittest.TestCase):
+    def test_iter_feature_collection_json(self):
+        features = [Feature((float(i), float(-i)), properties={'n': i}) for i in range(3)]
+        data = json.loads(''.join(iter_feature_collection_json(iter(features))))
+        self.failUnlessEqual(data['type'], 'FeatureCollection')
+        self.failUnlessEqual([f['properties']['n'] for f in data['features']], [0, 1, 2])
+        self.failUnlessEqual(data['features'][1]['geometry']['coordinates'], [-1.0, 1.0])
+        self.failUnlessEqual(json.loads(''.join(iter_feature_collection_json([]))), {'type': 'FeatureCollection', 'features': []})
+
+class RecordingAgent(HoldingAgent):
+    def request(self, method, endpoint, headers=None, bodyProducer=None):
+        self.bodyProducer = bodyProducer
+        return HoldingAgent.request(self, method, endpoint, headers, bodyProducer)
+
+class ClientRequestBodyTest(unittest.TestCase):
+    def test_request_takes_producer(self):
+        client = Client('key', 'secret')
+        client.agent = RecordingAgent()
+        producer = ChunkedProducer(['abc'])
+        client._request('http://thing', 'POST', producer)
+        self.failUnlessIdentical(client.agent.bodyProducer, producer)
@@ -0,0 +1,107 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.web.http_headers import Headers
+
+from txsimplegeo.shared import Client, TokenBucket
+from txsimplegeo.shared.ratelimit import shared_limiter
+from txsimplegeo.shared.test.test_client import FakeResponse
+from txsimplegeo.shared.test.test_scheduler import HoldingAgent
+
+def response(code=200, **headers):
+    h = Headers()
+    for (name, value) in headers.iteritems():
+        h.setRawHeaders(name.replace('_', '-'), [value])
+    return FakeResponse([], h, code)
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.fired = []
+
+    def _acquire(self, bucket, n):
+        for i in range(n):
+            bucket.acquire().addCallback(lambda ign, i=i: self.fired.append(i))
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(10, burst=3, clock=self.clock)
+        self._acquire(bucket, 6)
+        self.failUnlessEqual(self.fired, [0, 1, 2])
+        self.failUnlessEqual(bucket.queue_depth, 3)
+        self.clock.advance(0.1)
+        self.failUnlessEqual(self.fired, [0, 1, 2, 3])
+        self.clock.advance(0.2)
+        self.failUnlessEqual(self.fired, [0, 1, 2, 3, 4, 5])
+        self.failUnlessEqual(bucket.num_waited, 3)
+
+    def test_refills_up_to_burst(self):
+        bucket = TokenBucket(10, burst=2, clock=self.clock)
+        self._acquire(bucket, 2)
+        self.clock.advance(100)
+        self._acquire(bucket, 3)
+        self.failUnlessEqual(len(self.fired), 4)
+
+    def test_cancel(self):
+        bucket = TokenBucket(1, clock=self.clock)
+        self._acquire(bucket, 1)
+        d = bucket.acquire()
+        d.addErrback(lambda f: None)
+        d.cancel()
+        self.failUnlessEqual(bucket.queue_depth, 0)
+        self.clock.advance(1)
+
+    def test_set_rate(self):
+        bucket = TokenBucket(1, clock=self.clock)
+        self._acquire(bucket, 2)
+        self.failUnlessEqual(len(self.fired), 1)
+        bucket.set_rate(10)
+        self.clock.advance(0.1)
+        self.failUnlessEqual(len(self.fired), 2)
+
+    def test_update_from_quota_headers(self):
+        bucket = TokenBucket(100, clock=self.clock)
+        bucket.update_from_response(response(X_RateLimit_Remaining='50', X_RateLimit_Reset='10'))
+        self.failUnlessEqual(bucket.rate, 5)
+        # A POSIX time works too, and the rate never goes above the
+        # configured one.
+        self.clock.advance(2 * 10 ** 9)
+        bucket.update_from_response(response(X_RateLimit_Remaining='5000', X_RateLimit_Reset=str(2 * 10 ** 9 + 10)))
+        self.failUnlessEqual(bucket.rate, 100)
+        bucket.update_from_response(response(X_RateLimit_Remaining='0', X_RateLimit_Reset='10'))
+        self.failUnlessEqual(bucket.rate, 1)
+
+    def test_429_holds(self):
+        bucket = TokenBucket(10, burst=1, clock=self.clock)
+        bucket.update_from_response(response(429, Retry_After='5'))
+        self._acquire(bucket, 1)
+        self.clock.advance(4.9)
+        self.failUnlessEqual(self.fired, [])
+        self.clock.advance(0.2)
+        self.failUnlessEqual(self.fired, [0])
+
+class SharedLimiterTest(unittest.TestCase):
+    def test_shared_by_key(self):
+        l1 = shared_limiter('shared-key', 5)
+        self.failUnlessIdentical(shared_limiter('shared-key', 50), l1)
+        self.failIfIdentical(shared_limiter('other-key', 5), l1)
+        c1 = Client('client-key', 'secret', rate_limit=5)
+        c2 = Client('client-key', 'secret2', rate_limit=5)
+        self.failUnlessIdentical(c1.rate_limiter, c2.rate_limiter)
+        self.failUnlessEqual(Client('key', 'secret').rate_limiter, None)
+
+class ClientRateLimitTest(unittest.TestCase):
+    def test_requests_are_spread_out(self):
+        clock = task.Clock()
+        client = Client('key', 'secret')
+        client.rate_limiter = TokenBucket(2, burst=1, clock=clock)
+        client.agent = HoldingAgent()
+        for i in range(3):
+            client._request('http://thing', 'GET')
+        self.failUnlessEqual(len(client.agent.requests), 1)
+        clock.advance(0.5)
+        self.failUnlessEqual(len(client.agent.requests), 2)
+        client.agent.requests[0].callback(response(X_RateLimit_Remaining='1', X_RateLimit_Reset='10'))
+        self.failUnlessEqual(client.rate_limiter.rate, 0.1)
+        clock.advance(0.5)
+        self.failUnlessEqual(len(client.agent.requests), 2)
+        clock.advance(10)
+        self.failUnlessEqual(len(client.agent.requests), 3)
@@ -1,6 +1,10 @@
 import unittest
-from txsimplegeo.shared import Feature, deep_swap
+from txsimplegeo.shared import DecodeError, Feature, LazyFeature, deep_swap
+from txsimplegeo.shared.geometry import CompactCoordinates, extent
 from decimal import Decimal as D
+from StringIO import StringIO
+
+from pyutil import jsonutil as json
 
 class FeatureTest(unittest.TestCase):
 
@@ -142,6 +146,38 @@ class FeatureTest(unittest.TestCase):
         self.assertEquals(record.coordinates[0], 11.0)
         self.assertEquals(record.coordinates[1], 10.0)
 
+    def test_compact_from_dict(self):
+        record_dict = {
+                     'geometry' : {
+                                   'type' : 'Polygon',
+                                   'coordinates' : [[[D('-122.5'), D('37.75')], [-122.25, 37.5], [-122.5, 37.75]]]
+                                   },
+                     'id' : 'SG_abcdefghijklmnopqrstuv',
+                     'type' : 'Feature',
+                     'properties' : { 'key' : 'value' }
+                     }
+
+        record = Feature.from_dict(record_dict, compact=True)
+        self.failUnless(isinstance(record.coordinates, CompactCoordinates))
+        self.failUnlessEqual(record.coordinates[0][1], (37.5, -122.25))
+
+        jsondict = record.to_dict()
+        self.failUnlessEqual(jsondict['geometry']['coordinates'], [[(-122.5, 37.75), (-122.25, 37.5), (-122.5, 37.75)]])
+        self.failUnlessEqual(Feature.from_dict(jsondict).coordinates, record.coordinates)
+
+    def test_compact_constructor_validates(self):
+        self.failUnlessRaises(AssertionError, Feature, CompactCoordinates.from_nested([(91.0, 10.0)]))
+        Feature(CompactCoordinates.from_nested((11.0, 10.0)))
+
+    def test_skip_validation(self):
+        record = Feature((D('91.0'), D('10.1')), validate=False)
+        self.failUnlessEqual(record.coordinates, (D('91.0'), D('10.1')))
+
+        record_dict = { 'geometry' : { 'type' : 'Point', 'coordinates' : [200.0, 11.0] }, 'type' : 'Feature', 'properties' : {} }
+        self.failUnlessRaises(AssertionError, Feature.from_dict, record_dict)
+        record = Feature.from_dict(record_dict, validate=False)
+        self.failUnlessEqual(record.coordinates, (11.0, 200.0))
+
     def test_record_to_dict_sets_id_correctly(self):
         handle = 'SG_abcdefghijklmnopqrstuv'
         record_id = 'this is my record #1. my first record. and it is mine'
@@ -164,3 +200,128 @@ class FeatureTest(unittest.TestCase):
         dic = rec.to_dict()
         self.failUnlessEqual(dic.get('id'), None)
         self.failUnlessEqual(dic.get('properties', {}).get('record_id'), None)
+
+class FeatureSummaryTest(unittest.TestCase):
+    POLYGON = [[(0.0, 10.0), (0.0, 12.0), (4.0, 12.0), (0.0, 10.0)]]
+
+    def test_summary(self):
+        record = Feature(self.POLYGON, geomtype='Polygon', validate=False)
+        self.failUnlessEqual(record._extent, None)
+        self.failUnlessEqual(record.bbox, (0.0, 10.0, 4.0, 12.0))
+        self.failUnlessEqual(record.centroid, (1.0, 11.0))
+        self.failUnlessEqual(record.num_vertices, 4)
+        self.failUnlessEqual(Feature((D('37.5'), D('-122.25'))).bbox, (D('37.5'), D('-122.25'), D('37.5'), D('-122.25')))
+
+    def test_from_dict_precomputes(self):
+        for (compact, validate) in ((False, True), (True, True), (True, False)):
+            record = Feature.from_dict({'geometry': {'type': 'Polygon', 'coordinates': deep_swap(self.POLYGON)}, 'properties': {}}, compact=compact, validate=validate)
+            self.failIfEqual(record._extent, None)
+            self.failUnlessEqual(record.bbox, (0.0, 10.0, 4.0, 12.0))
+            self.failUnlessEqual(record.centroid, (1.0, 11.0))
+
+    def test_assignment_invalidates(self):
+        record = Feature(self.POLYGON, geomtype='Polygon')
+        self.failUnlessEqual(record.num_vertices, 4)
+        record.coordinates = (1.0, 2.0)
+        self.failUnlessEqual(record.bbox, (1.0, 2.0, 1.0, 2.0))
+        self.failUnlessEqual(record.num_vertices, 1)
+
+        lazy = LazyFeature.from_json(LAZY_BODY)
+        self.failUnlessEqual(lazy.bbox, (37.5, -122.5, 37.75, -122.25))
+        lazy.coordinates = (1.0, 2.0)
+        self.failUnlessEqual(lazy.centroid, (1.0, 2.0))
+
+    def test_to_dict_bbox(self):
+        record = Feature(self.POLYGON, geomtype='Polygon')
+        self.failUnlessEqual(record.to_dict()['bbox'], [10.0, 0.0, 12.0, 4.0])
+        self.failUnlessEqual(json.loads(record.to_json())['bbox'], [10.0, 0.0, 12.0, 4.0])
+        empty = Feature([], geomtype='LineString', validate=False)
+        self.failIf('bbox' in json.loads(empty.to_json()))
+        self.failUnlessEqual(empty.num_vertices, 0)
+
+class FeatureJSONTest(unittest.TestCase):
+    def test_iter_json(self):
+        record = Feature([[(D('37.75'), D('-122.5')), (37.5, -122.25), (D('37.75'), D('-122.5'))]], geomtype='Polygon', simplegeohandle='SG_abcdefghijklmnopqrstuv', properties={'key': [u'value\u2603', None]})
+        text = ''.join(record.iter_json())
+        self.failUnlessEqual(text, record.to_json())
+        self.failUnlessEqual(json.loads(text), json.loads(json.dumps(record.to_dict())))
+        self.failUnlessEqual(Feature.from_json(text).to_dict(), record.to_dict())
+
+    def test_write_json(self):
+        record = Feature.from_dict({'geometry': {'type': 'Point', 'coordinates': [10.0, 11.0]}, 'properties': {}}, compact=True)
+        f = StringIO()
+        record.write_json(f)
+        self.failUnlessEqual(json.loads(f.getvalue())['geometry'], {'type': 'Point', 'coordinates': [10.0, 11.0]})
+
+LAZY_BODY = '{"type": "Feature", "id": "SG_abcdefghijklmnopqrstuv", "properties": {"key": "value"}, "geometry": {"type": "Polygon", "coordinates": [[[-122.5, 37.75], [-122.25, 37.5], [-122.5, 37.75]]]}}'
+
+class LazyFeatureTest(unittest.TestCase):
+    def test_properties_without_geometry(self):
+        record = LazyFeature.from_json(LAZY_BODY)
+        self.failUnlessEqual(record.id, 'SG_abcdefghijklmnopqrstuv')
+        self.failUnlessEqual(record.properties, {'key': 'value'})
+        self.failIf(record.is_materialized())
+
+    def test_geometry_on_first_read(self):
+        record = LazyFeature.from_json(LAZY_BODY)
+        self.failUnlessEqual(record.coordinates[0][1], (D('37.5'), D('-122.25')))
+        self.failUnless(record.is_materialized())
+        self.failUnlessEqual(record.geomtype, 'Polygon')
+        self.failUnlessEqual(record.to_dict(), Feature.from_json(LAZY_BODY).to_dict())
+
+    def test_options(self):
+        record = LazyFeature.from_json(LAZY_BODY, use_decimal=False, compact=True)
+        self.failUnless(isinstance(record.coordinates, CompactCoordinates))
+        self.failUnlessEqual(record.coordinates[0][1], (37.5, -122.25))
+
+    def test_set_coordinates(self):
+        record = LazyFeature.from_json(LAZY_BODY)
+        record.coordinates = (D('1.0'), D('2.0'))
+        record.geomtype = 'Point'
+        self.failUnlessEqual(record.to_dict()['geometry'], {'type': 'Point', 'coordinates': (D('2.0'), D('1.0'))})
+
+    def test_late_errors(self):
+        record = LazyFeature.from_json(LAZY_BODY.replace('37.5', '97.5'))
+        self.failUnlessRaises(AssertionError, getattr, record, 'coordinates')
+        record = LazyFeature.from_json(LAZY_BODY.replace('37.5', '97.5'), validate=False)
+        self.failUnlessEqual(record.coordinates[0][1], (D('97.5'), D('-122.25')))
+        record = LazyFeature.from_json(LAZY_BODY.replace('"coordinates"', '"coords"'))
+        self.failUnlessRaises(DecodeError, getattr, record, 'coordinates')
+        self.failUnlessRaises(DecodeError, LazyFeature.from_json, LAZY_BODY[:-1])
+
+    def test_to_json_without_decoding(self):
+        record = LazyFeature.from_json(LAZY_BODY)
+        record.properties['key'] = 'changed'
+        text = record.to_json()
+        self.failIf(record.is_materialized())
+        decoded = Feature.from_json(text)
+        self.failUnlessEqual(decoded.coordinates, Feature.from_json(LAZY_BODY).coordinates)
+        self.failUnlessEqual(decoded.properties, {'key': 'changed'})
+        # Once decoded, it is written out like any other Feature.
+        record.coordinates
+        self.failUnlessEqual(record.to_json(), Feature.from_dict(record.to_dict()).to_json())
+
+    def test_extent_from_validation(self):
+        import txsimplegeo.shared
+        calls = []
+        def counting_extent(struc):
+            calls.append(struc)
+            return extent(struc)
+        txsimplegeo.shared.extent = counting_extent
+        try:
+            record = LazyFeature.from_json(LAZY_BODY)
+            self.failUnlessEqual(record.bbox, (D('37.5'), D('-122.5'), D('37.75'), D('-122.25')))
+            self.failUnlessEqual(record.num_vertices, 3)
+            # Validating the geometry found its extent already.
+            self.failUnlessEqual(calls, [])
+            record = LazyFeature.from_json(LAZY_BODY, validate=False)
+            self.failUnlessEqual(record.num_vertices, 3)
+            self.failUnlessEqual(len(calls), 1)
+        finally:
+            txsimplegeo.shared.extent = extent
+
+    def test_eager_construction(self):
+        record = LazyFeature((D('11.0'), D('10.0')))
+        self.failUnless(record.is_materialized())
+        self.failUnlessEqual(record.coordinates, (D('11.0'), D('10.0')))
+        self.failUnlessRaises(AssertionError, LazyFeature, (D('91.0'), D('10.0')))
@@ -0,0 +1,153 @@
+from twisted.trial import unittest
+from twisted.internet import defer, error, task
+from twisted.python.failure import Failure
+from twisted.web.http_headers import Headers
+
+from txsimplegeo.shared import Client, Feature, HistogramInstrumentation, RetryPolicy
+from txsimplegeo.shared.retry import parse_retry_after
+from txsimplegeo.shared.test.test_client import EXAMPLE_BODY, FakeResponse, FakeSuccessResponse
+from txsimplegeo.shared.test.test_scheduler import HoldingAgent
+
+HANDLE = "SG_4bgzicKFmP89tQFGLGZYy0_34.714646_-86.584970"
+
+def error_response(code, retry_after=None):
+    headers = Headers()
+    if retry_after is not None:
+        headers.setRawHeaders('Retry-After', [retry_after])
+    return FakeResponse([], headers, code)
+
+class ParseRetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.failUnlessEqual(parse_retry_after('120', 0), 120)
+
+    def test_date(self):
+        self.failUnlessEqual(parse_retry_after('Thu, 01 Jan 1970 00:01:40 GMT', 40), 60)
+        self.failUnlessEqual(parse_retry_after('Thu, 01 Jan 1970 00:01:40 GMT', 200), 0)
+
+    def test_garbage(self):
+        self.failUnlessEqual(parse_retry_after('soon', 0), None)
+
+class RetryPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(max_retries=3, base_delay=1, max_delay=10, random=lambda: 1.0)
+
+    def test_backoff(self):
+        self.failUnlessEqual([self.policy.backoff(i) for i in range(5)], [1, 2, 4, 8, 10])
+        self.policy.random = lambda: 0.5
+        self.failUnlessEqual(self.policy.backoff(1), 1)
+
+    def test_retry_codes(self):
+        self.failUnlessEqual(self.policy.retry_delay(0, error_response(503), 0), 1)
+        self.failUnlessEqual(self.policy.retry_delay(0, error_response(429), 0), 1)
+        self.failUnlessEqual(self.policy.retry_delay(0, error_response(404), 0), None)
+        self.failUnlessEqual(self.policy.retry_delay(3, error_response(503), 0), None)
+
+    def test_retry_errors(self):
+        self.failUnlessEqual(self.policy.retry_delay(1, Failure(error.ConnectionLost()), 0), 2)
+        self.failUnlessEqual(self.policy.retry_delay(1, Failure(error.ConnectionRefusedError()), 0), 2)
+        self.failUnlessEqual(self.policy.retry_delay(1, Failure(ValueError()), 0), None)
+
+    def test_retry_after(self):
+        self.failUnlessEqual(self.policy.retry_delay(0, error_response(503, '5'), 0), 5)
+        # The backoff wins if it is longer.
+        self.failUnlessEqual(self.policy.retry_delay(3 - 1, error_response(503, '1'), 0), 4)
+        # Give up rather than wait longer than max_delay.
+        self.failUnlessEqual(self.policy.retry_delay(0, error_response(429, '60'), 0), None)
+
+    def test_hedge_delay(self):
+        self.failUnlessEqual(self.policy.hedge_delay('GET', 'feature'), None)
+        self.policy.hedge_after = 0.5
+        self.failUnlessEqual(self.policy.hedge_delay('GET', 'feature'), 0.5)
+        self.failUnlessEqual(self.policy.hedge_delay('POST', 'feature'), None)
+        self.policy.hedge_after = lambda name: {'feature': 0.25}.get(name)
+        self.failUnlessEqual(self.policy.hedge_delay('GET', 'feature'), 0.25)
+        self.failUnlessEqual(self.policy.hedge_delay('GET', 'features'), None)
+
+class ScriptedAgent(object):
+    """ Answers each request with the next of the given results: a
+    response, or an exception to errback with. """
+    def __init__(self, results):
+        self.results = list(results)
+        self.requests = []
+
+    def request(self, method, endpoint, headers=None, bodyProducer=None):
+        self.requests.append(headers.getRawHeaders('Authorization')[0])
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            return defer.fail(result)
+        return defer.succeed(result)
+
+class ClientRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.inst = HistogramInstrumentation()
+        self.client = Client('key', 'secret', instrumentation=self.inst, retry_policy=RetryPolicy(base_delay=1, random=lambda: 1.0))
+        self.client.clock = self.clock
+
+    def test_retries_then_succeeds(self):
+        self.client.agent = ScriptedAgent([error_response(503), error.ConnectionLost(), FakeSuccessResponse([EXAMPLE_BODY], {})])
+        d = self.client.get_feature(HANDLE)
+        results = []
+        d.addCallback(results.append)
+        self.failUnlessEqual(len(self.client.agent.requests), 1)
+        self.clock.advance(1)
+        self.failUnlessEqual(len(self.client.agent.requests), 2)
+        self.clock.advance(2)
+        self.failUnlessEqual(len(self.client.agent.requests), 3)
+        self.failUnless(isinstance(results[0], Feature))
+        # Each attempt was signed afresh.
+        self.failUnlessEqual(len(set(self.client.agent.requests)), 3)
+        self.failUnlessEqual(self.inst.retries, 2)
+        self.failUnlessEqual(self.inst.codes, {200: 1})
+
+    def test_gives_up(self):
+        self.client.retry_policy.max_retries = 1
+        self.client.agent = ScriptedAgent([error_response(500), error_response(502)])
+        d = self.client.get_feature(HANDLE)
+        self.clock.advance(1)
+        d = self.failUnlessFailure(d, FakeResponse)
+        d.addCallback(lambda resp: self.failUnlessEqual(resp.code, 502))
+        return d
+
+    def test_not_retryable(self):
+        self.client.agent = ScriptedAgent([error_response(404)])
+        d = self.client.get_feature(HANDLE)
+        return self.failUnlessFailure(d, FakeResponse)
+
+    def test_post_is_not_retried(self):
+        self.client.agent = ScriptedAgent([error_response(503)])
+        d = self.client._request('http://thing', 'POST', 'body')
+        d.addCallback(lambda resp: self.failUnlessEqual(resp.code, 503))
+        return d
+
+    def test_hedge(self):
+        self.client.retry_policy.hedge_after = 0.5
+        self.client.agent = HoldingAgent()
+        d = self.client.get_feature(HANDLE)
+        results = []
+        d.addCallback(results.append)
+        self.failUnlessEqual(len(self.client.agent.requests), 1)
+        self.clock.advance(0.5)
+        self.failUnlessEqual(len(self.client.agent.requests), 2)
+        # The duplicate answers first, and the original is cancelled.
+        self.client.agent.requests[1].callback(FakeSuccessResponse([EXAMPLE_BODY], {}))
+        self.failUnless(isinstance(results[0], Feature))
+        self.failUnless(self.client.agent.requests[0].called)
+        self.failUnlessEqual(self.inst.hedges, 1)
+
+    def test_no_hedge_when_fast(self):
+        self.client.retry_policy.hedge_after = 0.5
+        self.client.agent = HoldingAgent()
+        d = self.client.get_feature(HANDLE)
+        self.client.agent.requests[0].callback(FakeSuccessResponse([EXAMPLE_BODY], {}))
+        self.clock.advance(1)
+        self.failUnlessEqual(len(self.client.agent.requests), 1)
+        return d
+
+    def test_hedge_from_histogram(self):
+        for i in range(20):
+            self.inst.phases['ttfb'].add(0.1)
+        self.inst.by_name['feature'] = self.inst.phases
+        self.client.retry_policy.hedge_after = lambda name: self.inst.percentile('ttfb', 95, name, min_count=10)
+        self.failUnlessEqual(self.client.retry_policy.hedge_delay('GET', 'feature'), 0.1)
+        self.failUnlessEqual(self.client.retry_policy.hedge_delay('GET', 'features'), None)
@@ -0,0 +1,100 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from txsimplegeo.shared import Client
+from txsimplegeo.shared.scheduler import RequestScheduler
+
+class RequestSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = RequestScheduler(2, clock=self.clock)
+        self.started = []
+
+    def _op(self, name):
+        d = defer.Deferred()
+        self.started.append((name, d))
+        return d
+
+    def test_limits_in_flight(self):
+        results = []
+        for i in range(5):
+            self.scheduler.run(self._op, i).addCallback(results.append)
+        self.failUnlessEqual([name for (name, d) in self.started], [0, 1])
+        self.failUnlessEqual(self.scheduler.in_flight, 2)
+        self.failUnlessEqual(self.scheduler.queue_depth, 3)
+
+        self.started[0][1].callback('a')
+        self.failUnlessEqual(results, ['a'])
+        self.failUnlessEqual([name for (name, d) in self.started], [0, 1, 2])
+        self.failUnlessEqual(self.scheduler.queue_depth, 2)
+
+    def test_priority_then_fifo(self):
+        self.scheduler.max_in_flight = 1
+        self.scheduler.run(self._op, 'first')
+        self.scheduler.schedule(5, self._op, 'low1')
+        self.scheduler.schedule(5, self._op, 'low2')
+        self.scheduler.schedule(-1, self._op, 'high')
+        for i in range(3):
+            self.started[-1][1].callback(None)
+        self.failUnlessEqual([name for (name, d) in self.started], ['first', 'high', 'low1', 'low2'])
+
+    def test_wait_time(self):
+        self.scheduler.max_in_flight = 1
+        self.scheduler.run(self._op, 'first')
+        self.scheduler.run(self._op, 'second')
+        self.clock.advance(3)
+        self.failUnlessEqual(self.scheduler.oldest_wait(), 3)
+        self.started[0][1].callback(None)
+        self.failUnlessEqual(self.scheduler.last_wait, 3)
+        self.failUnlessEqual(self.scheduler.max_wait, 3)
+        self.failUnlessEqual(self.scheduler.mean_wait(), 1.5)
+
+    def test_failure_frees_slot(self):
+        self.scheduler.max_in_flight = 1
+        d = self.scheduler.run(self._op, 'first')
+        self.scheduler.run(self._op, 'second')
+        self.started[0][1].errback(ValueError())
+        self.failUnlessEqual(len(self.started), 2)
+        return self.failUnlessFailure(d, ValueError)
+
+    def test_cancel_queued(self):
+        self.scheduler.max_in_flight = 1
+        self.scheduler.run(self._op, 'first')
+        d = self.scheduler.run(self._op, 'second')
+        d.cancel()
+        self.failUnlessEqual(self.scheduler.queue_depth, 0)
+        self.started[0][1].callback(None)
+        self.failUnlessEqual(len(self.started), 1)
+        return self.failUnlessFailure(d, defer.CancelledError)
+
+    def test_synchronous_results(self):
+        scheduler = RequestScheduler(1, clock=self.clock)
+        results = []
+        for i in range(1000):
+            scheduler.run(defer.succeed, i).addCallback(results.append)
+        self.failUnlessEqual(results, range(1000))
+        self.failUnlessEqual(scheduler.in_flight, 0)
+
+    def test_unlimited(self):
+        scheduler = RequestScheduler(None, clock=self.clock)
+        for i in range(50):
+            scheduler.run(self._op, i)
+        self.failUnlessEqual(scheduler.in_flight, 50)
+
+class HoldingAgent(object):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, endpoint, headers=None, bodyProducer=None):
+        d = defer.Deferred()
+        self.requests.append(d)
+        return d
+
+class ClientSchedulerTest(unittest.TestCase):
+    def test_client_queues_requests(self):
+        client = Client('key', 'secret', max_in_flight=3)
+        client.agent = HoldingAgent()
+        for i in range(10):
+            client._request('http://thing', 'GET')
+        self.failUnlessEqual(len(client.agent.requests), 3)
+        self.failUnlessEqual(client.scheduler.queue_depth, 7)
@@ -0,0 +1,159 @@
+import random
+
+from twisted.trial import unittest
+
+from txsimplegeo.shared import Feature, FeatureCache, GridIndex
+from txsimplegeo.shared.spatial import MAX_CELLS_PER_FEATURE, distance, distance_to_box
+
+def point(lat, lon):
+    return Feature((lat, lon))
+
+def box(minlat, minlon, maxlat, maxlon):
+    return Feature([[(minlat, minlon), (minlat, maxlon), (maxlat, maxlon), (maxlat, minlon), (minlat, minlon)]], geomtype='Polygon')
+
+class DistanceTest(unittest.TestCase):
+    def test_distance(self):
+        # One degree of latitude is about 111.2km.
+        self.failUnlessApproximates(distance(0, 0, 1, 0), 111195, 1)
+        self.failUnlessApproximates(distance(60, 0, 60, 1), 111195 / 2.0, 100)
+        self.failUnlessEqual(distance(37.75, -122.5, 37.75, -122.5), 0)
+
+    def test_distance_to_box(self):
+        self.failUnlessEqual(distance_to_box(1, 1, (0, 0, 2, 2)), 0)
+        self.failUnlessApproximates(distance_to_box(3, 1, (0, 0, 2, 2)), distance(3, 1, 2, 1), 1e-6)
+
+class GridIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = GridIndex(cell_size=1)
+
+    def test_insert_remove(self):
+        f = point(37.75, -122.5)
+        self.index.insert(f, 'a')
+        self.failUnless('a' in self.index)
+        self.failUnlessIdentical(self.index.get('a'), f)
+        self.failUnlessEqual(self.index.intersecting((37, -123, 38, -122)), [('a', f)])
+        # Re-inserting under the same key moves it.
+        g = point(10, 10)
+        self.index.insert(g, 'a')
+        self.failUnlessEqual(len(self.index), 1)
+        self.failUnlessEqual(self.index.intersecting((37, -123, 38, -122)), [])
+        self.index.remove('a')
+        self.failUnlessEqual(len(self.index), 0)
+        self.failUnlessEqual(self.index._cells, {})
+        self.index.remove('a')
+
+    def test_key_defaults_to_handle(self):
+        f = Feature((1.0, 2.0), simplegeohandle='SG_%022d' % 1)
+        self.index.insert(f)
+        self.failUnless(f.id in self.index)
+
+    def test_intersecting(self):
+        self.index.insert(box(0, 0, 2, 2), 'box')
+        self.index.insert(point(5, 5), 'p')
+        self.failUnlessEqual(sorted([k for (k, f) in self.index.intersecting((1.5, 1.5, 6, 6))]), ['box', 'p'])
+        self.failUnlessEqual([k for (k, f) in self.index.intersecting((3, 3, 4, 4))], [])
+        # Much bigger than the grid: every feature is checked instead.
+        self.failUnlessEqual(len(self.index.intersecting((-90, -180, 90, 180))), 2)
+
+    def test_large_features(self):
+        self.index.insert(box(-50, -50, 50, 50), 'big')
+        self.failUnlessEqual(self.index._large, set(['big']))
+        self.failUnlessEqual(self.index.intersecting((10, 10, 11, 11))[0][0], 'big')
+        self.failUnlessEqual(self.index.nearest(10, 10)[0][:2], (0, 'big'))
+        self.index.remove('big')
+        self.failUnlessEqual(self.index._large, set())
+        self.failUnless(MAX_CELLS_PER_FEATURE < 100 * 100)
+
+    def test_nearest(self):
+        self.index.insert(point(0, 0), 'origin')
+        self.index.insert(point(0, 3), 'east')
+        self.index.insert(point(10, 0), 'north')
+        result = self.index.nearest(0, 1, k=2)
+        self.failUnlessEqual([key for (d, key, f) in result], ['origin', 'east'])
+        self.failUnlessApproximates(result[0][0], distance(0, 1, 0, 0), 1e-6)
+        self.failUnlessEqual([key for (d, key, f) in self.index.nearest(0, 1, k=10)], ['origin', 'east', 'north'])
+        self.failUnlessEqual([key for (d, key, f) in self.index.nearest(0, 1, k=10, max_distance=300000)], ['origin', 'east'])
+        self.failUnlessEqual(GridIndex().nearest(0, 0), [])
+
+    def _check_brute_force(self, rng, lats, lons, query_lats, query_lons, cell_size):
+        index = GridIndex(cell_size=cell_size)
+        points = {}
+        for i in range(300):
+            (lat, lon) = (rng.uniform(*lats), rng.uniform(*lons))
+            points[i] = (lat, lon)
+            index.insert(point(lat, lon), i)
+        for i in range(0, 300, 3):
+            index.remove(i)
+            del points[i]
+        for j in range(20):
+            (lat, lon) = (rng.uniform(*query_lats), rng.uniform(*query_lons))
+            expected = sorted([(distance(lat, lon, plat, plon), key) for (key, (plat, plon)) in points.iteritems()])[:5]
+            self.failUnlessEqual([(d, key) for (d, key, f) in index.nearest(lat, lon, k=5)], expected)
+
+    def test_nearest_matches_brute_force(self):
+        rng = random.Random(0)
+        self._check_brute_force(rng, (30, 40), (-110, -100), (25, 45), (-115, -95), 0.5)
+        # Near the pole the nearest feature may be across it, more
+        # than 90 degrees of longitude away.
+        self._check_brute_force(rng, (85, 90), (-180, 180), (85, 90), (-180, 180), 5)
+
+    def test_ring_size(self):
+        index = GridIndex()
+        for (row, col, ring, extent) in [(0, 0, 0, (0, 0, 0, 0)), (0, 0, 3, (-10, -10, 10, 10)), (5, 5, 4, (0, 0, 6, 20)), (0, 0, 30, (-2, -2, 2, 2))]:
+            self.failUnlessEqual(index._ring_size(row, col, ring, extent), len(index._ring(row, col, ring, extent)))
+
+    def test_nearest_sparse(self):
+        # A few features on each of two continents make an extent of
+        # millions of cells, nearly all of them empty.
+        rng = random.Random(1)
+        index = GridIndex()
+        points = {}
+        for i in range(40):
+            if i % 2:
+                (lat, lon) = (rng.uniform(30, 50), rng.uniform(-120, -75))
+            else:
+                (lat, lon) = (rng.uniform(40, 60), rng.uniform(-5, 30))
+            points[i] = (lat, lon)
+            index.insert(point(lat, lon), i)
+        visited = []
+        real_ring = index._ring
+        def _ring(*args):
+            cells = real_ring(*args)
+            visited.extend(cells)
+            return cells
+        index._ring = _ring
+        for (lat, lon, k) in [(-40, 150, 3), (45, -40, 5), (40, -100, 100)]:
+            del visited[:]
+            expected = sorted([(distance(lat, lon, plat, plon), key) for (key, (plat, plon)) in points.iteritems()])[:k]
+            self.failUnlessEqual([(d, key) for (d, key, f) in index.nearest(lat, lon, k=k)], expected)
+            self.failUnless(len(visited) <= len(index._cells), (lat, lon, k, len(visited)))
+
+    def test_nearest_across_pole(self):
+        index = GridIndex()
+        index.insert(point(89.5, 100.0), 'near')
+        index.insert(point(0.0, 0.0), 'far')
+        [(d, key, f)] = index.nearest(89.5, -80.0)
+        self.failUnlessEqual(key, 'near')
+        self.failUnlessApproximates(d, 111195, 1)
+
+    def test_nearest_across_antimeridian(self):
+        index = GridIndex()
+        index.insert(point(0.0, 179.9), 'near')
+        index.insert(point(0.0, -175.0), 'far')
+        [(d, key, f)] = index.nearest(0.0, -179.9)
+        self.failUnlessEqual(key, 'near')
+
+class FeatureCacheIndexTest(unittest.TestCase):
+    def test_cache_keeps_index(self):
+        index = GridIndex()
+        cache = FeatureCache(maxsize=2, index=index)
+        cache.put('a', point(1, 1))
+        cache.put('b', point(2, 2))
+        self.failUnlessEqual(index.nearest(1.1, 1.1)[0][1], 'a')
+        cache.put('c', point(3, 3))
+        # 'a' was evicted.
+        self.failIf('a' in index)
+        cache.invalidate('b')
+        self.failUnlessEqual([key for (d, key, f) in index.nearest(0, 0, k=5)], ['c'])
+        cache.clear()
+        self.failUnlessEqual(len(index), 0)